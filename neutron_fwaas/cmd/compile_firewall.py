@@ -0,0 +1,243 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compile a firewall group into iptables rules without a router.
+
+The firewall group, in the format the FWaaS plugin sends to the L3 agents
+(see FirewallPluginDb.make_firewall_group_dict_with_rules()), is applied
+to the given router ports by the iptables driver, with the [fwaas] options
+of the configuration files, to an iptables manager which only keeps the
+rules in memory. The filter table is then printed in the iptables-save
+format, followed by comment lines with the size of the result and the
+compile time.
+"""
+
+import json
+import sys
+import time
+import types
+
+from neutron.agent.linux import iptables_manager
+from oslo_config import cfg
+
+from neutron_fwaas._i18n import _
+from neutron_fwaas.services.firewall.service_drivers.agents import \
+    firewall_agent_api  # noqa
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import iptables_fwaas_v2
+
+BUILTIN_CHAINS = ('INPUT', 'FORWARD', 'OUTPUT')
+
+
+class InMemoryIptablesManager(iptables_manager.IptablesManager):
+    """Iptables manager whose rules are never applied to the host."""
+
+    def __init__(self, namespace=None):
+        super(InMemoryIptablesManager, self).__init__(
+            use_ipv6=True, namespace=namespace, external_lock=False)
+
+    def _apply(self):
+        return []
+
+
+class OfflineIptablesFwaasDriver(iptables_fwaas_v2.IptablesFwaasDriver):
+    """Iptables driver keeping the ipsets of the groups in memory."""
+
+    def __init__(self):
+        super(OfflineIptablesFwaasDriver, self).__init__()
+        # (set ID, ethertype) -> addresses
+        self.ipset_members = {}
+
+    def _set_ipsets(self, ipt_mgr, ipsets):
+        self.ipset_members.update(ipsets)
+
+    def _remove_unused_ipsets(self, fwid, ipt_mgr, ipsets):
+        pass
+
+
+def compile_firewall(firewall, ports, namespace=None):
+    """Apply a firewall group to ports of an in-memory router.
+
+    :returns: the driver, the iptables manager and the compile time in
+        seconds
+    """
+    driver = OfflineIptablesFwaasDriver()
+    ipt_mgr = InMemoryIptablesManager(namespace=namespace)
+    router = types.SimpleNamespace(router={}, iptables_manager=ipt_mgr)
+    start = time.monotonic()
+    driver._setup_firewall('legacy', [(router, ports)], firewall)
+    return driver, ipt_mgr, time.monotonic() - start
+
+
+def _chain_rules(table, chain):
+    """Rules of a wrapped chain, in the order they are written in."""
+    rules = [rule for rule in table.rules if rule.wrap and rule.chain == chain]
+    return ([rule.rule for rule in rules if rule.top] +
+            [rule.rule for rule in rules if not rule.top])
+
+
+def save_table(table):
+    """Filter table of an iptables manager as iptables-save prints it."""
+    lines = ['*filter']
+    lines += [':%s ACCEPT [0:0]' % chain for chain in BUILTIN_CHAINS]
+    lines += [':%s - [0:0]' % chain
+              for chain in sorted(table.unwrapped_chains)]
+    lines += [':%s-%s - [0:0]' % (table.wrap_name, chain)
+              for chain in sorted(table.chains)]
+    lines += [str(rule) for rule in table.rules if rule.top]
+    lines += [str(rule) for rule in table.rules if not rule.top]
+    lines.append('COMMIT')
+    return '\n'.join(lines)
+
+
+def _wrapped_target(table, rule, option):
+    """Chain of the table a rule jumps or goes to with option, if any."""
+    args = rule.split()
+    prefix = table.wrap_name + '-'
+    for idx, arg in enumerate(args[:-1]):
+        if arg == option and args[idx + 1].startswith(prefix):
+            return args[idx + 1][len(prefix):]
+    return None
+
+
+def _matches_interface(rule, iptables_dir, intf_name):
+    args = rule.split()
+    if iptables_dir not in args[:-1]:
+        return True
+    pattern = args[args.index(iptables_dir) + 1]
+    if pattern.endswith('+'):
+        return intf_name.startswith(pattern[:-1])
+    return intf_name == pattern
+
+
+def _rules_to_jump(table, chain, target, iptables_dir, intf_name):
+    """Rules a packet of an interface goes through up to a jump to target.
+
+    The chains the packet jumps to on the way, like the interface dispatch
+    chains, are searched for the jump too.
+
+    :returns: the number of rules, the jump included, or None when the
+        packet does not reach the jump
+    """
+    count = 0
+    for rule in _chain_rules(table, chain):
+        count += 1
+        jump = _wrapped_target(table, rule, '-j')
+        if not (jump and _matches_interface(rule, iptables_dir, intf_name)):
+            continue
+        if jump == target:
+            return count
+        if jump != chain:
+            jump_count = _rules_to_jump(table, jump, target, iptables_dir,
+                                        intf_name)
+            if jump_count is not None:
+                return count + jump_count
+    return None
+
+
+def _chain_depth(table, chain):
+    """Largest number of rules a packet goes through in a chain tree.
+
+    Packets either go through all the rules of the chain or go to a
+    sub-chain of the tree, see chain_tree.ChainNode.depth().
+    """
+    rules = _chain_rules(table, chain)
+    depth = len(rules)
+    for idx, rule in enumerate(rules):
+        child = _wrapped_target(table, rule, '-g')
+        if child is not None:
+            depth = max(depth, idx + 1 + _chain_depth(table, child))
+    return depth
+
+
+def get_metrics(driver, ipt_mgr, firewall, ports):
+    """Size of what the driver compiled for a group, per IP version.
+
+    :returns: {<IP version>: {'rules': <FWaaS rules, FORWARD included>,
+                              'chains': <FWaaS chains>,
+                              'depth': <worst number of rules a packet
+                                        goes through in FORWARD and the
+                                        chains of the group>}}
+    """
+    metrics = {}
+    # the group as compiled, its policy-shared chains are named after it
+    applied_firewall = driver.fwg_states.get(firewall['id']).applied_firewall
+    intf_names = [driver._get_intf_name(iptables_fwaas_v2.INTERNAL_DEV_PREFIX,
+                                        port) for port in ports]
+    for version, ver, table in [(4, iptables_fwaas_v2.IPV4,
+                                 ipt_mgr.ipv4['filter']),
+                                (6, iptables_fwaas_v2.IPV6,
+                                 ipt_mgr.ipv6['filter'])]:
+        chains = [chain for chain in table.chains
+                  if driver._is_fwaas_chain(chain)]
+        rules = [rule for rule in table.rules
+                 if rule.wrap and (rule.chain in chains or
+                                   rule.chain == iptables_fwaas_v2.
+                                   FORWARD_CHAIN)]
+        depth = 0
+        for direction, iptables_dir in iptables_fwaas_v2.IPTABLES_DIR.items():
+            chain = iptables_manager.get_chain_name(driver._get_chain_name(
+                driver._get_rule_chains_id(applied_firewall, direction),
+                ver, direction))
+            if chain not in table.chains:
+                continue
+            chain_depth = _chain_depth(table, chain)
+            for intf_name in intf_names:
+                count = _rules_to_jump(table, iptables_fwaas_v2.FORWARD_CHAIN,
+                                       chain, iptables_dir, intf_name)
+                if count is not None:
+                    depth = max(depth, count + chain_depth)
+        metrics[version] = {'rules': len(rules), 'chains': len(chains),
+                            'depth': depth}
+    return metrics
+
+
+def setup_conf(args=None):
+    cli_opts = [
+        cfg.StrOpt('firewall-group',
+                   positional=True,
+                   help=_('JSON file of the firewall group, with its '
+                          'ingress_rule_list and egress_rule_list, - for '
+                          'the standard input')),
+        cfg.MultiStrOpt('port',
+                        default=[],
+                        help=_('ID of a router port the group applies to, '
+                               'its ports by default')),
+        cfg.IntOpt('ip-version',
+                   default=4,
+                   choices=[4, 6],
+                   help=_('IP version of the filter table to print')),
+    ]
+    conf = cfg.CONF
+    conf.register_cli_opts(cli_opts)
+    conf(args, project='neutron')
+    return conf
+
+
+def main():
+    conf = setup_conf()
+    if conf.firewall_group == '-':
+        firewall = json.load(sys.stdin)
+    else:
+        with open(conf.firewall_group) as firewall_file:
+            firewall = json.load(firewall_file)
+    ports = conf.port or firewall.get('ports', [])
+
+    driver, ipt_mgr, elapsed = compile_firewall(firewall, ports)
+    table = (ipt_mgr.ipv4 if conf.ip_version == 4 else ipt_mgr.ipv6)
+    print(save_table(table['filter']))
+    for version, metrics in sorted(get_metrics(driver, ipt_mgr, firewall,
+                                               ports).items()):
+        print('# IPv%d: %d rules, %d chains, worst-case depth %d' % (
+            version, metrics['rules'], metrics['chains'], metrics['depth']))
+    print('# %d ports, %d ipsets, compiled in %.1f ms' % (
+        len(ports), len(driver.ipset_members), elapsed * 1000))
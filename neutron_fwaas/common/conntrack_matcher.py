@@ -0,0 +1,207 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Match conntrack entries against the filters of firewall rules.
+
+The filters are indexed by IP version and protocol. Within an index, each
+filter is a bit of an integer mask, and every dimension of the filters
+maps the value of an entry to the mask of the filters it satisfies:
+
+- the source and destination port ranges (ICMP type and code for ICMP
+  entries) through the sorted boundaries of the ranges, each interval
+  between two boundaries being covered by the same filters;
+- the source and destination addresses through the prefixes of the
+  filters, grouped by prefix length.
+
+An entry matches when the masks of all the dimensions have a bit in
+common, which takes a binary search per port and a lookup per prefix
+length of the filters per address, however many filters overlap.
+"""
+
+import bisect
+import ipaddress
+
+from neutron_lib import constants
+
+ADDRESS_BITS = {constants.IP_VERSION_4: 32, constants.IP_VERSION_6: 128}
+ICMP_PROTOCOLS = (constants.PROTO_NAME_ICMP,
+                  constants.PROTO_NAME_IPV6_ICMP_LEGACY)
+
+
+def normalize_filter(rule_filter):
+    """Turn a filter parsed from a firewall rule into a matcher filter
+
+    :param rule_filter: (ip_version, protocol, source port range,
+        destination port range, source address, destination address) as
+        parsed from a firewall rule by the conntrack drivers,
+        ex: (4, 'tcp', ['0', '10'], [], '10.0.0.0/24', [])
+    :return: the filter with the conntrack name of the protocol, integer
+        [lower, upper] port ranges and None for what any entry matches,
+        ex: (4, 'tcp', [0, 10], None, '10.0.0.0/24', None)
+    """
+    ip_version, protocol, sport_range, dport_range = rule_filter[:4]
+    if protocol == constants.PROTO_NAME_IPV6_ICMP:
+        protocol = constants.PROTO_NAME_IPV6_ICMP_LEGACY
+    port_ranges = []
+    for port_range in (sport_range, dport_range):
+        if port_range:
+            port_range = sorted(int(port) for port in port_range)
+            port_range = [port_range[0], port_range[-1]]
+        port_ranges.append(port_range or None)
+    addresses = [address or None for address in rule_filter[4:6]]
+    addresses += [None] * (2 - len(addresses))
+    return (ip_version, protocol or None) + tuple(port_ranges + addresses)
+
+
+def _address_to_int(address):
+    return int(ipaddress.ip_address(address))
+
+
+class _IntervalIndex(object):
+    """Filters covering a value, from their [lower, upper] ranges."""
+
+    def __init__(self, ranges):
+        any_mask = 0
+        events = {}
+        for bit, value_range in ranges:
+            if not value_range:
+                any_mask |= bit
+                continue
+            lower, upper = value_range
+            events.setdefault(lower, [0, 0])[0] |= bit
+            events.setdefault(upper + 1, [0, 0])[1] |= bit
+        self._starts = sorted(events)
+        self._masks = []
+        mask = any_mask
+        for start in self._starts:
+            entering, leaving = events[start]
+            mask = (mask | entering) & ~leaving
+            self._masks.append(mask)
+        self._any_mask = any_mask
+
+    def lookup(self, value):
+        idx = bisect.bisect_right(self._starts, value) - 1
+        return self._masks[idx] if idx >= 0 else self._any_mask
+
+
+class _PrefixIndex(object):
+    """Filters whose prefix contains an address, by prefix length."""
+
+    def __init__(self, prefixes, ip_version):
+        self.bits = ADDRESS_BITS[ip_version]
+        self.any_mask = 0
+        # [(shift, {<network >> shift>: <mask>})] by decreasing length
+        networks = {}
+        for bit, prefix in prefixes:
+            if not prefix:
+                self.any_mask |= bit
+                continue
+            network = ipaddress.ip_network(prefix, strict=False)
+            shift = self.bits - network.prefixlen
+            by_network = networks.setdefault(shift, {})
+            key = int(network.network_address) >> shift
+            by_network[key] = by_network.get(key, 0) | bit
+        self._networks = sorted(networks.items())
+
+    def lookup(self, address):
+        if address is None:
+            return self.any_mask
+        address = _address_to_int(address)
+        mask = self.any_mask
+        for shift, by_network in self._networks:
+            mask |= by_network.get(address >> shift, 0)
+        return mask
+
+
+class _FilterIndex(object):
+    """Index of the filters of an IP version and protocol."""
+
+    def __init__(self, rule_filters, ip_version):
+        bits = [1 << idx for idx in range(len(rule_filters))]
+        self.all_mask = (1 << len(rule_filters)) - 1
+        self.sports = _IntervalIndex(
+            zip(bits, (rule_filter[2] for rule_filter in rule_filters)))
+        self.dports = _IntervalIndex(
+            zip(bits, (rule_filter[3] for rule_filter in rule_filters)))
+        self.sources = _PrefixIndex(
+            zip(bits, (rule_filter[4] for rule_filter in rule_filters)),
+            ip_version)
+        self.destinations = _PrefixIndex(
+            zip(bits, (rule_filter[5] for rule_filter in rule_filters)),
+            ip_version)
+
+    def match(self, first, second, src, dst, reply_src):
+        mask = self.sports.lookup(first) & self.dports.lookup(second)
+        if mask and self.sources.any_mask != self.all_mask:
+            mask &= self.sources.lookup(src)
+        if mask and self.destinations.any_mask != self.all_mask:
+            dst_mask = self.destinations.lookup(dst)
+            if reply_src is not None:
+                dst_mask |= self.destinations.lookup(reply_src)
+            mask &= dst_mask
+        return bool(mask)
+
+
+class ConntrackMatcher(object):
+    """Classify conntrack entries against the filters of firewall rules
+
+    The source address of a filter is compared to the original source
+    address of the entries. The destination address of a filter is
+    compared to both the original destination address of the entries and
+    the source address of their reply, which is the address the firewall
+    sees for connections to floating IPs, destination NAT happening before
+    the FORWARD chain.
+    """
+
+    def __init__(self, rule_filters):
+        """Index filters
+
+        :param rule_filters: filters normalized by normalize_filter()
+        """
+        by_key = {}
+        for rule_filter in rule_filters:
+            by_key.setdefault(tuple(rule_filter[:2]), []).append(rule_filter)
+        self._indexes = {key: _FilterIndex(key_filters, key[0])
+                         for key, key_filters in by_key.items()}
+        self.needs_addresses = any(rule_filter[4] or rule_filter[5]
+                                   for rule_filter in rule_filters)
+
+    def match(self, ip_version, protocol, first, second, src=None, dst=None,
+              reply_src=None):
+        """Whether a conntrack entry matches one of the filters
+
+        :param first: source port, or ICMP type of ICMP entries
+        :param second: destination port, or ICMP code of ICMP entries
+        :param src: original source address, as text or packed bytes,
+            which may be omitted when no filter has addresses
+        :param dst: original destination address, same
+        :param reply_src: reply source address, same, or None if unknown
+        """
+        for key in ((ip_version, protocol), (ip_version, None)):
+            index = self._indexes.get(key)
+            if index is not None and index.match(first, second, src, dst,
+                                                 reply_src):
+                return True
+        return False
+
+    def match_entry(self, entry):
+        """Whether a parsed conntrack entry matches one of the filters
+
+        :param entry: entry as parsed by the conntrack drivers, optionally
+            followed by its reply source address, ex:
+            (4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234) or
+            (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2', '3.3.3.3')
+        """
+        reply_idx = 7 if entry[1] in ICMP_PROTOCOLS else 6
+        reply_src = entry[reply_idx] if len(entry) > reply_idx else None
+        return self.match(entry[0], entry[1], entry[2], entry[3], entry[4],
+                          entry[5], reply_src)
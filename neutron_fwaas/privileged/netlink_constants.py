@@ -53,8 +53,10 @@ NFCT_T_DESTROY = 1 << NFCT_T_DESTROY_BIT
 
 ATTR_IPV4_SRC = 0
 ATTR_IPV4_DST = 1
+ATTR_REPL_IPV4_SRC = 2
 ATTR_IPV6_SRC = 4
 ATTR_IPV6_DST = 5
+ATTR_REPL_IPV6_SRC = 6
 ATTR_PORT_SRC = 8
 ATTR_PORT_DST = 9
 ATTR_ICMP_TYPE = 12
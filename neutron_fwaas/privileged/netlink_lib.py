@@ -35,13 +35,18 @@
 # THE SOFTWARE.
 #
 
+import contextlib
 import ctypes
 from ctypes import util
+import socket
+import struct
+import time
 
 from oslo_log import log as logging
 
 from neutron_lib import constants
 
+from neutron_fwaas.common import conntrack_matcher
 from neutron_fwaas import privileged
 from neutron_fwaas.privileged import netlink_constants as nl_constants
 from neutron_fwaas.privileged import utils as fwaas_utils
@@ -67,13 +72,18 @@ if nfct_lib:
     nfct.nfct_set_attr_u16.argtypes = [ctypes.c_void_p,
                                        ctypes.c_int,
                                        ctypes.c_uint16]
-    nfct.nfct_snprintf.argtypes = [ctypes.c_char_p,
-                                   ctypes.c_uint,
-                                   ctypes.c_void_p,
-                                   ctypes.c_uint,
-                                   ctypes.c_uint,
-                                   ctypes.c_uint]
+    nfct.nfct_get_attr.argtypes = [ctypes.c_void_p,
+                                   ctypes.c_int]
+    nfct.nfct_get_attr.restype = ctypes.c_void_p
+    nfct.nfct_get_attr_u8.argtypes = [ctypes.c_void_p,
+                                      ctypes.c_int]
+    nfct.nfct_get_attr_u8.restype = ctypes.c_uint8
+    nfct.nfct_get_attr_u16.argtypes = [ctypes.c_void_p,
+                                       ctypes.c_int]
+    nfct.nfct_get_attr_u16.restype = ctypes.c_uint16
     nfct.nfct_new.restype = ctypes.c_void_p
+    nfct.nfct_clone.argtypes = [ctypes.c_void_p]
+    nfct.nfct_clone.restype = ctypes.c_void_p
     nfct.nfct_destroy.argtypes = [ctypes.c_void_p]
     nfct.nfct_query.argtypes = [ctypes.c_void_p,
                                 ctypes.c_int,
@@ -82,6 +92,7 @@ if nfct_lib:
                                             ctypes.c_int,
                                             ctypes.c_void_p,
                                             ctypes.c_void_p]
+    nfct.nfct_callback_unregister.argtypes = [ctypes.c_void_p]
     nfct.nfct_open.restype = ctypes.c_void_p
     nfct.nfct_close.argtypes = [ctypes.c_void_p]
 
@@ -114,6 +125,25 @@ TARGET = {'src': {4: nl_constants.ATTR_IPV4_SRC,
                     6: nl_constants.ATTR_PORT_SRC},
           'dport': {4: nl_constants.ATTR_PORT_DST,
                     6: nl_constants.ATTR_PORT_DST}}
+REPLY_SRC = {4: nl_constants.ATTR_REPL_IPV4_SRC,
+             6: nl_constants.ATTR_REPL_IPV6_SRC}
+
+# Conntrack entries are dumped as fixed size records of their attributes,
+# packed one after the other: L4 protocol number, source and destination
+# ports, ICMP type, code and ID, source and destination addresses.
+ENTRY_STRUCTS = {
+    4: struct.Struct('!BHHBBH%ds%ds' % (nl_constants.ADDR_BUFFER_4,
+                                       nl_constants.ADDR_BUFFER_4)),
+    6: struct.Struct('!BHHBBH%ds%ds' % (nl_constants.ADDR_BUFFER_6,
+                                       nl_constants.ADDR_BUFFER_6))}
+# L4 protocols of the entries dumped, the others can't be deleted
+PROTOCOL_NAMES = {
+    constants.PROTO_NUM_ICMP: constants.PROTO_NAME_ICMP,
+    constants.PROTO_NUM_TCP: constants.PROTO_NAME_TCP,
+    constants.PROTO_NUM_UDP: constants.PROTO_NAME_UDP,
+    constants.PROTO_NUM_IPV6_ICMP: constants.PROTO_NAME_IPV6_ICMP_LEGACY}
+PORT_PROTOCOLS = (constants.PROTO_NUM_TCP, constants.PROTO_NUM_UDP)
+ICMP_PROTOCOLS = (constants.PROTO_NUM_ICMP, constants.PROTO_NUM_IPV6_ICMP)
 
 NFCT_CALLBACK = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int,
                                  ctypes.c_void_p, ctypes.c_void_p)
@@ -124,8 +154,15 @@ class ConntrackOpenFailedExit(SystemExit):
 
 
 class ConntrackManager(object):
-    def __init__(self, family_socket=None):
+    def __init__(self, family_socket=None, conntrack_handler=None):
+        """Create a manager
+
+        :param family_socket: address family of the entries to query
+        :param conntrack_handler: handler to query instead of opening one,
+            which is left open
+        """
         self.family_socket = family_socket
+        self.shared_handler = conntrack_handler
         self.set_functions = {
             'src': {4: nfct.nfct_set_attr,
                     6: nfct.nfct_set_attr},
@@ -157,16 +194,47 @@ class ConntrackManager(object):
                       'dport': libc.htons, }
 
     def list_entries(self):
-        entries = []
-        raw_entry = ctypes.create_string_buffer(nl_constants.BUFFER)
+        """Dump the entries of the family of the manager.
+
+        Only the attributes of the entries which are compared to firewall
+        rules are read, without formatting the entries into text.
+
+        :return: the entries packed as ENTRY_STRUCTS records of the family,
+            see unpack_entries()
+        """
+        ipversion = (4 if self.family_socket in (None, socket.AF_INET)
+                     else 6)
+        entry_struct = ENTRY_STRUCTS[ipversion]
+        src_attr = TARGET['src'][ipversion]
+        dst_attr = TARGET['dst'][ipversion]
+        addr_size = nl_constants.IPVERSION_BUFFER[ipversion]
+        entries = bytearray()
 
         @NFCT_CALLBACK
         def callback(type_, conntrack, data):
-            nfct.nfct_snprintf(raw_entry, nl_constants.BUFFER,
-                               conntrack, type_,
-                               nl_constants.NFCT_O_PLAIN,
-                               nl_constants.NFCT_OF_TIME)
-            entries.append(raw_entry.value.decode('utf-8'))
+            protocol = nfct.nfct_get_attr_u8(conntrack,
+                                             nl_constants.ATTR_L4PROTO)
+            if protocol not in PROTOCOL_NAMES:
+                return nl_constants.NFCT_CB_CONTINUE
+            sport = dport = icmp_type = icmp_code = icmp_id = 0
+            if protocol in PORT_PROTOCOLS:
+                sport = socket.ntohs(nfct.nfct_get_attr_u16(
+                    conntrack, nl_constants.ATTR_PORT_SRC))
+                dport = socket.ntohs(nfct.nfct_get_attr_u16(
+                    conntrack, nl_constants.ATTR_PORT_DST))
+            else:
+                icmp_type = nfct.nfct_get_attr_u8(
+                    conntrack, nl_constants.ATTR_ICMP_TYPE)
+                icmp_code = nfct.nfct_get_attr_u8(
+                    conntrack, nl_constants.ATTR_ICMP_CODE)
+                icmp_id = socket.ntohs(nfct.nfct_get_attr_u16(
+                    conntrack, nl_constants.ATTR_ICMP_ID))
+            entries.extend(entry_struct.pack(
+                protocol, sport, dport, icmp_type, icmp_code, icmp_id,
+                ctypes.string_at(nfct.nfct_get_attr(conntrack, src_attr),
+                                 addr_size),
+                ctypes.string_at(nfct.nfct_get_attr(conntrack, dst_attr),
+                                 addr_size)))
             return nl_constants.NFCT_CB_CONTINUE
 
         self._callback_register(nl_constants.NFCT_T_ALL,
@@ -175,7 +243,70 @@ class ConntrackManager(object):
         data_ref = self._get_ref(self.family_socket or
                                  nl_constants.IPVERSION_SOCKET[4])
         self._query(nl_constants.NFCT_Q_DUMP, data_ref)
-        return entries
+        return bytes(entries)
+
+    def delete_matching_entries(self, rule_filters):
+        """Delete the entries of the family of the manager matching filters.
+
+        The entries are matched while they are dumped, the matching ones
+        being cloned to be deleted once the dump is over.
+
+        :param rule_filters: filters of the family of the manager, see
+            delete_entries_by_filters()
+        :return: (number of entries dumped, matched, deleted)
+        """
+        ipversion = (4 if self.family_socket in (None, socket.AF_INET)
+                     else 6)
+        matcher = conntrack_matcher.ConntrackMatcher(rule_filters)
+        addr_attrs = (TARGET['src'][ipversion], TARGET['dst'][ipversion],
+                      REPLY_SRC[ipversion])
+        addr_size = nl_constants.IPVERSION_BUFFER[ipversion]
+        matched = []
+        dumped = 0
+
+        @NFCT_CALLBACK
+        def callback(type_, conntrack, data):
+            nonlocal dumped
+            dumped += 1
+            protocol = nfct.nfct_get_attr_u8(conntrack,
+                                             nl_constants.ATTR_L4PROTO)
+            if protocol not in PROTOCOL_NAMES:
+                return nl_constants.NFCT_CB_CONTINUE
+            if protocol in PORT_PROTOCOLS:
+                first = socket.ntohs(nfct.nfct_get_attr_u16(
+                    conntrack, nl_constants.ATTR_PORT_SRC))
+                second = socket.ntohs(nfct.nfct_get_attr_u16(
+                    conntrack, nl_constants.ATTR_PORT_DST))
+            else:
+                first = nfct.nfct_get_attr_u8(conntrack,
+                                              nl_constants.ATTR_ICMP_TYPE)
+                second = nfct.nfct_get_attr_u8(conntrack,
+                                               nl_constants.ATTR_ICMP_CODE)
+            addresses = ()
+            if matcher.needs_addresses:
+                addresses = [
+                    ctypes.string_at(nfct.nfct_get_attr(conntrack, attr),
+                                     addr_size) for attr in addr_attrs]
+            if matcher.match(ipversion, PROTOCOL_NAMES[protocol], first,
+                             second, *addresses):
+                matched.append(nfct.nfct_clone(conntrack))
+            return nl_constants.NFCT_CB_CONTINUE
+
+        self._callback_register(nl_constants.NFCT_T_ALL,
+                                callback, DATA_CALLBACK)
+        data_ref = self._get_ref(self.family_socket or
+                                 nl_constants.IPVERSION_SOCKET[4])
+        deleted = 0
+        try:
+            self._query(nl_constants.NFCT_Q_DUMP, data_ref)
+            for conntrack in matched:
+                if (self._query(nl_constants.NFCT_Q_DESTROY, conntrack) !=
+                        nl_constants.NFCT_CB_FAILURE):
+                    deleted += 1
+        finally:
+            for conntrack in matched:
+                nfct.nfct_destroy(conntrack)
+        return dumped, len(matched), deleted
 
     def delete_entries(self, entries):
         conntrack = nfct.nfct_new()
@@ -200,6 +331,7 @@ class ConntrackManager(object):
                                  query_data)
         if result == nl_constants.NFCT_CB_FAILURE:
             LOG.warning("Netlink query failed")
+        return result
 
     def _convert_text_to_binary(self, source, addr_family):
         dest = ctypes.create_string_buffer(
@@ -227,36 +359,80 @@ class ConntrackManager(object):
         return ctypes.byref(ctypes.c_int(data))
 
     def __enter__(self):
-        self.conntrack_handler = nfct.nfct_open(
-                nl_constants.CONNTRACK,
-                nl_constants.NFNL_SUBSYS_CTNETLINK)
-        if not self.conntrack_handler:
-            msg = "Failed to open new conntrack handler"
-            LOG.critical(msg)
-            raise ConntrackOpenFailedExit(msg)
+        if self.shared_handler:
+            self.conntrack_handler = self.shared_handler
+        else:
+            self.conntrack_handler = _open_conntrack_handler()
         return self
 
     def __exit__(self, *args):
-        nfct.nfct_close(self.conntrack_handler)
+        if self.shared_handler:
+            # the callback is freed with the manager
+            nfct.nfct_callback_unregister(self.conntrack_handler)
+        else:
+            nfct.nfct_close(self.conntrack_handler)
+
+
+def _open_conntrack_handler(namespace=None):
+    with fwaas_utils.in_namespace(namespace):
+        conntrack_handler = nfct.nfct_open(
+                nl_constants.CONNTRACK,
+                nl_constants.NFNL_SUBSYS_CTNETLINK)
+    if not conntrack_handler:
+        msg = "Failed to open new conntrack handler"
+        LOG.critical(msg)
+        raise ConntrackOpenFailedExit(msg)
+    return conntrack_handler
+
+
+def _close_conntrack_handler(conntrack_handler):
+    nfct.nfct_close(conntrack_handler)
+
+
+# A conntrack handler keeps querying the namespace it was opened in
+_conntrack_handlers = fwaas_utils.NamespaceCache(_open_conntrack_handler,
+                                                 _close_conntrack_handler)
 
 
-def _parse_entry(entry, ipversion):
-    """Parse entry from text to Python tuple
+@contextlib.contextmanager
+def _namespace_handler(namespace):
+    """Use the cached conntrack handler of a namespace
 
-    :param entry: conntrack entry in text
+    :param namespace: namespace to query, None for the current one
+    :return: the handler, or None, having moved in the namespace, when it
+        is not a named namespace the handler can be cached for
+    """
+    with _conntrack_handlers.get(namespace) as conntrack_handler:
+        if conntrack_handler is not None:
+            yield conntrack_handler
+            return
+    with fwaas_utils.in_namespace(namespace):
+        yield None
+
+
+def unpack_entries(packed_entries, ipversion):
+    """Unpack entries dumped by ConntrackManager.list_entries() to tuples
+
+    :param packed_entries: entries packed as ENTRY_STRUCTS records
     :param ipversion: ipversion 4 or 6
-    :return: conntrack entry in Python tuple
-    example: (4, 'tcp', '1', '2', '1.1.1.1', '2.2.2.2')
+    :return: list of conntrack entries in Python tuple
+    example: [(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')]
     The attributes are ordered to be easy to compare with other entries
     and compare with firewall rule
     """
-    protocol = entry[1]
-    parsed_entry = [ipversion, protocol]
-    for attr, position in ATTR_POSITIONS[protocol]:
-        val = entry[position].partition('=')[2]
-        parsed_entry.append(int(val) if attr in ['sport', 'dport', 'type',
-                                                 'code', 'id'] else val)
-    return tuple(parsed_entry)
+    family = nl_constants.IPVERSION_SOCKET[ipversion]
+    entries = []
+    for (protocol, sport, dport, icmp_type, icmp_code, icmp_id, src,
+         dst) in ENTRY_STRUCTS[ipversion].iter_unpack(packed_entries):
+        src = socket.inet_ntop(family, src)
+        dst = socket.inet_ntop(family, dst)
+        if protocol in ICMP_PROTOCOLS:
+            entries.append((ipversion, PROTOCOL_NAMES[protocol], icmp_type,
+                            icmp_code, src, dst, icmp_id))
+        else:
+            entries.append((ipversion, PROTOCOL_NAMES[protocol], sport,
+                            dport, src, dst))
+    return entries
 
 
 @privileged.default.entrypoint
@@ -266,32 +442,44 @@ def flush_entries(namespace=None):
     :param namespace: namespace to delete conntrack entries
     :return: None
     """
-    with fwaas_utils.in_namespace(namespace):
+    with _namespace_handler(namespace) as conntrack_handler:
         for ipversion in IP_VERSIONS:
-            with ConntrackManager(nl_constants.IPVERSION_SOCKET[ipversion]) \
-                    as conntrack:
+            with ConntrackManager(nl_constants.IPVERSION_SOCKET[ipversion],
+                                  conntrack_handler) as conntrack:
                 conntrack.flush_entries()
 
 
 @privileged.default.entrypoint
+def dump_entries(namespace=None):
+    """Dump all conntrack entries of TCP, UDP and ICMP
+
+    :param namespace: namespace to get conntrack entries
+    :return: list of (ipversion, entries packed as ENTRY_STRUCTS records)
+    """
+    packed_entries = []
+    with _namespace_handler(namespace) as conntrack_handler:
+        for ipversion in IP_VERSIONS:
+            with ConntrackManager(nl_constants.IPVERSION_SOCKET[ipversion],
+                                  conntrack_handler) as conntrack:
+                packed_entries.append((ipversion, conntrack.list_entries()))
+    return packed_entries
+
+
 def list_entries(namespace=None):
-    """List and parse all conntrack entries
+    """List and parse all conntrack entries of TCP, UDP and ICMP
+
+    The entries are dumped packed with dump_entries(), so that they cross
+    the privsep channel as a few buffers, and are unpacked to tuples here.
 
     :param namespace: namespace to get conntrack entries
-    :return: sorted list of conntrack entries in Python tuple
-    example: [(4, 'icmp', '8', '0', '1.1.1.1', '2.2.2.2', '1234'),
-              (4, 'tcp', '1', '2', '1.1.1.1', '2.2.2.2')]
+    :return: sorted tuple of conntrack entries in Python tuple
+    example: ((4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234),
+              (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'))
     """
     parsed_entries = []
-    with fwaas_utils.in_namespace(namespace):
-        for ipversion in IP_VERSIONS:
-            with ConntrackManager(nl_constants.IPVERSION_SOCKET[ipversion]) \
-                    as conntrack:
-                raw_entries = conntrack.list_entries()
-            for raw_entry in raw_entries:
-                parsed_entry = _parse_entry(raw_entry.split(), ipversion)
-                parsed_entries.append(parsed_entry)
-    return sorted(parsed_entries)
+    for ipversion, packed_entries in dump_entries(namespace):
+        parsed_entries.extend(unpack_entries(packed_entries, ipversion))
+    return tuple(sorted(parsed_entries))
 
 
 @privileged.default.entrypoint
@@ -309,6 +497,41 @@ def delete_entries(entries, namespace=None):
             entry_arg[attr[0]] = entry[idx + 2]
         entry_args.append(entry_arg)
 
-    with fwaas_utils.in_namespace(namespace):
-        with ConntrackManager() as conntrack:
+    with _namespace_handler(namespace) as conntrack_handler:
+        with ConntrackManager(conntrack_handler=conntrack_handler) \
+                as conntrack:
             conntrack.delete_entries(entry_args)
+
+
+@privileged.default.entrypoint
+def delete_entries_by_filters(rule_filters, namespace=None):
+    """Delete the conntrack entries matching filters of firewall rules
+
+    The entries are matched and deleted within the privsep daemon, without
+    sending them back and forth.
+
+    :param rule_filters: list of filters normalized by
+        conntrack_matcher.normalize_filter()
+    example: [(4, 'tcp', None, [22, 22], '10.0.0.0/24', None),
+              (6, 'icmpv6', None, None, None, None)]
+    :param namespace: namespace to delete conntrack entries
+    :return: dict of the numbers of entries 'dumped', 'matched' and
+        'deleted' and the 'duration' of the deletion in seconds
+    """
+    start = time.monotonic()
+    stats = {'dumped': 0, 'matched': 0, 'deleted': 0}
+    with _namespace_handler(namespace) as conntrack_handler:
+        for ipversion in IP_VERSIONS:
+            version_filters = [rule_filter for rule_filter in rule_filters
+                               if rule_filter[0] == ipversion]
+            if not version_filters:
+                continue
+            with ConntrackManager(nl_constants.IPVERSION_SOCKET[ipversion],
+                                  conntrack_handler) as conntrack:
+                dumped, matched, deleted = conntrack.delete_matching_entries(
+                    version_filters)
+            stats['dumped'] += dumped
+            stats['matched'] += matched
+            stats['deleted'] += deleted
+    stats['duration'] = time.monotonic() - start
+    return stats
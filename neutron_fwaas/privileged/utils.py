@@ -13,8 +13,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import contextlib
 import os
+import threading
 
 from oslo_log import log as logging
 from pyroute2 import netns as pynetns
@@ -23,14 +25,204 @@ from neutron_fwaas._i18n import _
 
 
 PROCESS_NETNS = '/proc/self/ns/net'
+# Namespaces whose file descriptors, or conntrack handles, are kept open
+MAX_CACHED_NAMESPACES = 256
+# Seconds between two checks that all the cached namespaces still exist
+NAMESPACE_CHECK_INTERVAL = 10
 
 LOG = logging.getLogger(__name__)
 
+_process_netns_fd = None
+
 
 class BackInNamespaceExit(SystemExit):
     """Raised if we fail to moved back process in its original namespace."""
 
 
+def _get_namespace_id(namespace):
+    """Device and inode of a named namespace, or None for the current one.
+
+    :raises FileNotFoundError: when there is no namespace with that name
+    """
+    if not namespace:
+        return None
+    stat = os.stat(os.path.join(pynetns.NETNS_RUN_DIR, namespace))
+    return stat.st_dev, stat.st_ino
+
+
+class _CachedResource(object):
+    __slots__ = ('namespace_id', 'resource', 'lock', 'evicted', 'closed')
+
+    def __init__(self, namespace_id, resource):
+        self.namespace_id = namespace_id
+        self.resource = resource
+        self.lock = threading.Lock()
+        self.evicted = False
+        self.closed = False
+
+
+class NamespaceCache(object):
+    """Bounded cache of resources bound to network namespaces.
+
+    Open namespace file descriptors and netlink sockets hold a reference to
+    their namespace, which keeps it alive after it is deleted. Cached
+    resources are therefore checked to still belong to the namespace of
+    that name, by its inode, whenever they are used, and, while the cache
+    is not empty, all of them every NAMESPACE_CHECK_INTERVAL seconds from a
+    timer thread, so that deleted namespaces are released even when the
+    cache is not used anymore. The least recently used resources are
+    closed beyond max_size namespaces.
+    """
+
+    def __init__(self, open_resource, close_resource,
+                 max_size=MAX_CACHED_NAMESPACES):
+        """Create a cache
+
+        :param open_resource: function opening the resource of a namespace
+        :param close_resource: function closing a resource
+        """
+        self._open_resource = open_resource
+        self._close_resource = close_resource
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # namespace -> _CachedResource, from the least recently used
+        self._cached = collections.OrderedDict()
+        # timer of the next check of the cached namespaces
+        self._timer = None
+
+    @contextlib.contextmanager
+    def get(self, namespace):
+        """Use the resource of a namespace, exclusively.
+
+        The resource is evicted when the block raises an exception.
+
+        :param namespace: name of the namespace, None for the current one
+        :return: the resource, or None when there is no namespace with that
+            name
+        """
+        while True:
+            cached = self._acquire(namespace)
+            if cached is None:
+                yield None
+                return
+            cached.lock.acquire()
+            if not cached.closed:
+                break
+            # evicted and closed while waiting for it
+            cached.lock.release()
+        try:
+            yield cached.resource
+        except BaseException:
+            with self._lock:
+                self._remove(namespace, cached)
+            raise
+        finally:
+            if cached.evicted:
+                self._close(cached)
+            cached.lock.release()
+
+    def clear(self):
+        """Close the resources of all the namespaces."""
+        with self._lock:
+            for namespace, cached in list(self._cached.items()):
+                self._evict(namespace, cached)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _acquire(self, namespace):
+        with self._lock:
+            try:
+                namespace_id = _get_namespace_id(namespace)
+            except FileNotFoundError:
+                cached = self._cached.get(namespace)
+                if cached is not None:
+                    self._evict(namespace, cached)
+                return None
+            cached = self._cached.get(namespace)
+            if cached is not None and cached.namespace_id != namespace_id:
+                # the namespace was deleted and created again
+                self._evict(namespace, cached)
+                cached = None
+            if cached is not None:
+                self._cached.move_to_end(namespace)
+                return cached
+            cached = _CachedResource(namespace_id,
+                                     self._open_resource(namespace))
+            self._cached[namespace] = cached
+            while len(self._cached) > self._max_size:
+                self._evict(*next(iter(self._cached.items())))
+            self._schedule_check()
+            return cached
+
+    def _schedule_check(self):
+        if self._timer is not None or not self._cached:
+            return
+        self._timer = threading.Timer(NAMESPACE_CHECK_INTERVAL, self._check)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _check(self):
+        with self._lock:
+            self._timer = None
+            try:
+                self._evict_missing()
+            except Exception:
+                LOG.exception('Failed to check the cached namespaces')
+            self._schedule_check()
+
+    def _evict_missing(self):
+        for namespace, cached in list(self._cached.items()):
+            try:
+                namespace_id = _get_namespace_id(namespace)
+            except FileNotFoundError:
+                namespace_id = None
+            if namespace_id != cached.namespace_id:
+                self._evict(namespace, cached)
+
+    def _remove(self, namespace, cached):
+        if self._cached.get(namespace) is cached:
+            del self._cached[namespace]
+        cached.evicted = True
+
+    def _evict(self, namespace, cached):
+        """Remove a resource, closing it unless it is in use.
+
+        Resources in use are closed once they are released.
+        """
+        self._remove(namespace, cached)
+        if cached.lock.acquire(blocking=False):
+            try:
+                self._close(cached)
+            finally:
+                cached.lock.release()
+
+    def _close(self, cached):
+        if cached.closed:
+            return
+        cached.closed = True
+        try:
+            self._close_resource(cached.resource)
+        except Exception:
+            LOG.exception('Failed to close the cached resource %s',
+                          cached.resource)
+
+
+def _open_namespace_fd(namespace):
+    return os.open(os.path.join(pynetns.NETNS_RUN_DIR, namespace),
+                   os.O_RDONLY)
+
+
+_namespace_fds = NamespaceCache(_open_namespace_fd, os.close)
+
+
+def _get_process_netns_fd():
+    global _process_netns_fd
+    if _process_netns_fd is None:
+        _process_netns_fd = os.open(PROCESS_NETNS, os.O_RDONLY)
+    return _process_netns_fd
+
+
 @contextlib.contextmanager
 def in_namespace(namespace):
     """Move current process in a specific namespace.
@@ -38,13 +230,17 @@ def in_namespace(namespace):
     This contextmanager moves current process in a specific namespace and
     ensures to move it back in original namespace or kills it if we fail to
     move back in original namespace.
+
+    The file descriptors of the original namespace and of the named
+    namespaces are kept open, see NamespaceCache.
     """
     if not namespace:
         yield
         return
 
-    org_netns_fd = os.open(PROCESS_NETNS, os.O_RDONLY)
-    pynetns.setns(namespace)
+    org_netns_fd = _get_process_netns_fd()
+    with _namespace_fds.get(namespace) as netns_fd:
+        pynetns.setns(namespace if netns_fd is None else netns_fd)
     try:
         yield
     finally:
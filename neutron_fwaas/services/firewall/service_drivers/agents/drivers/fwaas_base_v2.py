@@ -84,6 +84,20 @@ class FwaasDriverBase(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    def update_firewall_group_ports(self, agent_mode, add_apply_list,
+                                    del_apply_list, firewall):
+        """Apply the firewall to more ports and remove it from others.
+
+        Drivers which can only add or remove the ports of a firewall
+        cheaply when its policy is unchanged should override this; by
+        default the firewall is deleted from the ports of del_apply_list
+        and updated on those of add_apply_list.
+        """
+        if del_apply_list:
+            self.delete_firewall_group(agent_mode, del_apply_list, firewall)
+        if add_apply_list:
+            self.update_firewall_group(agent_mode, add_apply_list, firewall)
+
     @abc.abstractmethod
     def apply_default_policy(self, agent_mode, apply_list, firewall):
         """Apply the default policy on all trusted interfaces.
@@ -92,3 +106,43 @@ class FwaasDriverBase(object, metaclass=abc.ABCMeta):
         interfaces.
         """
         pass
+
+    def get_rule_counters(self):
+        """Get the packet and byte counters of the firewall rules.
+
+        Drivers which do not count the packets matching each rule report
+        none.
+
+        :returns: a list of dicts with the 'firewall_group_id', 'rule_id',
+            'direction', 'ip_version', 'namespace', 'ports', 'packets' and
+            'bytes' of each counted rule
+        """
+        return []
+
+    def get_reject_counters(self):
+        """Get the packets rejected and dropped over the reject rate limit.
+
+        Drivers which do not rate limit rejects report none.
+
+        :returns: a list of dicts with the 'namespace', 'ip_version',
+            'rejected' and 'dropped' packets of each namespace
+        """
+        return []
+
+    def get_compile_cache_stats(self):
+        """Get the hit ratio of the caches of compiled rules.
+
+        Drivers which do not cache the rules they compile report none.
+
+        :returns: a dict of the 'hits', 'misses', 'size', 'maxsize' and
+            'hit_ratio' of each cache, by name
+        """
+        return {}
+
+    def apply_rule_hit_order(self):
+        """Re-apply the firewall groups whose rules the hits reorder.
+
+        Called after the rule counters were read. Drivers which do not
+        order rules by the packets they match have nothing to do.
+        """
+        pass
@@ -0,0 +1,84 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class _PendingApply(object):
+    """Changes to one iptables manager waiting to be applied."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.callers = 1
+        self.error = None
+
+
+class ApplyScheduler(object):
+    """Coalesce the applies of an iptables manager over a short window.
+
+    The first caller asking for an iptables manager to be applied becomes
+    the leader of a batch: it waits for the window to elapse, then applies
+    the manager once. Callers asking for the same manager meanwhile join the
+    batch and wait for the leader, as their changes are already in the
+    in-memory tables of the manager. Every caller gets the outcome of the
+    apply, so that errors are reported for each firewall group.
+
+    The manager is applied with apply_func, defer_apply_off() by default.
+    """
+
+    def __init__(self, window, apply_func=None):
+        self.window = window
+        self.apply_func = apply_func or (
+            lambda ipt_mgr: ipt_mgr.defer_apply_off())
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def apply(self, ipt_mgr):
+        if not self.window:
+            self.apply_func(ipt_mgr)
+            return
+
+        key = id(ipt_mgr)
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = _PendingApply()
+                leader = True
+            else:
+                batch.callers += 1
+                leader = False
+
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return
+
+        time.sleep(self.window)
+        with self._lock:
+            # later callers have to wait for a new apply
+            del self._pending[key]
+        LOG.debug("Applying iptables changes of %(count)d callers in "
+                  "namespace %(ns)s",
+                  {'count': batch.callers, 'ns': ipt_mgr.namespace})
+        try:
+            self.apply_func(ipt_mgr)
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            batch.done.set()
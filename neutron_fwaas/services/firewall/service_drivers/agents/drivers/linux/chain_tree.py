@@ -0,0 +1,204 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Split an ordered firewall rule list into a decision tree of chains.
+
+Firewall rules are evaluated in order and the first matching rule wins. A
+packet of a given protocol can only match the rules of that protocol and
+the rules without protocol, so evaluating only these rules, in their
+original order, gives the same first match as evaluating the whole list.
+The same holds for the rules whose destination can contain the destination
+of the packet. The tree built here dispatches packets on their protocol
+first and, for buckets with many rules, on their destination prefix, and
+each chain of the tree holds the subsequence of the rules able to match
+the packets reaching it.
+"""
+
+import netaddr
+from neutron_lib import constants
+
+PROTOCOL_BUCKETS = (('tcp', 't'), ('udp', 'u'), ('icmp', 'c'))
+# protocol numbers of the buckets, per IP version
+BUCKET_PROTOCOL_NUMBERS = {
+    constants.IP_VERSION_4: {constants.PROTO_NUM_TCP: 'tcp',
+                             constants.PROTO_NUM_UDP: 'udp',
+                             constants.PROTO_NUM_ICMP: 'icmp'},
+    constants.IP_VERSION_6: {constants.PROTO_NUM_TCP: 'tcp',
+                             constants.PROTO_NUM_UDP: 'udp',
+                             constants.PROTO_NUM_IPV6_ICMP: 'icmp'},
+}
+OTHER_PROTOCOL = 'other'
+# destination prefix lengths tried to split a protocol bucket
+SPLIT_PREFIX_LENGTHS = {constants.IP_VERSION_4: (8, 16, 24),
+                        constants.IP_VERSION_6: (32, 48, 64)}
+# tags of the destination chains of a bucket, one character each
+SPLIT_TAGS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+class ChainNode(object):
+    """A chain of the tree.
+
+    Packets matching the match of a branch go to the chain of the branch
+    and never come back; the others are matched against rules.
+    """
+
+    def __init__(self, tag, rules):
+        self.tag = tag
+        # [((<'protocol' or 'destination'>, <value>), ChainNode), ...]
+        self.branches = []
+        self.rules = rules
+
+    def depth(self):
+        """Most rules a packet goes through in this chain and below."""
+        branch_depths = [node.depth() for _match, node in self.branches]
+        return len(self.branches) + max(branch_depths + [len(self.rules)])
+
+
+def get_protocol_bucket(rule):
+    """Return the bucket of the rule, None for rules of any protocol."""
+    protocol = rule.get('protocol')
+    if protocol is None:
+        return None
+    protocol = str(protocol).lower()
+    if protocol in (constants.PROTO_NAME_IPV6_ICMP_LEGACY,
+                    constants.PROTO_NAME_IPV6_ICMP):
+        number = constants.PROTO_NUM_IPV6_ICMP
+    elif (protocol == constants.PROTO_NAME_ICMP and
+            rule.get('ip_version') == constants.IP_VERSION_6):
+        # the driver matches ICMPv6 for the icmp protocol of IPv6 rules
+        number = constants.PROTO_NUM_IPV6_ICMP
+    else:
+        number = constants.IP_PROTOCOL_MAP.get(protocol, protocol)
+    try:
+        number = int(number)
+    except ValueError:
+        return OTHER_PROTOCOL
+    return BUCKET_PROTOCOL_NUMBERS.get(rule.get('ip_version'), {}).get(
+        number, OTHER_PROTOCOL)
+
+
+def _get_destination(rule):
+    destination = rule.get('destination_ip_address')
+    return netaddr.IPNetwork(destination).cidr if destination else None
+
+
+def build_tree(rules, ip_version, min_rules):
+    """Build the chain tree of rules of one IP version.
+
+    :param min_rules: protocol buckets with at least that many rules are
+        split by destination prefix
+    :returns: the root ChainNode, or None when the rules cannot be split
+    """
+    root = ChainNode(None, [])
+    buckets = []
+    for protocol, tag in PROTOCOL_BUCKETS:
+        if not any(get_protocol_bucket(rule) == protocol for rule in rules):
+            continue
+        bucket_rules = [rule for rule in rules
+                        if get_protocol_bucket(rule) in (protocol, None)]
+        node = ChainNode(tag, bucket_rules)
+        if len(bucket_rules) >= min_rules:
+            _split_by_destination(node, ip_version)
+        root.branches.append((('protocol', protocol), node))
+        buckets.append(protocol)
+    if not root.branches:
+        return None
+    root.rules = [rule for rule in rules
+                  if get_protocol_bucket(rule) not in buckets]
+    return root
+
+
+def _split_by_destination(node, ip_version):
+    """Split the rules of node into chains by destination prefix.
+
+    The prefix length is the one giving the smallest chain of rules a
+    packet has to go through, if any is smaller than the current chain.
+    """
+    best = None
+    best_cost = len(node.rules)
+    for prefixlen in SPLIT_PREFIX_LENGTHS.get(ip_version, ()):
+        nets = []
+        for rule in node.rules:
+            destination = _get_destination(rule)
+            if destination is None or destination.prefixlen < prefixlen:
+                continue
+            net = destination.supernet(prefixlen)[0] if (
+                destination.prefixlen > prefixlen) else destination
+            if net not in nets:
+                nets.append(net)
+        if not 1 < len(nets) <= len(SPLIT_TAGS):
+            continue
+        children = [[rule for rule in node.rules
+                     if _contains_or_within(_get_destination(rule), net)]
+                    for net in nets]
+        rest = [rule for rule in node.rules
+                if not _within_any(_get_destination(rule), nets)]
+        cost = len(nets) + max([len(child) for child in children] +
+                               [len(rest)])
+        if cost < best_cost:
+            best, best_cost = (nets, children, rest), cost
+    if best is None:
+        return
+    nets, children, rest = best
+    node.branches = [(('destination', str(net)), ChainNode(tag, child))
+                     for tag, net, child in zip(SPLIT_TAGS, nets, children)]
+    node.rules = rest
+
+
+def _contains_or_within(destination, net):
+    return (destination is None or destination in net or
+            net in destination)
+
+
+def _within_any(destination, nets):
+    return destination is not None and any(destination in net
+                                           for net in nets)
+
+
+def verify_tree(rules, root):
+    """Check that every chain of the tree keeps the order of the rules.
+
+    For every chain, the rules of the original list which may match the
+    packets reaching it are computed again, from the matches of the
+    branches leading to it, and compared with the rules of the chain. This
+    is what makes the first match of the tree equal to the first match of
+    the rule list.
+    """
+    return _verify_node(rules, root, 'protocol')
+
+
+def _verify_node(rules, node, kind):
+    expected_rest = list(rules)
+    for (match_kind, value), child in node.branches:
+        if match_kind != kind:
+            return False
+        if kind == 'protocol':
+            expected = [rule for rule in rules
+                        if get_protocol_bucket(rule) in (value, None)]
+            expected_rest = [rule for rule in expected_rest
+                             if get_protocol_bucket(rule) != value]
+            if not _verify_node(expected, child, 'destination'):
+                return False
+        else:
+            net = netaddr.IPNetwork(value)
+            expected = [rule for rule in rules
+                        if _contains_or_within(_get_destination(rule), net)]
+            expected_rest = [rule for rule in expected_rest
+                             if not _within_any(_get_destination(rule),
+                                                [net])]
+            if child.branches or not _same_rules(expected, child.rules):
+                return False
+    return _same_rules(expected_rest, node.rules)
+
+
+def _same_rules(expected, rules):
+    return [id(rule) for rule in expected] == [id(rule) for rule in rules]
@@ -0,0 +1,121 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+import weakref
+
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class FirewallGroupState(object):
+    """What the agent last applied for one firewall group."""
+
+    def __init__(self, fwid):
+        self.fwid = fwid
+        # firewall group dict the rules were last applied from
+        self.firewall = None
+        # same, with the rules as they were compiled, once optimized and
+        # reordered
+        self.applied_firewall = None
+        # (agent mode, apply list) the group was last applied with
+        self.apply_args = None
+        # namespace -> (ipt_mgr, compiled rules or None)
+        self.namespaces = {}
+        # namespace -> IDs of the router ports the group applies to there
+        self.ports = {}
+        # (IP version, direction) -> ((chains ID, fingerprint of the rule
+        # list), chains, ipsets) last compiled
+        self.compiled_chains = {}
+
+
+class FirewallGroupStateStore(object):
+    """Bounded store of FirewallGroupState keyed by firewall group ID.
+
+    A group is dropped as soon as it is not applied in any namespace anymore.
+    When more than max_groups groups are known, the least recently used ones
+    are evicted; drivers must then treat the group as if nothing had been
+    applied for it before. The store may be used from several threads, the
+    applies of a group being serialized with lock().
+    """
+
+    def __init__(self, max_groups):
+        self.max_groups = max_groups
+        self._states = collections.OrderedDict()
+        self._lock = threading.RLock()
+        # firewall group ID -> lock of its applies, while in use
+        self._group_locks = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, fwid):
+        return fwid in self._states
+
+    def __iter__(self):
+        return iter(list(self._states.values()))
+
+    def lock(self, fwid):
+        """Get the reentrant lock serializing the applies of a group.
+
+        The lock outlives the state of the group, so that it also
+        serializes the applies which drop or create the state.
+        """
+        with self._lock:
+            lock = self._group_locks.get(fwid)
+            if lock is None:
+                lock = self._group_locks[fwid] = threading.RLock()
+            return lock
+
+    def get(self, fwid):
+        with self._lock:
+            state = self._states.get(fwid)
+            if state is not None:
+                self._states.move_to_end(fwid)
+            return state
+
+    def get_or_create(self, fwid):
+        with self._lock:
+            state = self.get(fwid)
+            if state is None:
+                state = self._states[fwid] = FirewallGroupState(fwid)
+                while len(self._states) > self.max_groups:
+                    evicted_id, evicted = self._states.popitem(last=False)
+                    LOG.debug("Evicting state of firewall group %(fwid)s "
+                              "applied in %(count)d namespaces",
+                              {'fwid': evicted_id,
+                               'count': len(evicted.namespaces)})
+            return state
+
+    def add_namespace(self, fwid, ipt_mgr, compiled=None, ports=None):
+        with self._lock:
+            state = self.get_or_create(fwid)
+            state.namespaces[ipt_mgr.namespace] = (ipt_mgr, compiled)
+            state.ports[ipt_mgr.namespace] = list(ports or [])
+            return state
+
+    def remove_namespace(self, fwid, namespace):
+        """Forget a namespace of a group, and the group once it is gone."""
+        with self._lock:
+            state = self._states.get(fwid)
+            if state is None:
+                return
+            state.namespaces.pop(namespace, None)
+            state.ports.pop(namespace, None)
+            if not state.namespaces:
+                del self._states[fwid]
+
+    def pop(self, fwid):
+        with self._lock:
+            return self._states.pop(fwid, None)
@@ -13,20 +13,46 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+from concurrent import futures
+import difflib
+import functools
+import hashlib
+
+from neutron.agent.linux import ipset_manager
 from neutron.agent.linux import iptables_manager
 from neutron.common import utils
 from neutron_lib import constants
 from neutron_lib.exceptions import firewall_v2 as fw_ext
+from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 
 from neutron_fwaas.services.firewall.service_drivers.agents.drivers import\
     conntrack_base
 from neutron_fwaas.services.firewall.service_drivers.agents.drivers import\
     fwaas_base_v2
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import apply_scheduler
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import chain_tree
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import firewall_group_state
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import noflush_applier
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import rule_counters
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import rule_diff
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import rule_optimizer
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import rule_reorder
 
 LOG = logging.getLogger(__name__)
 FWAAS_DRIVER_NAME = 'Fwaas iptables driver'
 FWAAS_DEFAULT_CHAIN = 'fwaas-default-policy'
+FWAAS_ESTABLISHED_CHAIN = 'fwaas-established'
 
 # Introduce these chain for future processing like firewall logging
 ACCEPTED_CHAIN = 'accepted'
@@ -57,21 +83,206 @@ INTERNAL_DEV_PREFIX = 'qr-'
 SNAT_INT_DEV_PREFIX = 'sg-'
 ROUTER_2_FIP_DEV_PREFIX = 'rfp-'
 
+FORWARD_CHAIN = 'FORWARD'
+
+# rule fields which a run of rules may differ in and be matched with an ipset
+IPSET_FIELDS = {'source_ip_address': 'src',
+                'destination_ip_address': 'dst'}
+# shortest run of rules worth an ipset
+IPSET_MIN_RULES = 3
+IPSET_ETHERTYPE = {IPV4: constants.IPv4,
+                   IPV6: constants.IPv6}
+# characters of the digest of their members ipsets are named after
+IPSET_DIGEST_LEN = 14
+# key of the ipsets in the compiled rules of a firewall group
+IPSETS = 'ipsets'
+# keys of the policy-shared chains a group uses and of the chains its
+# interfaces jump to in the compiled rules of a firewall group
+SHARED_CHAINS = 'shared_chains'
+JUMP_TARGETS = 'jump_targets'
+# first character of the IDs policy-shared chains are named after, which
+# can not start a firewall group ID
+SHARED_CHAIN_ID_PREFIX = 'P'
+
+# rule fields which a run of rules may differ in and be matched with multiport
+MULTIPORT_FIELDS = {'source_port': 'sports',
+                    'destination_port': 'dports'}
+# ports a multiport match takes at most, a port range counts as two
+MULTIPORT_MAX_PORTS = 15
+# rule fields compared to find foldable runs of rules
+FOLD_KEY_FIELDS = ('protocol', 'source_ip_address', 'destination_ip_address',
+                   'source_port', 'destination_port', 'action')
+
+# rule fields the iptables rule compiled for a firewall rule depends on
+COMPILE_KEY_FIELDS = ('action', 'protocol', 'ip_version',
+                      'source_ip_address', 'destination_ip_address',
+                      'source_port', 'destination_port')
+
 MAX_INTF_NAME_LEN = 14
 
+# families of the interface dispatch chains, in the order FORWARD jumps to
+# them: jumps to the group chains, then to the default policy, per direction
+DISPATCH_FAMILIES = ('fwo', 'fwi', 'fdo', 'fdi')
+# characters of the port ID keying the dispatch chain of a port
+DISPATCH_KEY_LEN = 2
+# number of dispatch chains of a family above which FORWARD jumps to
+# intermediate chains keyed by the first character of the port ID instead
+DISPATCH_CHAIN_SIZE = 16
+# tag of the rules jumping to the interface dispatch chains
+DISPATCH_TAG = 'fwaas-dispatch'
+# tag of the FORWARD rule jumping to the established connections chain
+ESTABLISHED_TAG = 'fwaas-established'
+
+
+class NamespaceErrors(RuntimeError):
+    """Errors raised while programming several namespaces concurrently."""
+
+    def __init__(self, errors):
+        super(NamespaceErrors, self).__init__(
+            'Failed to program namespaces: %s' % ', '.join(
+                '%s (%s)' % (namespace, error)
+                for namespace, error in errors))
+        # [(namespace, exception), ...]
+        self.errors = errors
+
+
+def _synchronized_group(method):
+    """Serialize the applies of the firewall group passed last to method.
+
+    The RPC handlers and apply_rule_hit_order() apply groups from different
+    threads, which must not interleave for the same group.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        with self.fwg_states.lock(args[-1]['id']):
+            return method(self, *args)
+    return wrapper
+
 
 class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
     """IPTables driver for Firewall As A Service."""
 
     def __init__(self):
         LOG.debug("Initializing fwaas iptables driver")
-        self.pre_firewall = None
         self.conntrack = conntrack_base.load_and_init_conntrack_driver()
+        self.incremental = cfg.CONF.fwaas.incremental_apply
+        # last applied firewall group and, in incremental mode, the rules
+        # compiled for it in each namespace
+        self.fwg_states = firewall_group_state.FirewallGroupStateStore(
+            cfg.CONF.fwaas.max_firewall_group_states)
+        apply_func = None
+        if cfg.CONF.fwaas.noflush_apply:
+            apply_func = noflush_applier.NoflushApplier(
+                self._is_fwaas_chain).apply
+        self.apply_scheduler = apply_scheduler.ApplyScheduler(
+            cfg.CONF.fwaas.apply_coalesce_window, apply_func)
+        self.enable_ipset = cfg.CONF.fwaas.enable_ipset
+        self.enable_multiport = cfg.CONF.fwaas.enable_multiport
+        self.chain_tree_min_rules = cfg.CONF.fwaas.chain_tree_min_rules
+        self.optimize_rules = cfg.CONF.fwaas.optimize_rules
+        self.interface_dispatch = cfg.CONF.fwaas.interface_dispatch
+        self.established_fast_path = cfg.CONF.fwaas.established_fast_path
+        # bounded pool programming the namespaces of a call concurrently
+        self.namespace_workers = cfg.CONF.fwaas.namespace_workers
+        self._executor = None
+        if self.namespace_workers > 1:
+            self._executor = futures.ThreadPoolExecutor(
+                max_workers=self.namespace_workers)
+        self.reorder_rules_by_hits = cfg.CONF.fwaas.reorder_rules_by_hits
+        # firewall group ID -> direction -> rule ID -> packets matched, as
+        # accumulated from the counters read by get_rule_counters()
+        self.rule_hits = {}
+        # (firewall group ID, direction, rule ID, IP version, namespace) ->
+        # packets counted by iptables at the last read
+        self._rule_packets = {}
+        # namespace -> firewall group ID -> interfaces of the group's ports
+        # while it is admin down
+        self.admin_down_intfs = {}
+        # namespace -> IpsetManager
+        self.ipset_mgrs = {}
+        # chains of the rules of a policy are shared by the groups using it
+        # in a namespace, see _get_rule_chains_id()
+        self.share_policy_chains = (cfg.CONF.fwaas.share_policy_chains and
+                                    self.incremental)
+        # namespace -> firewall group ID -> IP version -> policy-shared
+        # chain -> rules, the groups referencing a chain keep it alive
+        self.shared_chains = {}
+        # bounded caches of the iptables rules compiled for firewall rules,
+        # of the action chains and of the addresses of the ipsets, shared
+        # by the groups and routers of the agent
+        cache_size = cfg.CONF.fwaas.compiled_rule_cache_size
+        self._compile_rule = functools.lru_cache(maxsize=cache_size)(
+            self._build_iptables_rule)
+        self._action_chain = functools.lru_cache(maxsize=cache_size)(
+            self._build_action_chain)
+        self._ip_to_cidr = functools.lru_cache(maxsize=cache_size)(
+            utils.ip_to_cidr)
+        # namespace -> firewall group ID -> IDs and ethertypes of its ipsets
+        self.ipsets = {}
+
+    def _apply_iptables(self, ipt_mgr):
+        """Apply the changes made to ipt_mgr, coalescing concurrent ones."""
+        if self.interface_dispatch:
+            self._sync_dispatch_chains(ipt_mgr)
+        if self.established_fast_path:
+            self._sync_established_chain(ipt_mgr)
+        self.apply_scheduler.apply(ipt_mgr)
 
     def _get_intf_name(self, if_prefix, port_id):
         _name = "%s%s" % (if_prefix, port_id)
         return _name[:MAX_INTF_NAME_LEN]
 
+    def _run_per_namespace(self, agent_mode, apply_list, func, unique=False):
+        """Call func(ipt_if_prefix, router_fw_ports) for every namespace.
+
+        The calls for one namespace are made one after the other, in the
+        order of apply_list. With namespace_workers above 1, the namespaces
+        are programmed concurrently by the driver's worker pool, and the
+        known library errors of all of them are reported together as a
+        NamespaceErrors once every namespace is done.
+
+        :param unique: only call func once for each namespace
+        """
+        calls = collections.OrderedDict()
+        for ri, router_fw_ports in apply_list:
+            for ipt_if_prefix in self._get_ipt_mgrs_with_if_prefix(
+                    agent_mode, ri):
+                namespace_calls = calls.setdefault(id(ipt_if_prefix['ipt']),
+                                                   [])
+                if not (unique and namespace_calls):
+                    namespace_calls.append((ipt_if_prefix, router_fw_ports))
+
+        def _run(namespace_calls):
+            for ipt_if_prefix, router_fw_ports in namespace_calls:
+                func(ipt_if_prefix, router_fw_ports)
+
+        if self._executor is None or len(calls) < 2:
+            for namespace_calls in calls.values():
+                _run(namespace_calls)
+            return
+
+        results = [(namespace_calls[0][0]['ipt'].namespace,
+                    self._executor.submit(_run, namespace_calls))
+                   for namespace_calls in calls.values()]
+        errors = []
+        for namespace, result in results:
+            error = result.exception()
+            if error is None:
+                continue
+            if not isinstance(error, (LookupError, RuntimeError)):
+                raise error
+            LOG.error("Failed to program namespace %(ns)s: %(err)s",
+                      {'ns': namespace, 'err': error})
+            errors.append((namespace, error))
+        if errors:
+            raise NamespaceErrors(errors)
+
+    def _get_intf_names(self, ipt_if_prefix, router_fw_ports):
+        return [self._get_intf_name(ipt_if_prefix['if_prefix'],
+                                    router_fw_port)
+                for router_fw_port in router_fw_ports]
+
+    @_synchronized_group
     def create_firewall_group(self, agent_mode, apply_list, firewall):
         LOG.debug('Creating firewall %(fw_id)s for tenant %(tid)s',
                   {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
@@ -80,7 +291,7 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
                 self._setup_firewall(agent_mode, apply_list, firewall)
                 self._remove_conntrack_new_firewall(agent_mode,
                                                     apply_list, firewall)
-                self.pre_firewall = dict(firewall)
+                self._set_applied_firewall(agent_mode, apply_list, firewall)
             else:
                 self.apply_default_policy(agent_mode, apply_list, firewall)
         except (LookupError, RuntimeError):
@@ -98,116 +309,1129 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         namespace and a fip so this is provided back as a list - so in that
         scenario rules can be applied on both.
         """
+        router_id = ri.router.get('id')
         if not ri.router.get('distributed'):
             return [{'ipt': ri.iptables_manager,
-                     'if_prefix': INTERNAL_DEV_PREFIX}]
+                     'if_prefix': INTERNAL_DEV_PREFIX,
+                     'router_id': router_id}]
         ipt_mgrs = []
         # TODO(sridar): refactor to get strings to a common location.
         if agent_mode == 'dvr_snat':
             if ri.snat_iptables_manager:
                 ipt_mgrs.append({'ipt': ri.snat_iptables_manager,
-                                 'if_prefix': SNAT_INT_DEV_PREFIX})
+                                 'if_prefix': SNAT_INT_DEV_PREFIX,
+                                 'router_id': router_id})
         if ri.rtr_fip_connect:
             # handle the fip case on n/w or compute node.
             ipt_mgrs.append({'ipt': ri.iptables_manager,
-                             'if_prefix': ROUTER_2_FIP_DEV_PREFIX})
+                             'if_prefix': ROUTER_2_FIP_DEV_PREFIX,
+                             'router_id': router_id})
         return ipt_mgrs
 
+    @_synchronized_group
     def delete_firewall_group(self, agent_mode, apply_list, firewall):
         LOG.debug('Deleting firewall %(fw_id)s for tenant %(tid)s',
                   {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
         fwid = firewall['id']
+        state = self.fwg_states.get(fwid)
+        if state:
+            # the group is applied to part of its ports only until the next
+            # update, which must not be replayed by apply_rule_hit_order()
+            state.apply_args = None
         try:
-            for ri, router_fw_ports in apply_list:
-                ipt_if_prefix_list = self._get_ipt_mgrs_with_if_prefix(
-                    agent_mode, ri)
-                for ipt_if_prefix in ipt_if_prefix_list:
-                    ipt_mgr = ipt_if_prefix['ipt']
-                    self._remove_chains(fwid, ipt_mgr)
-                    self._remove_default_chains(ipt_mgr)
-                    # apply the changes immediately (no defer in firewall path)
-                    ipt_mgr.defer_apply_off()
-            self.pre_firewall = None
+            if self.incremental:
+                self._setup_firewall_incremental(agent_mode, apply_list,
+                                                 firewall, remove=True)
+                return
+
+            def _delete(ipt_if_prefix, router_fw_ports):
+                ipt_mgr = ipt_if_prefix['ipt']
+                self._remove_chains(fwid, ipt_mgr)
+                self._remove_default_chains(ipt_mgr)
+                self._set_admin_down_intfs(fwid, ipt_mgr, [])
+                # apply the changes (no defer in firewall path)
+                self._apply_iptables(ipt_mgr)
+                self._remove_unused_ipsets(fwid, ipt_mgr, {})
+                self.fwg_states.remove_namespace(fwid, ipt_mgr.namespace)
+
+            self._run_per_namespace(agent_mode, apply_list, _delete)
         except (LookupError, RuntimeError):
             # catch known library exceptions and raise Fwaas generic exception
             LOG.exception("Failed to delete firewall: %s", fwid)
             raise fw_ext.FirewallInternalDriverError(driver=FWAAS_DRIVER_NAME)
 
+    @_synchronized_group
     def update_firewall_group(self, agent_mode, apply_list, firewall):
         LOG.debug('Updating firewall %(fw_id)s for tenant %(tid)s',
                   {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
         try:
+            state = self.fwg_states.get(firewall['id'])
+            pre_firewall = state.firewall if state else None
             if firewall['admin_state_up']:
                 self._setup_firewall(agent_mode, apply_list, firewall)
-                if self.pre_firewall:
+                if pre_firewall:
                     self._remove_conntrack_updated_firewall(agent_mode,
-                                    apply_list, self.pre_firewall, firewall)
+                                    apply_list, pre_firewall, firewall)
                 else:
                     self._remove_conntrack_new_firewall(agent_mode,
                                                     apply_list, firewall)
             else:
                 self.apply_default_policy(agent_mode, apply_list, firewall)
-            self.pre_firewall = dict(firewall)
+            self._set_applied_firewall(agent_mode, apply_list, firewall)
         except (LookupError, RuntimeError):
             # catch known library exceptions and raise Fwaas generic exception
             LOG.exception("Failed to update firewall: %s", firewall['id'])
             raise fw_ext.FirewallInternalDriverError(driver=FWAAS_DRIVER_NAME)
 
+    @_synchronized_group
+    def update_firewall_group_ports(self, agent_mode, add_apply_list,
+                                    del_apply_list, firewall):
+        """Apply a firewall group to more ports and remove it from others.
+
+        When neither the rules nor the admin state of the group changed
+        since it was last applied, and it keeps ports in every namespace
+        involved, only the jumps of the interfaces of the group's ports to
+        its chains are rewritten: its policy chains are left untouched,
+        whatever their number of rules. Any other change goes through
+        delete_firewall_group() and update_firewall_group().
+        """
+        fwid = firewall['id']
+        state = self.fwg_states.get(fwid)
+        changes = self._get_port_changes(agent_mode, add_apply_list,
+                                         del_apply_list, state, firewall)
+        if changes is None:
+            super(IptablesFwaasDriver, self).update_firewall_group_ports(
+                agent_mode, add_apply_list, del_apply_list, firewall)
+            return
+        LOG.debug('Updating the ports of firewall %(fw_id)s for tenant '
+                  '%(tid)s', {'fw_id': fwid, 'tid': firewall['tenant_id']})
+
+        def _update_ports(ipt_if_prefix, router_fw_ports):
+            ipt_mgr = ipt_if_prefix['ipt']
+            ports = changes[id(ipt_mgr)]
+            self._update_forward_jumps(fwid, ipt_if_prefix,
+                                       state.ports[ipt_mgr.namespace], ports)
+            self._apply_iptables(ipt_mgr)
+
+        try:
+            self._run_per_namespace(agent_mode,
+                                    del_apply_list + add_apply_list,
+                                    _update_ports, unique=True)
+            state.firewall = dict(firewall)
+            # the apply list of the group is not known anymore, see
+            # delete_firewall_group()
+            state.apply_args = None
+        except (LookupError, RuntimeError):
+            # catch known library exceptions and raise Fwaas generic exception
+            LOG.exception("Failed to update the ports of firewall: %s", fwid)
+            raise fw_ext.FirewallInternalDriverError(driver=FWAAS_DRIVER_NAME)
+
+    def _get_port_changes(self, agent_mode, add_apply_list, del_apply_list,
+                          state, firewall):
+        """Get the ports a group is left with in each namespace.
+
+        :returns: {id(<iptables manager>): [<port ID>, ...]}, or None when
+            more than the ports of the group changed, or when it is new to
+            a namespace or removed from one
+        """
+        if not (state and state.firewall and firewall['admin_state_up'] and
+                state.firewall['admin_state_up']):
+            return None
+        for rule_list in rule_diff.RULE_LISTS:
+            if (rule_diff.rule_fingerprint(state.firewall[rule_list]) !=
+                    rule_diff.rule_fingerprint(firewall[rule_list])):
+                return None
+
+        changes = {}
+        for apply_list, adding in [(del_apply_list, False),
+                                   (add_apply_list, True)]:
+            for ri, router_fw_ports in apply_list:
+                for ipt_if_prefix in self._get_ipt_mgrs_with_if_prefix(
+                        agent_mode, ri):
+                    ipt_mgr = ipt_if_prefix['ipt']
+                    last_ipt_mgr, _compiled = state.namespaces.get(
+                        ipt_mgr.namespace, (None, None))
+                    if (last_ipt_mgr is not ipt_mgr or
+                            ipt_mgr.namespace not in state.ports):
+                        return None
+                    ports = changes.setdefault(
+                        id(ipt_mgr), list(state.ports[ipt_mgr.namespace]))
+                    if adding:
+                        ports.extend(port for port in router_fw_ports
+                                     if port not in ports)
+                    else:
+                        ports[:] = [port for port in ports
+                                    if port not in router_fw_ports]
+        if not all(changes.values()):
+            return None
+        return changes
+
+    def _update_forward_jumps(self, fwid, ipt_if_prefix, old_ports, ports):
+        """Replace the jumps of the interfaces of old_ports by ports'."""
+        ipt_mgr = ipt_if_prefix['ipt']
+        if_prefix = ipt_if_prefix['if_prefix']
+        if self.incremental:
+            last_compiled = self.fwg_states.get(fwid).namespaces[
+                ipt_mgr.namespace][1]
+            targets = last_compiled.get(JUMP_TARGETS, {})
+        else:
+            targets = {}
+            for ver in [IPV4, IPV6]:
+                table = self._get_filter_table(ipt_mgr, ver)
+                targets[ver] = {}
+                for direction in [constants.INGRESS_DIRECTION,
+                                  constants.EGRESS_DIRECTION]:
+                    chain_name = self._get_chain_name(fwid, ver, direction)
+                    if iptables_manager.get_chain_name(chain_name) in (
+                            table.chains):
+                        targets[ver][direction] = chain_name
+        jumps = self._compile_jumps(
+            if_prefix, self._get_intf_names(ipt_if_prefix, ports), targets)
+        if self.incremental:
+            # the chains of the group are compared with themselves and kept
+            compiled = dict(last_compiled)
+            for ver in [IPV4, IPV6]:
+                compiled[ver] = dict(
+                    (chain_name, rules) for chain_name, rules
+                    in last_compiled.get(ver, {}).items()
+                    if chain_name != FORWARD_CHAIN and
+                    not self._is_dispatch_chain(chain_name))
+                compiled[ver].update(jumps[ver])
+            self._apply_compiled_rules(fwid, ipt_mgr, compiled, ports)
+            return
+
+        old_jumps = self._compile_jumps(
+            if_prefix, self._get_intf_names(ipt_if_prefix, old_ports),
+            targets)
+        for ver in [IPV4, IPV6]:
+            table = self._get_filter_table(ipt_mgr, ver)
+            for chain_name, rules in old_jumps[ver].items():
+                for rule in rules:
+                    table.remove_rule(chain_name, rule)
+            for chain_name, rules in jumps[ver].items():
+                if chain_name != FORWARD_CHAIN:
+                    table.add_chain(chain_name)
+                self._add_rules_to_chain(ipt_mgr, ver, chain_name, rules)
+        self.fwg_states.add_namespace(fwid, ipt_mgr, ports=ports)
+
+    @_synchronized_group
     def apply_default_policy(self, agent_mode, apply_list, firewall):
         LOG.debug('Applying firewall %(fw_id)s for tenant %(tid)s',
                   {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
         fwid = firewall['id']
         try:
-            for ri, router_fw_ports in apply_list:
-                ipt_if_prefix_list = self._get_ipt_mgrs_with_if_prefix(
-                    agent_mode, ri)
-                for ipt_if_prefix in ipt_if_prefix_list:
-                    # the following only updates local memory; no hole in FW
-                    ipt_mgr = ipt_if_prefix['ipt']
-                    self._remove_chains(fwid, ipt_mgr)
-                    self._remove_default_chains(ipt_mgr)
+            if self.incremental:
+                self._setup_firewall_incremental(agent_mode, apply_list,
+                                                 firewall, with_policy=False)
+                return
 
-                    # Create accepted/dropped/rejected chain
-                    self._add_accepted_chain_v4v6(ipt_mgr)
-                    self._add_dropped_chain_v4v6(ipt_mgr)
-                    self._add_rejected_chain_v4v6(ipt_mgr)
+            def _apply_default_policy(ipt_if_prefix, router_fw_ports):
+                # the following only updates local memory; no hole in FW
+                ipt_mgr = ipt_if_prefix['ipt']
+                self._remove_chains(fwid, ipt_mgr)
+                self._remove_default_chains(ipt_mgr)
 
-                    # create default 'DROP ALL' policy chain
-                    self._add_default_policy_chain_v4v6(ipt_mgr)
-                    self._enable_policy_chain(fwid, ipt_if_prefix,
-                                              router_fw_ports)
+                # Create accepted/dropped/rejected chain
+                self._add_accepted_chain_v4v6(ipt_mgr)
+                self._add_dropped_chain_v4v6(ipt_mgr)
+                self._add_rejected_chain_v4v6(
+                    ipt_mgr, ipt_if_prefix.get('router_id'))
 
-                    # apply the changes immediately (no defer in firewall path)
-                    ipt_mgr.defer_apply_off()
+                # create default 'DROP ALL' policy chain
+                self._add_default_policy_chain_v4v6(ipt_mgr)
+                self._enable_policy_chain(fwid, ipt_if_prefix,
+                                          router_fw_ports)
+                self._set_admin_down_intfs(
+                    fwid, ipt_mgr, self._get_intf_names(
+                        ipt_if_prefix, router_fw_ports))
+
+                # apply the changes (no defer in firewall path)
+                self._apply_iptables(ipt_mgr)
+                self._remove_unused_ipsets(fwid, ipt_mgr, {})
+                self.fwg_states.add_namespace(fwid, ipt_mgr,
+                                              ports=router_fw_ports)
+
+            self._run_per_namespace(agent_mode, apply_list,
+                                    _apply_default_policy)
         except (LookupError, RuntimeError):
             # catch known library exceptions and raise Fwaas generic exception
             LOG.exception(
                 "Failed to apply default policy on firewall: %s", fwid)
             raise fw_ext.FirewallInternalDriverError(driver=FWAAS_DRIVER_NAME)
 
+    def get_rule_counters(self):
+        """Get the packet and byte counters of the rules of every group.
+
+        The filter tables of each namespace are read once, whatever the
+        number of groups applied there, see rule_counters.read_counters(),
+        and their rules matched by text with the rules compiled from the
+        last applied version of each group. Rules folded into a single
+        iptables rule all report the counters of that rule; a rule spread
+        over several sub-chains of a chain tree reports their sum. Groups
+        which are admin down, or whose state was evicted from fwg_states,
+        are not reported. The packets counted since the last read are added
+        to the hits of the rules, see _record_rule_hits().
+
+        :returns: [{'firewall_group_id': ..., 'rule_id': ...,
+                    'direction': 'ingress', 'ip_version': 4,
+                    'namespace': ..., 'ports': [<port ID>, ...],
+                    'packets': ..., 'bytes': ...}, ...]
+        """
+        namespaces = {}
+        for state in self.fwg_states:
+            if not (state.firewall and state.firewall['admin_state_up'] and
+                    state.applied_firewall):
+                continue
+            for namespace, (ipt_mgr, _compiled) in list(
+                    state.namespaces.items()):
+                namespaces.setdefault(namespace, (ipt_mgr, []))[1].append(
+                    state)
+
+        counters = []
+        for namespace, (ipt_mgr, states) in sorted(namespaces.items()):
+            saved = self._read_counters(namespace, ipt_mgr)
+            if saved is None:
+                continue
+            for state in states:
+                counters += self._match_rule_counters(
+                    state.applied_firewall, namespace,
+                    state.ports.get(namespace, []), saved)
+        self._record_rule_hits(counters)
+        return counters
+
+    def _read_counters(self, namespace, ipt_mgr):
+        try:
+            saved = {IPV4: rule_counters.read_counters(namespace)}
+            if ipt_mgr.use_ipv6:
+                saved[IPV6] = rule_counters.read_counters(namespace,
+                                                          'ip6tables')
+        except RuntimeError:
+            LOG.warning("Failed to read the rule counters of namespace %s",
+                        namespace, exc_info=True)
+            return None
+        return saved
+
+    def get_reject_counters(self):
+        """Get the packets rejected and dropped over the reject rate limit.
+
+        The rejected chain of each namespace the groups are applied to is
+        read, see _rejected_chain_rules(): the packets of its first rule were
+        rejected and those of its DROP rule, only there with a reject rate
+        limit, were dropped instead.
+
+        :returns: [{'namespace': ..., 'ip_version': 4,
+                    'rejected': <packets>, 'dropped': <packets>}, ...]
+        """
+        namespaces = {}
+        for state in self.fwg_states:
+            for namespace, (ipt_mgr, _compiled) in list(
+                    state.namespaces.items()):
+                namespaces.setdefault(namespace, ipt_mgr)
+
+        chain = self._get_action_chain(REJECTED_CHAIN)
+        counters = []
+        for namespace, ipt_mgr in sorted(namespaces.items()):
+            saved = self._read_counters(namespace, ipt_mgr)
+            if saved is None:
+                continue
+            for ver in [IPV4, IPV6]:
+                rules = saved.get(ver, {}).get(chain)
+                if not rules:
+                    continue
+                counters.append({
+                    'namespace': namespace,
+                    'ip_version': (constants.IP_VERSION_4 if ver == IPV4
+                                   else constants.IP_VERSION_6),
+                    'rejected': rules[0][1],
+                    'dropped': sum(packets for rule, packets, _bytes
+                                   in rules[1:] if rule == '-j DROP')})
+        return counters
+
+    def _match_rule_counters(self, firewall, namespace, ports, saved):
+        fwid = firewall['id']
+        bname = iptables_manager.binary_name
+        totals = collections.OrderedDict()
+        for direction, rule_list in [
+                (constants.INGRESS_DIRECTION, firewall['ingress_rule_list']),
+                (constants.EGRESS_DIRECTION, firewall['egress_rule_list'])]:
+            for ver in [IPV4, IPV6]:
+                if ver not in saved or not self._has_chains(firewall, ver):
+                    continue
+                sources = {}
+                chains, _ipsets = self._compile_chains(
+                    self._get_rule_chains_id(firewall, direction), ver,
+                    direction, rule_list, sources)
+                for chain_name, rules in chains.items():
+                    chain = '%s-%s' % (
+                        bname, iptables_manager.get_chain_name(chain_name))
+                    # only the first of identical rules can match
+                    saved_rules = {}
+                    for rule, packets, bytes_ in saved[ver].get(chain, []):
+                        saved_rules.setdefault(rule, (packets, bytes_))
+                    for rule, rule_ids in zip(rules, sources[chain_name]):
+                        packets, bytes_ = saved_rules.pop(rule, (0, 0))
+                        for rule_id in rule_ids:
+                            total = totals.setdefault(
+                                (rule_id, direction, ver), [0, 0])
+                            total[0] += packets
+                            total[1] += bytes_
+
+        return [{'firewall_group_id': fwid,
+                 'rule_id': rule_id,
+                 'direction': direction,
+                 'ip_version': (constants.IP_VERSION_4 if ver == IPV4
+                                else constants.IP_VERSION_6),
+                 'namespace': namespace,
+                 'ports': list(ports),
+                 'packets': packets,
+                 'bytes': bytes_}
+                for (rule_id, direction, ver), (packets, bytes_)
+                in totals.items()]
+
+    def _set_applied_firewall(self, agent_mode, apply_list, firewall):
+        state = self.fwg_states.get_or_create(firewall['id'])
+        state.firewall = dict(firewall)
+        if self.reorder_rules_by_hits:
+            state.apply_args = (agent_mode, list(apply_list))
+
+    def apply_rule_hit_order(self):
+        """Re-apply the groups whose rules the hits now order differently.
+
+        With reorder_rules_by_hits, the rules of each group are ordered by
+        the packets they matched so far, see _reorder_firewall(), when the
+        group is applied. As the hits grow, groups whose rules would be
+        ordered differently are applied again, with the same apply list and
+        through update_firewall_group(). Groups applied to part of their
+        ports only, or admin down, are left alone until their next update.
+        The group is only applied again when no RPC applied it meanwhile,
+        under the lock serializing its applies.
+        """
+        if not self.reorder_rules_by_hits:
+            return
+        for state in self.fwg_states:
+            firewall = state.firewall
+            if not (firewall and firewall['admin_state_up'] and
+                    state.apply_args and state.applied_firewall):
+                continue
+            ordered = self._reorder_firewall(self._optimize_firewall(
+                firewall))
+            if all([rule['id'] for rule in ordered[rule_list]] ==
+                   [rule['id'] for rule in state.applied_firewall[rule_list]]
+                   for rule_list in rule_diff.RULE_LISTS):
+                continue
+            with self.fwg_states.lock(state.fwid):
+                if (state.firewall is not firewall or not state.apply_args or
+                        state.fwid not in self.fwg_states):
+                    LOG.debug("Firewall group %s was applied again, not "
+                              "reordering its rules", state.fwid)
+                    continue
+                LOG.info("Reordering the rules of firewall group %s by "
+                         "their hits", firewall['id'])
+                agent_mode, apply_list = state.apply_args
+                try:
+                    self.update_firewall_group(agent_mode, apply_list,
+                                               firewall)
+                except fw_ext.FirewallInternalDriverError:
+                    # already logged, the next check tries again
+                    pass
+
+    def _reorder_firewall(self, firewall):
+        """Order the rules of the group by their hits, see rule_reorder.
+
+        :returns: a copy of the group with the reordered rules
+        """
+        hits = self.rule_hits.get(firewall['id'])
+        if not (self.reorder_rules_by_hits and hits):
+            return firewall
+        reordered = dict(firewall)
+        for direction, rule_list in [
+                (constants.INGRESS_DIRECTION, 'ingress_rule_list'),
+                (constants.EGRESS_DIRECTION, 'egress_rule_list')]:
+            reordered[rule_list] = rule_reorder.reorder_rules(
+                firewall[rule_list], hits.get(direction, {}))
+        return reordered
+
+    def _record_rule_hits(self, counters):
+        """Add the packets counted since the last read to rule_hits.
+
+        iptables counts from zero again when a rule is added back, e.g. once
+        moved, so a count lower than the last one is all new packets.
+        """
+        for counter in counters:
+            fwid = counter['firewall_group_id']
+            key = (fwid, counter['direction'], counter['rule_id'],
+                   counter['ip_version'], counter['namespace'])
+            packets = counter['packets']
+            last_packets = self._rule_packets.get(key, 0)
+            if packets >= last_packets:
+                packets -= last_packets
+            self._rule_packets[key] = counter['packets']
+            rule_hits = self.rule_hits.setdefault(fwid, {}).setdefault(
+                counter['direction'], {})
+            rule_hits[counter['rule_id']] = (
+                rule_hits.get(counter['rule_id'], 0) + packets)
+        for fwid in list(self.rule_hits):
+            if fwid not in self.fwg_states:
+                del self.rule_hits[fwid]
+        for key in list(self._rule_packets):
+            if key[0] not in self.rule_hits:
+                del self._rule_packets[key]
+
     def _setup_firewall(self, agent_mode, apply_list, firewall):
+        """Apply the rules of a group and record them once applied.
+
+        When the group fails to be applied to any namespace, what is known
+        of it is dropped, so that its next apply starts from scratch.
+        """
+        firewall = self._reorder_firewall(self._optimize_firewall(firewall))
+        try:
+            self._setup_firewall_rules(agent_mode, apply_list, firewall)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self.fwg_states.pop(firewall['id'])
+        self.fwg_states.get_or_create(
+            firewall['id']).applied_firewall = firewall
+
+    def _setup_firewall_rules(self, agent_mode, apply_list, firewall):
+        if self.incremental:
+            self._setup_firewall_incremental(agent_mode, apply_list, firewall)
+            return
         fwid = firewall['id']
-        for ri, router_fw_ports in apply_list:
-            ipt_if_prefix_list = self._get_ipt_mgrs_with_if_prefix(
-                agent_mode, ri)
-            for ipt_if_prefix in ipt_if_prefix_list:
-                ipt_mgr = ipt_if_prefix['ipt']
-                # the following only updates local memory; no hole in FW
-                self._remove_chains(fwid, ipt_mgr)
-                self._remove_default_chains(ipt_mgr)
 
-                # Create accepted/dropped/rejected chain
+        def _setup(ipt_if_prefix, router_fw_ports):
+            ipt_mgr = ipt_if_prefix['ipt']
+            # the following only updates local memory; no hole in FW
+            self._remove_chains(fwid, ipt_mgr)
+            self._remove_default_chains(ipt_mgr)
+
+            # Create accepted/dropped/rejected chain
+            self._add_accepted_chain_v4v6(ipt_mgr)
+            self._add_dropped_chain_v4v6(ipt_mgr)
+            self._add_rejected_chain_v4v6(
+                ipt_mgr, ipt_if_prefix.get('router_id'))
+
+            # create default 'DROP ALL' policy chain
+            self._add_default_policy_chain_v4v6(ipt_mgr)
+            # create chain based on configured policy
+            ipsets = self._setup_chains(firewall, ipt_if_prefix,
+                                        router_fw_ports)
+            self._set_admin_down_intfs(fwid, ipt_mgr, [])
+
+            # the sets have to exist before the rules using them
+            self._set_ipsets(ipt_mgr, ipsets)
+            # apply the changes (no defer in firewall path)
+            self._apply_iptables(ipt_mgr)
+            self._remove_unused_ipsets(fwid, ipt_mgr, ipsets)
+            self.fwg_states.add_namespace(fwid, ipt_mgr,
+                                          ports=router_fw_ports)
+
+        self._run_per_namespace(agent_mode, apply_list, _setup)
+
+    def _optimize_firewall(self, firewall):
+        """Drop the rules of the group which can never match.
+
+        The rules of each list covered by an earlier rule of the list are
+        removed, see rule_optimizer, and reported. The group itself is left
+        untouched, as the conntrack cleanup of the next update compares its
+        full rule lists.
+
+        :returns: a copy of the group with the remaining rules
+        """
+        if not self.optimize_rules:
+            return firewall
+        optimized = dict(firewall)
+        for rule_list in rule_diff.RULE_LISTS:
+            rules, removed = rule_optimizer.remove_shadowed_rules(
+                firewall[rule_list])
+            optimized[rule_list] = rules
+            if removed:
+                LOG.info("Removed %(count)d rules of %(list)s of firewall "
+                         "group %(fwid)s which can never match: %(rules)s",
+                         {'count': len(removed), 'list': rule_list,
+                          'fwid': firewall['id'],
+                          'rules': ', '.join(
+                              '%s (covered by %s)' % (rule.get('id'),
+                                                      earlier.get('id'))
+                              for rule, earlier in removed)})
+        return optimized
+
+    def _has_chains(self, firewall, ver):
+        """Whether the group needs its chains of an IP version.
+
+        Without optimize_rules, the chains are always created. Otherwise,
+        they are skipped when no enabled rule of either direction has the IP
+        version: no connection of that version can then go through the
+        ports of the group, and their packets reach the default policy.
+        """
+        if not self.optimize_rules:
+            return True
+        ip_version = (constants.IP_VERSION_4 if ver == IPV4
+                      else constants.IP_VERSION_6)
+        return any(rule['enabled'] and rule['ip_version'] == ip_version
+                   for rule_list in rule_diff.RULE_LISTS
+                   for rule in firewall[rule_list])
+
+    def _setup_firewall_incremental(self, agent_mode, apply_list, firewall,
+                                    with_policy=True, remove=False):
+        """Program only what changed since the group was last applied.
+
+        The rules of the firewall group are compiled for every namespace and
+        compared with the rules compiled for it the last time, so that only
+        the chains and rules which differ are handed to the iptables manager.
+        With remove set, everything the group owns in the namespaces is
+        removed; without with_policy, only the jumps to the default 'DROP
+        ALL' policy are kept.
+        """
+        fwid = firewall['id']
+        # the chains of a direction are compiled once for every namespace,
+        # and only when its rules changed
+        fingerprints = dict(
+            (direction, rule_diff.rule_fingerprint(
+                firewall['%s_rule_list' % direction]))
+            for direction in [constants.INGRESS_DIRECTION,
+                              constants.EGRESS_DIRECTION])
+
+        def _setup(ipt_if_prefix, router_fw_ports):
+            ipt_mgr = ipt_if_prefix['ipt']
+            if remove:
+                compiled = {}
+            else:
+                # these chains are shared by the groups of the router
                 self._add_accepted_chain_v4v6(ipt_mgr)
                 self._add_dropped_chain_v4v6(ipt_mgr)
-                self._add_rejected_chain_v4v6(ipt_mgr)
+                self._add_rejected_chain_v4v6(
+                    ipt_mgr, ipt_if_prefix.get('router_id'))
+                self._ensure_default_policy_chain_v4v6(ipt_mgr)
+                compiled = self._compile_firewall(
+                    firewall, ipt_if_prefix, router_fw_ports,
+                    with_policy=with_policy, fingerprints=fingerprints)
+            ipsets = compiled.get(IPSETS, {})
+            shared_chains = compiled.get(SHARED_CHAINS, {})
+            self._add_shared_chains(ipt_mgr, shared_chains)
+            self._apply_compiled_rules(fwid, ipt_mgr, compiled,
+                                       router_fw_ports)
+            self._release_shared_chains(fwid, ipt_mgr, shared_chains)
+            if remove and not self._default_policy_chain_in_use(ipt_mgr):
+                self._remove_default_chains(ipt_mgr)
+            admin_down = not (with_policy or remove)
+            self._set_admin_down_intfs(
+                fwid, ipt_mgr, self._get_intf_names(
+                    ipt_if_prefix, router_fw_ports) if admin_down else [])
+
+            # the sets have to exist before the rules using them
+            self._set_ipsets(ipt_mgr, ipsets)
+            # apply the changes (no defer in firewall path)
+            self._apply_iptables(ipt_mgr)
+            self._remove_unused_ipsets(fwid, ipt_mgr, ipsets)
+
+        self._run_per_namespace(agent_mode, apply_list, _setup)
+
+    def _compile_firewall(self, firewall, ipt_if_prefix, router_fw_ports,
+                          with_policy=True, fingerprints=None):
+        """Compile the iptables rules a firewall group owns in a namespace.
+
+        With share_policy_chains, the chains of a policy go to
+        'shared_chains' rather than to the chains of the group, see
+        _get_rule_chains_id().
+
+        :param fingerprints: {<direction>: <fingerprint>} of the rule lists
+            of the group, to reuse the chains last compiled from the same
+            rules, see _get_compiled_chains()
+
+        :returns: the rules of the group's chains and its FORWARD jumps,
+            in order, the ipsets the rules use, the policy-shared chains and
+            the chains the interfaces jump to, for example:
+            {'ipv4': {'iv4<fwid>': [...], 'ov4<fwid>': [...],
+                      'FORWARD': [...]},
+             'ipv6': {...},
+             'ipsets': {(<set id>, 'IPv4'): [<address>, ...]},
+             'shared_chains': {'ipv4': {}, 'ipv6': {}},
+             'jump_targets': {'ipv4': {'ingress': 'iv4<fwid>',
+                                       'egress': 'ov4<fwid>'},
+                              'ipv6': {...}}}
+        """
+        fwid = firewall['id']
+        if_prefix = ipt_if_prefix['if_prefix']
+        intf_names = self._get_intf_names(ipt_if_prefix, router_fw_ports)
+        compiled = {IPV4: {}, IPV6: {}, IPSETS: {},
+                    SHARED_CHAINS: {IPV4: {}, IPV6: {}},
+                    JUMP_TARGETS: {IPV4: {}, IPV6: {}}}
+
+        if with_policy:
+            # default rules for invalid packets and established sessions
+            preamble = self._preamble_rules()
+            for direction, rule_list in [
+                    (constants.INGRESS_DIRECTION,
+                     firewall['ingress_rule_list']),
+                    (constants.EGRESS_DIRECTION,
+                     firewall['egress_rule_list'])]:
+                rules_id = self._get_rule_chains_id(firewall, direction)
+                for ver in [IPV4, IPV6]:
+                    if not self._has_chains(firewall, ver):
+                        continue
+                    chains_id = rules_id
+                    chain_name = self._get_chain_name(chains_id, ver,
+                                                      direction)
+                    chains, ipsets = self._get_compiled_chains(
+                        fwid, chains_id, ver, direction, rule_list,
+                        fingerprints)
+                    chains[chain_name] = preamble + chains[chain_name]
+                    if chains_id != fwid and self._shared_chains_conflict(
+                            ipt_if_prefix['ipt'].namespace, fwid, ver,
+                            chains):
+                        LOG.warning("Chains %(chains)s of firewall group "
+                                    "%(fwid)s are named like other shared "
+                                    "chains, not sharing them",
+                                    {'chains': sorted(chains),
+                                     'fwid': fwid})
+                        chains_id = fwid
+                        chain_name = self._get_chain_name(chains_id, ver,
+                                                          direction)
+                        chains, ipsets = self._get_compiled_chains(
+                            fwid, chains_id, ver, direction, rule_list,
+                            fingerprints)
+                        chains[chain_name] = preamble + chains[chain_name]
+                    if chains_id == fwid:
+                        compiled[ver].update(chains)
+                    else:
+                        compiled[SHARED_CHAINS][ver].update(chains)
+                    compiled[IPSETS].update(ipsets)
+                    compiled[JUMP_TARGETS][ver][direction] = chain_name
+
+        jumps = self._compile_jumps(if_prefix, intf_names,
+                                    compiled[JUMP_TARGETS])
+        for ver in [IPV4, IPV6]:
+            compiled[ver].update(jumps[ver])
+        return compiled
+
+    def _get_compiled_chains(self, fwid, chains_id, ver, direction,
+                             rule_list, fingerprints=None):
+        """Compile the chains of a direction, or reuse the last compiled.
+
+        The chains only depend on the rule list, so they are compiled again
+        only when the fingerprint of the rule list differs from the one
+        they were last compiled from for the group: not for the other
+        namespaces of the group, nor when only its ports or its other
+        direction changed. Any change of the rules of the direction still
+        compiles all of them.
+        """
+        if fingerprints is None:
+            return self._compile_chains(chains_id, ver, direction, rule_list)
+        key = (chains_id, fingerprints[direction])
+        state = self.fwg_states.get_or_create(fwid)
+        cached = state.compiled_chains.get((ver, direction))
+        if cached is None or cached[0] != key:
+            chains, ipsets = self._compile_chains(chains_id, ver, direction,
+                                                  rule_list)
+            cached = (key, chains, ipsets)
+            state.compiled_chains[(ver, direction)] = cached
+        # callers add the preamble to the chains
+        return dict(cached[1]), dict(cached[2])
+
+    def _get_rule_chains_id(self, firewall, direction):
+        """Get the ID the rule chains of a group for a direction are named by.
+
+        That is the group ID, unless share_policy_chains is set and the
+        group has a policy for the direction: the chains are then named
+        after a digest of the policy ID and of the rules the group was
+        applied with, so that the groups using the same version of a
+        policy in a namespace jump to the same chains.
+        """
+        policy_id = firewall.get('%s_firewall_policy_id' % direction)
+        if not (self.share_policy_chains and policy_id):
+            return firewall['id']
+        digest = hashlib.sha1(repr(
+            (policy_id, rule_diff.rule_fingerprint(
+                firewall['%s_rule_list' % direction]))).encode()).hexdigest()
+        return SHARED_CHAIN_ID_PREFIX + digest[:15]
+
+    def _shared_chains_conflict(self, namespace, fwid, ver, chains):
+        """Whether other groups have chains of these names and other rules.
+
+        Shared chain names only keep a few characters of their digest.
+        """
+        for group_id, group_chains in self.shared_chains.get(
+                namespace, {}).items():
+            if group_id == fwid:
+                continue
+            for chain_name, rules in chains.items():
+                if group_chains.get(ver, {}).get(chain_name, rules) != rules:
+                    return True
+        return False
 
-                # create default 'DROP ALL' policy chain
-                self._add_default_policy_chain_v4v6(ipt_mgr)
-                # create chain based on configured policy
-                self._setup_chains(firewall, ipt_if_prefix, router_fw_ports)
+    def _add_shared_chains(self, ipt_mgr, shared_chains):
+        """Add the policy-shared chains a group uses which are missing.
+
+        Chains of the same name have the same rules, so existing ones are
+        left as they are.
+        """
+        for ver in [IPV4, IPV6]:
+            table = self._get_filter_table(ipt_mgr, ver)
+            for chain_name, rules in shared_chains.get(ver, {}).items():
+                if iptables_manager.get_chain_name(chain_name) in (
+                        table.chains):
+                    continue
+                table.add_chain(chain_name)
+                for rule in rules:
+                    table.add_rule(chain_name, rule)
+
+    def _release_shared_chains(self, fwid, ipt_mgr, shared_chains):
+        """Record the shared chains of a group, remove the unused ones.
+
+        This must run once the jumps of the group to the chains it does not
+        use anymore have been removed.
+        """
+        namespace = ipt_mgr.namespace
+        groups = self.shared_chains.get(namespace, {})
+        released = groups.pop(fwid, {})
+        if any(shared_chains.values()):
+            self.shared_chains.setdefault(namespace, {})[fwid] = dict(
+                (ver, dict(chains)) for ver, chains in shared_chains.items())
+        elif namespace in self.shared_chains and not groups:
+            del self.shared_chains[namespace]
+        for ver, chains in released.items():
+            table = self._get_filter_table(ipt_mgr, ver)
+            for chain_name in chains:
+                if chain_name in shared_chains.get(ver, {}) or any(
+                        chain_name in group_chains.get(ver, {})
+                        for group_chains in groups.values()):
+                    continue
+                table.remove_chain(chain_name)
+
+    def _compile_jumps(self, if_prefix, intf_names, targets):
+        """Compile the jumps of the interfaces of a group to its chains.
+
+        :param targets: {'ipv4': {<direction>: <chain>}, 'ipv6': ...}, the
+            chains the interfaces jump to for each direction the group has
+            chains for
+        :returns: {'ipv4': {<chain>: [<jump rule>, ...]}, 'ipv6': ...}, see
+            _route_forward_jumps()
+        """
+        bname = iptables_manager.binary_name
+        default_chain = iptables_manager.get_chain_name(FWAAS_DEFAULT_CHAIN)
+        jumps = {}
+        for ver in [IPV4, IPV6]:
+            jump_rules = []
+            for direction in [constants.INGRESS_DIRECTION,
+                              constants.EGRESS_DIRECTION]:
+                if direction not in targets.get(ver, {}):
+                    continue
+                chain_name = iptables_manager.get_chain_name(
+                    targets[ver][direction])
+                jump_rules += ['%s %s -j %s-%s' % (
+                    IPTABLES_DIR[direction], intf_name, bname, chain_name)
+                    for intf_name in intf_names]
+            # jump to DROP_ALL policy
+            for iptables_dir in ['-o', '-i']:
+                jump_rules += ['%s %s -j %s-%s' % (
+                    iptables_dir, intf_name, bname, default_chain)
+                    for intf_name in intf_names]
+            jumps[ver] = self._route_forward_jumps(if_prefix, jump_rules)
+        return jumps
+
+    def _apply_compiled_rules(self, fwid, ipt_mgr, compiled, ports=None):
+        """Hand the delta between two compilations to the iptables manager.
+
+        Chains the group no longer needs are removed, new ones are added and
+        the rules of the remaining chains are edited in place. Every rule is
+        tagged with the firewall group ID, so that the group can be rebuilt
+        from scratch when what was last compiled for it is not known.
+        """
+        state = self.fwg_states.get(fwid)
+        last_ipt_mgr, last_compiled = (None, None)
+        if state:
+            last_ipt_mgr, last_compiled = state.namespaces.get(
+                ipt_mgr.namespace, (None, None))
+        if last_ipt_mgr is not ipt_mgr or last_compiled is None:
+            # Nothing is known about what the group has in the namespace,
+            # e.g. its state was evicted from the store: drop all of it.
+            self._remove_chains(fwid, ipt_mgr)
+            for table in [ipt_mgr.ipv4['filter'], ipt_mgr.ipv6['filter']]:
+                table.clear_rules_by_tag(fwid)
+            last_compiled = {}
+        bname = iptables_manager.binary_name
+
+        for ver in [IPV4, IPV6]:
+            table = self._get_filter_table(ipt_mgr, ver)
+            old_chains = dict(last_compiled.get(ver, {}))
+            new_chains = compiled.get(ver, {})
+
+            # FORWARD and the interface dispatch chains are shared with the
+            # other groups, only the rules of the group are edited there
+            shared_chains = [FORWARD_CHAIN] + [
+                name for name in list(old_chains) + list(new_chains)
+                if self._is_dispatch_chain(name)]
+            for chain_name in list(old_chains):
+                if chain_name in shared_chains or chain_name in new_chains:
+                    continue
+                # removing the chain also removes the jumps to it
+                table.remove_chain(chain_name)
+                del old_chains[chain_name]
+                jump = '-j %s-%s' % (
+                    bname, iptables_manager.get_chain_name(chain_name))
+                for shared_chain in shared_chains:
+                    if shared_chain in old_chains:
+                        old_chains[shared_chain] = [
+                            rule for rule in old_chains[shared_chain]
+                            if jump not in rule]
+
+            chain_names = [name for name in new_chains
+                           if name not in shared_chains]
+            for chain_name in chain_names:
+                if chain_name not in old_chains:
+                    table.add_chain(chain_name)
+            for chain_name in shared_chains:
+                if chain_name != FORWARD_CHAIN:
+                    table.add_chain(chain_name)
+            for chain_name in chain_names + sorted(set(shared_chains)):
+                self._update_chain_rules(table, fwid, chain_name,
+                                         old_chains.get(chain_name, []),
+                                         new_chains.get(chain_name, []))
+
+        if compiled:
+            self.fwg_states.add_namespace(fwid, ipt_mgr, compiled, ports)
+        else:
+            self.fwg_states.remove_namespace(fwid, ipt_mgr.namespace)
 
-                # apply the changes immediately (no defer in firewall path)
-                ipt_mgr.defer_apply_off()
+    def _update_chain_rules(self, table, fwid, chain_name, old_rules,
+                            new_rules):
+        """Turn the rules the group owns in a chain into new_rules.
+
+        IptablesTable.add_rule() can only append to a chain, so rules are
+        inserted and deleted directly in the ordered rule list of the table.
+        Only the rules of the chain tagged with the group ID are touched;
+        other rules of shared chains like FORWARD keep their place.
+        """
+        if old_rules == new_rules:
+            return
+        chain = iptables_manager.get_chain_name(chain_name)
+        positions = [idx for idx, rule in enumerate(table.rules)
+                     if rule.chain == chain and rule.tag == fwid]
+        current_rules = [table.rules[idx].rule for idx in positions]
+        if current_rules != old_rules:
+            LOG.debug("Rules of chain %s differ from the last compiled "
+                      "ones, rebuilding it", chain_name)
+            old_rules = current_rules
+
+        def _new_rules(rules):
+            return [iptables_manager.IptablesRule(
+                chain_name, rule, binary_name=table.wrap_name, tag=fwid)
+                for rule in rules]
+
+        inserts = {}
+        removed = set()
+        append_at = positions[-1] + 1 if positions else len(table.rules)
+        matcher = difflib.SequenceMatcher(None, old_rules, new_rules,
+                                          autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            removed.update(positions[i1:i2])
+            if j1 < j2:
+                at = positions[i1] if i1 < len(positions) else append_at
+                inserts.setdefault(at, []).extend(
+                    _new_rules(new_rules[j1:j2]))
+
+        rules = []
+        for idx, rule in enumerate(table.rules):
+            rules.extend(inserts.get(idx, []))
+            if idx not in removed:
+                rules.append(rule)
+        rules.extend(inserts.get(len(table.rules), []))
+        table.rules = rules
+
+    def _default_policy_chain_in_use(self, ipt_mgr):
+        default_chain = iptables_manager.get_chain_name(FWAAS_DEFAULT_CHAIN)
+        jump = '-j %s-%s' % (iptables_manager.binary_name, default_chain)
+        return any((rule.chain == FORWARD_CHAIN or
+                    self._is_dispatch_chain(rule.chain)) and jump in rule.rule
+                   for table in [ipt_mgr.ipv4['filter'],
+                                 ipt_mgr.ipv6['filter']]
+                   for rule in table.rules)
+
+    def _set_admin_down_intfs(self, fwid, ipt_mgr, intf_names):
+        """Record the interfaces of a group while it is admin down."""
+        namespace = ipt_mgr.namespace
+        groups = self.admin_down_intfs.setdefault(namespace, {})
+        if intf_names:
+            groups[fwid] = list(intf_names)
+        else:
+            groups.pop(fwid, None)
+            if not groups:
+                del self.admin_down_intfs[namespace]
+
+    def _sync_established_chain(self, ipt_mgr):
+        """Accept the packets of established sessions ahead of the groups.
+
+        While the namespace has firewall groups, FORWARD sends the packets
+        of established and related sessions to a chain accepting them,
+        before any jump to the chains of the groups or to the interface
+        dispatch chains, so that most packets only go through that rule.
+        The packets of the interfaces of admin down groups return from it,
+        as their default policy drops every packet. Invalid packets are not
+        matched and are still dropped by the chains of the groups.
+        """
+        bname = iptables_manager.binary_name
+        chain_name = iptables_manager.get_chain_name(FWAAS_ESTABLISHED_CHAIN)
+        if not self._default_policy_chain_in_use(ipt_mgr):
+            self._remove_chain_by_name_v4v6(FWAAS_ESTABLISHED_CHAIN, ipt_mgr)
+            return
+        intf_names = sorted(set(
+            intf_name for intf_names in self.admin_down_intfs.get(
+                ipt_mgr.namespace, {}).values()
+            for intf_name in intf_names))
+        chain_rules = ['%s %s -j RETURN' % (iptables_dir, intf_name)
+                       for intf_name in intf_names
+                       for iptables_dir in ['-i', '-o']] + ['-j ACCEPT']
+        jump_rule = '-m state --state RELATED,ESTABLISHED -j %s-%s' % (
+            bname, chain_name)
+        for table in [ipt_mgr.ipv4['filter'], ipt_mgr.ipv6['filter']]:
+            if chain_name not in table.chains:
+                table.add_chain(chain_name)
+            current_rules = [rule.rule for rule in table.rules
+                             if rule.chain == chain_name]
+            if current_rules != chain_rules:
+                table.rules = [rule for rule in table.rules
+                               if rule.chain != chain_name]
+                for rule in chain_rules:
+                    table.add_rule(chain_name, rule)
+
+            # the jump goes before the first per-interface FORWARD rule
+            rules = [rule for rule in table.rules
+                     if rule.tag != ESTABLISHED_TAG]
+            position = next(
+                (idx for idx, rule in enumerate(rules)
+                 if rule.chain == FORWARD_CHAIN and rule.wrap and
+                 rule.rule.startswith(('-i ', '-o '))), len(rules))
+            current = [idx for idx, rule in enumerate(table.rules)
+                       if rule.tag == ESTABLISHED_TAG]
+            if (len(current) == 1 and current[0] <= position and
+                    table.rules[current[0]].rule == jump_rule):
+                continue
+            rules.insert(position, iptables_manager.IptablesRule(
+                FORWARD_CHAIN, jump_rule, binary_name=table.wrap_name,
+                tag=ESTABLISHED_TAG))
+            table.rules = rules
+
+    def _is_fwaas_chain(self, chain_name):
+        """Whether a (truncated) filter chain name is one of the driver's."""
+        if chain_name in [iptables_manager.get_chain_name(name) for name in
+                          [ACCEPTED_CHAIN, DROPPED_CHAIN, REJECTED_CHAIN,
+                           FWAAS_DEFAULT_CHAIN, FWAAS_ESTABLISHED_CHAIN]]:
+            return True
+        if chain_name[:3] in ['%s%s' % (prefix, tag)
+                              for prefix in CHAIN_NAME_PREFIX.values()
+                              for tag in IP_VER_TAG.values()]:
+            return True
+        # sub-chains of the chain trees, see _get_tree_chain_name()
+        if (chain_name[:1] in CHAIN_NAME_PREFIX.values() and
+                chain_name[1:2] in [tag[-1] for tag in IP_VER_TAG.values()] and
+                chain_name[2:3] in [tag for _protocol, tag in
+                                    chain_tree.PROTOCOL_BUCKETS]):
+            return True
+        return self._is_dispatch_chain(chain_name)
+
+    def _is_dispatch_chain(self, chain_name):
+        return (chain_name[:3] in DISPATCH_FAMILIES and
+                chain_name[3:4] == '-')
+
+    def _route_forward_jumps(self, if_prefix, jump_rules):
+        """Place the per-interface jumps of a group in their chains.
+
+        Without interface_dispatch, every jump goes to FORWARD. Otherwise,
+        the jumps are spread over dispatch chains keyed by the family of the
+        jump and the first DISPATCH_KEY_LEN characters after if_prefix of
+        the interface name, e.g. 'fwo-qr-ab' for the jumps of the qr-ab*
+        interfaces to the chains of their groups for packets going out of
+        them. FORWARD only reaches the dispatch chains through the jumps
+        _sync_dispatch_chains() maintains.
+
+        :returns: the jump rules, in order, of every chain
+        """
+        if not self.interface_dispatch:
+            return {FORWARD_CHAIN: jump_rules}
+        default_chain = iptables_manager.get_chain_name(FWAAS_DEFAULT_CHAIN)
+        chains = {}
+        for jump_rule in jump_rules:
+            iptables_dir, intf_name = jump_rule.split()[:2]
+            family = '%s%s' % (
+                'fd' if jump_rule.endswith('-' + default_chain) else 'fw',
+                iptables_dir[1])
+            chain_name = '%s-%s' % (
+                family, intf_name[:len(if_prefix) + DISPATCH_KEY_LEN])
+            chains.setdefault(chain_name, []).append(jump_rule)
+        return chains
+
+    def _sync_dispatch_chains(self, ipt_mgr):
+        """Make FORWARD jump to the interface dispatch chains in use.
+
+        Empty dispatch chains are removed. FORWARD jumps to the dispatch
+        chains of a family directly while there are up to
+        DISPATCH_CHAIN_SIZE of them, and otherwise to intermediate chains
+        keyed by the first character of the port ID, e.g. 'fwo-qr-a', which
+        jump to the dispatch chains of their character. With port IDs
+        made of hexadecimal digits, a packet goes through at most 16 jumps
+        per family and level, then through the jumps of the ports sharing
+        the first DISPATCH_KEY_LEN characters of the ID of its port: about
+        one 256th of the ports, so the cost still grows linearly with the
+        number of ports, only much slower than with a FORWARD rule per
+        port.
+
+        The jumps follow DISPATCH_FAMILIES whatever the groups, so that a
+        packet goes through the chains of the group of its output
+        interface, then of its input interface, before their default
+        policy.
+        """
+        bname = iptables_manager.binary_name
+        for table in [ipt_mgr.ipv4['filter'], ipt_mgr.ipv6['filter']]:
+            in_use = set(rule.chain for rule in table.rules
+                         if rule.tag != DISPATCH_TAG)
+            leaves = [chain_name for chain_name in table.chains
+                      if self._is_dispatch_chain(chain_name) and
+                      chain_name in in_use]
+            # chain -> dispatch chains it jumps to
+            jumps = {FORWARD_CHAIN: []}
+            for family in DISPATCH_FAMILIES:
+                chain_names = sorted(chain_name for chain_name in leaves
+                                     if chain_name[:3] == family)
+                if len(chain_names) <= DISPATCH_CHAIN_SIZE:
+                    jumps[FORWARD_CHAIN] += chain_names
+                    continue
+                for chain_name in chain_names:
+                    parent = chain_name[:-(DISPATCH_KEY_LEN - 1)]
+                    if parent not in jumps:
+                        jumps[FORWARD_CHAIN].append(parent)
+                        jumps[parent] = []
+                    jumps[parent].append(chain_name)
+            for chain_name in sorted(table.chains):
+                if (self._is_dispatch_chain(chain_name) and
+                        chain_name not in leaves and
+                        chain_name not in jumps):
+                    table.remove_chain(chain_name)
+            jump_rules = {
+                chain: ['-%s %s+ -j %s-%s' % (
+                    chain_name[2], chain_name[4:], bname, chain_name)
+                    for chain_name in chain_names]
+                for chain, chain_names in jumps.items()}
+            current_rules = {}
+            for rule in table.rules:
+                if rule.tag == DISPATCH_TAG:
+                    current_rules.setdefault(rule.chain, []).append(
+                        rule.rule)
+            if current_rules == {chain: rules for chain, rules in
+                                 jump_rules.items() if rules}:
+                continue
+            table.clear_rules_by_tag(DISPATCH_TAG)
+            for chain, rules in sorted(jump_rules.items()):
+                if chain != FORWARD_CHAIN:
+                    table.add_chain(chain)
+                for jump_rule in rules:
+                    table.add_rule(chain, jump_rule, tag=DISPATCH_TAG)
+
+    def _get_filter_table(self, ipt_mgr, ver):
+        if ver == IPV4:
+            return ipt_mgr.ipv4['filter']
+        return ipt_mgr.ipv6['filter']
 
     def _get_chain_name(self, fwid, ver, direction):
         return '%s%s%s' % (CHAIN_NAME_PREFIX[direction],
@@ -216,6 +1440,8 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
 
     def _setup_chains(self, firewall, ipt_if_prefix, router_fw_ports):
         """Create Fwaas chain using the rules in the policy
+
+        :returns: the ipsets used by the rules, see _compile_rule_list()
         """
         egress_rule_list = firewall['egress_rule_list']
         ingress_rule_list = firewall['ingress_rule_list']
@@ -223,10 +1449,11 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         ipt_mgr = ipt_if_prefix['ipt']
 
         # default rules for invalid packets and established sessions
-        invalid_rule = self._drop_invalid_packets_rule()
-        est_rule = self._allow_established_rule()
+        preamble = self._preamble_rules()
 
         for ver in [IPV4, IPV6]:
+            if not self._has_chains(firewall, ver):
+                continue
             if ver == IPV4:
                 table = ipt_mgr.ipv4['filter']
             else:
@@ -237,94 +1464,304 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
                 fwid, ver, constants.EGRESS_DIRECTION)
             for name in [ichain_name, ochain_name]:
                 table.add_chain(name)
-                table.add_rule(name, invalid_rule)
-                table.add_rule(name, est_rule)
+                for rule in preamble:
+                    table.add_rule(name, rule)
+
+        ipsets = {}
+        for direction, rule_list in [
+                (constants.INGRESS_DIRECTION, ingress_rule_list),
+                (constants.EGRESS_DIRECTION, egress_rule_list)]:
+            for ver in [IPV4, IPV6]:
+                if not self._has_chains(firewall, ver):
+                    continue
+                table = self._get_filter_table(ipt_mgr, ver)
+                top_chain_name = self._get_chain_name(fwid, ver, direction)
+                chains, chain_ipsets = self._compile_chains(
+                    fwid, ver, direction, rule_list)
+                for chain_name, rules in chains.items():
+                    if chain_name != top_chain_name:
+                        table.add_chain(chain_name)
+                    for iptbl_rule in rules:
+                        table.add_rule(chain_name, iptbl_rule)
+                ipsets.update(chain_ipsets)
 
-        for rule in ingress_rule_list:
-            if not rule['enabled']:
-                continue
-            iptbl_rule = self._convert_fwaas_to_iptables_rule(rule)
-            if rule['ip_version'] == constants.IP_VERSION_4:
-                ver = IPV4
-                table = ipt_mgr.ipv4['filter']
+        self._enable_policy_chain(fwid, ipt_if_prefix, router_fw_ports)
+        return ipsets
+
+    def _compile_chains(self, fwid, ver, direction, rule_list,
+                        sources=None):
+        """Compile the rules of a group's chain, split into a chain tree.
+
+        The rules of the IP version are compiled into the chain of the group
+        for the direction. When they are at least chain_tree_min_rules, they
+        are first split with chain_tree.build_tree() into sub-chains the
+        group's chain dispatches packets to with gotos, by protocol and for
+        large protocol buckets by destination prefix. The tree is only used
+        when chain_tree.verify_tree() confirms that every sub-chain keeps
+        the order of the rules which may match its packets.
+
+        :param sources: dict set to the IDs of the firewall rules each
+            iptables rule of each chain was compiled from, as
+            {<chain>: [[<rule ID>, ...], ...]}
+        :returns: the rules of each chain, the group's chain first, and the
+            ipsets they use, see _compile_rule_list()
+        """
+        sources = {} if sources is None else sources
+        chain_name = self._get_chain_name(fwid, ver, direction)
+        ip_version = (constants.IP_VERSION_4 if ver == IPV4
+                      else constants.IP_VERSION_6)
+        rules = [rule for rule in rule_list
+                 if rule['enabled'] and rule['ip_version'] == ip_version]
+        ipsets = {}
+        root = None
+        if self.chain_tree_min_rules and (
+                len(rules) >= self.chain_tree_min_rules):
+            root = chain_tree.build_tree(rules, ip_version,
+                                         self.chain_tree_min_rules)
+            if root is not None and not chain_tree.verify_tree(rules, root):
+                LOG.warning("Chain tree of firewall group %(fwid)s does not "
+                            "keep the order of its %(dir)s rules, using a "
+                            "single chain", {'fwid': fwid, 'dir': direction})
+                root = None
+        if root is None:
+            iptables_rules, ipsets = self._compile_rule_list(
+                fwid, ver, direction, rules, ipsets,
+                sources.setdefault(chain_name, []))
+            return {chain_name: iptables_rules}, ipsets
+
+        chains = {}
+        self._compile_chain_node(fwid, ver, direction, root, chain_name,
+                                 ip_version, chains, ipsets, sources)
+        return chains, ipsets
+
+    def _compile_chain_node(self, fwid, ver, direction, node, chain_name,
+                            ip_version, chains, ipsets, sources):
+        bname = iptables_manager.binary_name
+        chains[chain_name] = []
+        sources[chain_name] = []
+        for (kind, value), child in node.branches:
+            if kind == 'protocol':
+                args = self._protocol_arg(value, ip_version)
+                child_name = self._get_tree_chain_name(
+                    fwid, ver, direction, child.tag)
             else:
-                ver = IPV6
-                table = ipt_mgr.ipv6['filter']
-            ichain_name = self._get_chain_name(
-                fwid, ver, constants.INGRESS_DIRECTION)
-            table.add_rule(ichain_name, iptbl_rule)
-
-        for rule in egress_rule_list:
-            if not rule['enabled']:
+                args = self._ip_prefix_arg('d', value)
+                child_name = self._get_tree_chain_name(
+                    fwid, ver, direction, node.tag, child.tag)
+            args += ['-g', '%s-%s' % (
+                bname, iptables_manager.get_chain_name(child_name))]
+            chains[chain_name].append(' '.join(args))
+            sources[chain_name].append([])
+            self._compile_chain_node(fwid, ver, direction, child, child_name,
+                                     ip_version, chains, ipsets, sources)
+        rules, ipsets = self._compile_rule_list(fwid, ver, direction,
+                                                node.rules, ipsets,
+                                                sources[chain_name])
+        chains[chain_name] += rules
+
+    def _get_tree_chain_name(self, fwid, ver, direction, bucket_tag,
+                             split_tag='-'):
+        """Name of a sub-chain of a group's chain tree, e.g. 'i4t-<fwid>'."""
+        return '%s%s%s%s%s' % (CHAIN_NAME_PREFIX[direction],
+                               IP_VER_TAG[ver][-1], bucket_tag, split_tag,
+                               fwid)
+
+    def _get_tree_chain_names(self, table, fwid, ver, direction):
+        """Find the sub-chains of a group's chain tree in a table."""
+        prefix = '%s%s' % (CHAIN_NAME_PREFIX[direction], IP_VER_TAG[ver][-1])
+        suffix = iptables_manager.get_chain_name(
+            self._get_tree_chain_name(fwid, ver, direction, '-'))[4:]
+        return [chain for chain in table.chains
+                if chain.startswith(prefix) and chain[4:] == suffix]
+
+    def _compile_rule_list(self, fwid, ver, direction, rule_list,
+                           ipsets=None, sources=None):
+        """Convert the enabled rules of an IP version into iptables rules.
+
+        With ipsets enabled, runs of at least IPSET_MIN_RULES adjacent rules
+        which only differ in their source or their destination address are
+        folded into a single rule matching an ipset of these addresses.
+        Likewise, with multiport enabled, runs of TCP or UDP rules which only
+        differ in their source or their destination port are folded into
+        rules matching up to MULTIPORT_MAX_PORTS ports. The rules of a run
+        share their action, so matching the first rule of the run or the
+        folded rule makes no difference.
+
+        :param ipsets: ipsets of other rules of the chain tree, updated
+        :param sources: list extended with the IDs of the firewall rules
+            each iptables rule was compiled from
+        :returns: the iptables rules, in order, and the ipsets they use as
+            {(<set id>, <ethertype>): [<address>, ...]}
+        """
+        ip_version = (constants.IP_VERSION_4 if ver == IPV4
+                      else constants.IP_VERSION_6)
+        rules = [rule for rule in rule_list
+                 if rule['enabled'] and rule['ip_version'] == ip_version]
+        iptables_rules = []
+        ipsets = {} if ipsets is None else ipsets
+        sources = [] if sources is None else sources
+        idx = 0
+        while idx < len(rules):
+            field, length = self._find_ipset_run(rules, idx)
+            port_field, port_length = self._find_multiport_run(rules, idx)
+            if port_length > 1 and port_length >= length:
+                sources.append([rule['id']
+                                for rule in rules[idx:idx + port_length]])
+                ports = []
+                for rule in rules[idx:idx + port_length]:
+                    port = str(rule[port_field])
+                    if port not in ports:
+                        ports.append(port)
+                iptables_rules.append(self._convert_fwaas_to_iptables_rule(
+                    rules[idx], multiport=(port_field, ports)))
+                idx += port_length
                 continue
-            iptbl_rule = self._convert_fwaas_to_iptables_rule(rule)
-            if rule['ip_version'] == constants.IP_VERSION_4:
-                ver = IPV4
-                table = ipt_mgr.ipv4['filter']
-            else:
-                ver = IPV6
-                table = ipt_mgr.ipv6['filter']
-            ochain_name = self._get_chain_name(
-                fwid, ver, constants.EGRESS_DIRECTION)
-            table.add_rule(ochain_name, iptbl_rule)
+            if length < IPSET_MIN_RULES:
+                sources.append([rules[idx]['id']])
+                iptables_rules.append(
+                    self._convert_fwaas_to_iptables_rule(rules[idx]))
+                idx += 1
+                continue
+            sources.append([rule['id'] for rule in rules[idx:idx + length]])
+            ethertype = IPSET_ETHERTYPE[ver]
+            members = []
+            for rule in rules[idx:idx + length]:
+                address = self._ip_to_cidr(rule[field])
+                if address not in members:
+                    members.append(address)
+            set_id = self._get_ipset_id(fwid, direction, members)
+            ipsets[(set_id, ethertype)] = members
+            set_name = ipset_manager.IpsetManager.get_name(set_id, ethertype)
+            iptables_rules.append(self._convert_fwaas_to_iptables_rule(
+                rules[idx], ipset=(field, set_name)))
+            idx += length
+        return iptables_rules, ipsets
+
+    def _get_ipset_id(self, fwid, direction, members):
+        """Get the ID of the ipset of a group holding members.
+
+        The ID is derived from the members, so that the members of an
+        ipset never change: the sets of a new version of the rules are
+        filled under their own names while the rules of the previous
+        version still match the sets they were applied with, and the
+        sets no rule uses anymore are only destroyed after the apply,
+        see _remove_unused_ipsets().
+        """
+        digest = hashlib.sha1(repr(sorted(members)).encode()).hexdigest()
+        return '%s%s%s' % (CHAIN_NAME_PREFIX[direction], fwid[:8],
+                           digest[:IPSET_DIGEST_LEN])
 
-        self._enable_policy_chain(fwid, ipt_if_prefix, router_fw_ports)
+    def _find_ipset_run(self, rules, start):
+        """Find the longest run of rules an ipset can match from start.
 
-    def _find_changed_rules(self, pre_firewall, firewall):
-        """Find the rules changed between the current firewall
-        and the updating rule
-        """
-        changed_rules = []
-        for fw_rule_list in ['egress_rule_list', 'ingress_rule_list']:
-            pre_fw_rules = pre_firewall[fw_rule_list]
-            fw_rules = firewall[fw_rule_list]
-            for pre_fw_rule in pre_fw_rules:
-                for fw_rule in fw_rules:
-                    if (pre_fw_rule.get('id') == fw_rule.get('id') and
-                            pre_fw_rule != fw_rule):
-                        changed_rules.append(pre_fw_rule)
-                        changed_rules.append(fw_rule)
-        return changed_rules
-
-    def _find_removed_rules(self, pre_firewall, firewall):
-        removed_rules = []
-        for fw_rule_list in ['egress_rule_list', 'ingress_rule_list']:
-            pre_fw_rules = pre_firewall[fw_rule_list]
-            fw_rules = firewall[fw_rule_list]
-            fw_rule_ids = [fw_rule['id'] for fw_rule in fw_rules]
-            removed_rules.extend([pre_fw_rule for pre_fw_rule in pre_fw_rules
-                    if pre_fw_rule['id'] not in fw_rule_ids])
-        return removed_rules
-
-    def _find_new_rules(self, pre_firewall, firewall):
-        return self._find_removed_rules(firewall, pre_firewall)
+        :returns: the address field the rules of the run differ in and the
+            length of the run
+        """
+        best = (None, 1)
+        if not self.enable_ipset:
+            return best
+        for field in IPSET_FIELDS:
+            first = rules[start]
+            if not first.get(field):
+                continue
+            key = self._fold_key(first, field)
+            end = start + 1
+            while (end < len(rules) and rules[end].get(field) and
+                   self._fold_key(rules[end], field) == key):
+                end += 1
+            if end - start > best[1]:
+                best = (field, end - start)
+        return best
+
+    def _find_multiport_run(self, rules, start):
+        """Find the longest run of rules a multiport match can match.
+
+        :returns: the port field the rules of the run differ in and the
+            length of the run
+        """
+        best = (None, 1)
+        first = rules[start]
+        if (not self.enable_multiport or
+                first.get('protocol') not in [constants.PROTO_NAME_TCP,
+                                              constants.PROTO_NAME_UDP]):
+            return best
+        for field in MULTIPORT_FIELDS:
+            if first.get(field) is None:
+                continue
+            key = self._fold_key(first, field)
+            ports = set()
+            count = 0
+            end = start
+            while (end < len(rules) and rules[end].get(field) is not None and
+                   self._fold_key(rules[end], field) == key):
+                port = str(rules[end][field])
+                if port not in ports:
+                    weight = 2 if ':' in port else 1
+                    if count + weight > MULTIPORT_MAX_PORTS:
+                        break
+                    ports.add(port)
+                    count += weight
+                end += 1
+            if end - start > best[1]:
+                best = (field, end - start)
+        return best
+
+    def _fold_key(self, rule, field):
+        return tuple(rule.get(key) for key in FOLD_KEY_FIELDS
+                     if key != field)
+
+    def _get_ipset_mgr(self, ipt_mgr):
+        namespace = ipt_mgr.namespace
+        if namespace not in self.ipset_mgrs:
+            self.ipset_mgrs[namespace] = ipset_manager.IpsetManager(
+                namespace=namespace)
+        return self.ipset_mgrs[namespace]
+
+    def _set_ipsets(self, ipt_mgr, ipsets):
+        """Create or update the ipsets used by the rules of a group."""
+        for (set_id, ethertype), members in ipsets.items():
+            self._get_ipset_mgr(ipt_mgr).set_members(
+                set_id, ethertype, [(member, None) for member in members])
+
+    def _remove_unused_ipsets(self, fwid, ipt_mgr, ipsets):
+        """Destroy the ipsets of a group its rules do not use anymore.
+
+        This must run once the rules which used them have been applied, as
+        an ipset referenced by iptables cannot be destroyed.
+        """
+        namespace = ipt_mgr.namespace
+        groups = self.ipsets.get(namespace, {})
+        # the ipsets of policy-shared chains may be used by other groups
+        unused = groups.pop(fwid, set()) - set(ipsets)
+        for set_id, ethertype in unused - set().union(*groups.values()):
+            self._get_ipset_mgr(ipt_mgr).destroy(set_id, ethertype)
+        if ipsets:
+            self.ipsets.setdefault(namespace, {})[fwid] = set(ipsets)
+        elif namespace in self.ipsets and not groups:
+            del self.ipsets[namespace]
+            self.ipset_mgrs.pop(namespace, None)
 
     def _remove_conntrack_new_firewall(self, agent_mode, apply_list, firewall):
         """Remove conntrack when create new firewall"""
-        routers_list = list(set([apply_info[0] for apply_info in apply_list]))
-        for ri in routers_list:
-            ipt_if_prefix_list = self._get_ipt_mgrs_with_if_prefix(
-                agent_mode, ri)
-            for ipt_if_prefix in ipt_if_prefix_list:
-                ipt_mgr = ipt_if_prefix['ipt']
-                self.conntrack.flush_entries(ipt_mgr.namespace)
+        def _flush(ipt_if_prefix, router_fw_ports):
+            self.conntrack.flush_entries(ipt_if_prefix['ipt'].namespace)
+
+        self._run_per_namespace(agent_mode, apply_list, _flush, unique=True)
 
     def _remove_conntrack_updated_firewall(self, agent_mode,
                                            apply_list, pre_firewall, firewall):
         """Remove conntrack when updated firewall"""
-        routers_list = list(set([apply_info[0] for apply_info in apply_list]))
-        for ri in routers_list:
-            ipt_if_prefix_list = self._get_ipt_mgrs_with_if_prefix(
-                agent_mode, ri)
-            for ipt_if_prefix in ipt_if_prefix_list:
-                ipt_mgr = ipt_if_prefix['ipt']
-                ch_rules = self._find_changed_rules(pre_firewall,
-                                                    firewall)
-                i_rules = self._find_new_rules(pre_firewall, firewall)
-                r_rules = self._find_removed_rules(pre_firewall, firewall)
-                removed_conntrack_rules_list = ch_rules + i_rules + r_rules
-                self.conntrack.delete_entries(removed_conntrack_rules_list,
-                                              ipt_mgr.namespace)
+        # the diff does not depend on the namespace, compute it only once
+        diff = rule_diff.diff_firewall_rules(pre_firewall, firewall)
+        removed_conntrack_rules_list = (diff.changed + diff.added +
+                                        diff.removed)
+
+        def _delete_entries(ipt_if_prefix, router_fw_ports):
+            self.conntrack.delete_entries(removed_conntrack_rules_list,
+                                          ipt_if_prefix['ipt'].namespace)
+
+        self._run_per_namespace(agent_mode, apply_list, _delete_entries,
+                                unique=True)
 
     def _remove_default_chains(self, nsid):
         """Remove fwaas default policy chain."""
@@ -338,6 +1775,11 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
                               constants.EGRESS_DIRECTION]:
                 chain_name = self._get_chain_name(fwid, ver, direction)
                 self._remove_chain_by_name(ver, chain_name, ipt_mgr)
+                if self.chain_tree_min_rules:
+                    table = self._get_filter_table(ipt_mgr, ver)
+                    for chain_name in self._get_tree_chain_names(
+                            table, fwid, ver, direction):
+                        table.remove_chain(chain_name)
 
     def _add_default_policy_chain_v4v6(self, ipt_mgr):
         dropped_chain = self._get_action_chain(DROPPED_CHAIN)
@@ -348,6 +1790,15 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         ipt_mgr.ipv6['filter'].add_rule(
             FWAAS_DEFAULT_CHAIN, '-j %s' % dropped_chain)
 
+    def _ensure_default_policy_chain_v4v6(self, ipt_mgr):
+        for ip_version in [constants.IP_VERSION_4, constants.IP_VERSION_6]:
+            if ipt_mgr.is_chain_empty('filter', FWAAS_DEFAULT_CHAIN,
+                                      ip_version=ip_version):
+                table = ipt_mgr.get_tables(ip_version)['filter']
+                table.add_chain(FWAAS_DEFAULT_CHAIN)
+                table.add_rule(FWAAS_DEFAULT_CHAIN, '-j %s' %
+                               self._get_action_chain(DROPPED_CHAIN))
+
     def _add_accepted_chain_v4v6(self, ipt_mgr):
         v4rules_in_chain = \
             ipt_mgr.get_chain("filter", ACCEPTED_CHAIN,
@@ -378,24 +1829,46 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
             ipt_mgr.ipv6['filter'].add_chain(DROPPED_CHAIN)
             ipt_mgr.ipv6['filter'].add_rule(DROPPED_CHAIN, '-j DROP')
 
-    def _add_rejected_chain_v4v6(self, ipt_mgr):
+    def _add_rejected_chain_v4v6(self, ipt_mgr, router_id=None):
         v4rules_in_chain = \
             ipt_mgr.get_chain("filter", REJECTED_CHAIN,
                               ip_version=constants.IP_VERSION_4)
         if not v4rules_in_chain:
             ipt_mgr.ipv4['filter'].add_chain(REJECTED_CHAIN)
-            ipt_mgr.ipv4['filter'].add_rule(
-                REJECTED_CHAIN,
-                '-j REJECT --reject-with icmp-port-unreachable')
+            self._add_rules_to_chain(
+                ipt_mgr, IPV4, REJECTED_CHAIN, self._rejected_chain_rules(
+                    '-j REJECT --reject-with icmp-port-unreachable',
+                    router_id))
 
         v6rules_in_chain = \
             ipt_mgr.get_chain("filter", REJECTED_CHAIN,
                               ip_version=constants.IP_VERSION_6)
         if not v6rules_in_chain:
             ipt_mgr.ipv6['filter'].add_chain(REJECTED_CHAIN)
-            ipt_mgr.ipv6['filter'].add_rule(
-                REJECTED_CHAIN,
-                '-j REJECT --reject-with icmp6-port-unreachable')
+            self._add_rules_to_chain(
+                ipt_mgr, IPV6, REJECTED_CHAIN, self._rejected_chain_rules(
+                    '-j REJECT --reject-with icmp6-port-unreachable',
+                    router_id))
+
+    def _get_reject_rate_limit(self, router_id):
+        limits = cfg.CONF.fwaas.reject_rate_limits
+        if router_id in limits:
+            return limits[router_id]
+        return cfg.CONF.fwaas.reject_rate_limit
+
+    def _rejected_chain_rules(self, reject_rule, router_id):
+        """Rules of the rejected chain of a router.
+
+        With a reject rate limit, only that many packets per second are
+        rejected, the others are dropped by a last rule whose counters tell
+        how often the limit was hit, see get_reject_counters().
+        """
+        limit = self._get_reject_rate_limit(router_id)
+        if not limit:
+            return [reject_rule]
+        return ['-m limit --limit %d/sec --limit-burst %d %s' % (
+                    limit, cfg.CONF.fwaas.reject_rate_burst, reject_rule),
+                '-j DROP']
 
     def _remove_chain_by_name(self, ver, chain_name, ipt_mgr):
         if ver == IPV4:
@@ -415,7 +1888,31 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         for rule in rules:
             table.add_rule(chain_name, rule)
 
+    def get_compile_cache_stats(self):
+        """Get the hits and misses of the compiled rule caches.
+
+        :returns: {'rules' | 'action_chains' | 'addresses':
+                   {'hits': ..., 'misses': ..., 'size': ...,
+                    'maxsize': ..., 'hit_ratio': <hits / lookups>}}
+        """
+        stats = {}
+        for name, cached in [('rules', self._compile_rule),
+                             ('action_chains', self._action_chain),
+                             ('addresses', self._ip_to_cidr)]:
+            info = cached.cache_info()
+            lookups = info.hits + info.misses
+            stats[name] = {'hits': info.hits,
+                           'misses': info.misses,
+                           'size': info.currsize,
+                           'maxsize': info.maxsize,
+                           'hit_ratio': (float(info.hits) / lookups
+                                         if lookups else 0.0)}
+        return stats
+
     def _get_action_chain(self, name):
+        return self._action_chain(name)
+
+    def _build_action_chain(self, name):
         binary_name = iptables_manager.binary_name
         chain_name = iptables_manager.get_chain_name(name)
         return '%s-%s' % (binary_name, chain_name)
@@ -424,42 +1921,52 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         bname = iptables_manager.binary_name
         ipt_mgr = ipt_if_prefix['ipt']
         if_prefix = ipt_if_prefix['if_prefix']
+        intf_names = self._get_intf_names(ipt_if_prefix, router_fw_ports)
 
         for (ver, tbl) in [(IPV4, ipt_mgr.ipv4['filter']),
                            (IPV6, ipt_mgr.ipv6['filter'])]:
+            jump_rules = []
             for direction in [constants.INGRESS_DIRECTION,
                               constants.EGRESS_DIRECTION]:
                 chain_name = self._get_chain_name(fwid, ver, direction)
                 chain_name = iptables_manager.get_chain_name(chain_name)
                 if chain_name in tbl.chains:
-                    for router_fw_port in router_fw_ports:
-                        intf_name = self._get_intf_name(if_prefix,
-                                                        router_fw_port)
-                        jump_rule = ['%s %s -j %s-%s' % (
-                            IPTABLES_DIR[direction], intf_name,
-                            bname, chain_name)]
-                        self._add_rules_to_chain(ipt_mgr, ver,
-                                             'FORWARD', jump_rule)
-
-        # jump to DROP_ALL policy
-        chain_name = iptables_manager.get_chain_name(FWAAS_DEFAULT_CHAIN)
-        for router_fw_port in router_fw_ports:
-            intf_name = self._get_intf_name(if_prefix,
-                                            router_fw_port)
-            jump_rule = ['-o %s -j %s-%s' % (intf_name, bname, chain_name)]
-            self._add_rules_to_chain(ipt_mgr, IPV4, 'FORWARD', jump_rule)
-            self._add_rules_to_chain(ipt_mgr, IPV6, 'FORWARD', jump_rule)
-
-        # jump to DROP_ALL policy
-        chain_name = iptables_manager.get_chain_name(FWAAS_DEFAULT_CHAIN)
-        for router_fw_port in router_fw_ports:
-            intf_name = self._get_intf_name(if_prefix,
-                                            router_fw_port)
-            jump_rule = ['-i %s -j %s-%s' % (intf_name, bname, chain_name)]
-            self._add_rules_to_chain(ipt_mgr, IPV4, 'FORWARD', jump_rule)
-            self._add_rules_to_chain(ipt_mgr, IPV6, 'FORWARD', jump_rule)
-
-    def _convert_fwaas_to_iptables_rule(self, rule):
+                    jump_rules += ['%s %s -j %s-%s' % (
+                        IPTABLES_DIR[direction], intf_name,
+                        bname, chain_name) for intf_name in intf_names]
+
+            # jump to DROP_ALL policy
+            chain_name = iptables_manager.get_chain_name(FWAAS_DEFAULT_CHAIN)
+            for iptables_dir in ['-o', '-i']:
+                jump_rules += ['%s %s -j %s-%s' % (
+                    iptables_dir, intf_name, bname, chain_name)
+                    for intf_name in intf_names]
+
+            for chain_name, rules in self._route_forward_jumps(
+                    if_prefix, jump_rules).items():
+                if chain_name != FORWARD_CHAIN:
+                    tbl.add_chain(chain_name)
+                self._add_rules_to_chain(ipt_mgr, ver, chain_name, rules)
+
+    def _convert_fwaas_to_iptables_rule(self, rule, ipset=None,
+                                        multiport=None):
+        """Convert a firewall rule into an iptables rule.
+
+        :param ipset: (field, set name) to match the source or destination
+            address of the rule against an ipset instead of its own address
+        :param multiport: (field, ports) to match the source or destination
+            port of the rule against a list of ports instead of its own port
+        """
+        # rules with the same content compile to the same iptables rule,
+        # whatever their ID, group or router
+        key = rule_diff.rule_fingerprint(
+            [rule.get(field) for field in COMPILE_KEY_FIELDS])
+        if multiport:
+            multiport = (multiport[0], tuple(multiport[1]))
+        return self._compile_rule(key, ipset, multiport)
+
+    def _build_iptables_rule(self, key, ipset, multiport):
+        rule = dict(zip(COMPILE_KEY_FIELDS, key))
         action = FWAAS_TO_IPTABLE_ACTION_MAP[rule.get('action')]
 
         # Output ordering is important here as it must exactly match what
@@ -470,8 +1977,18 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         args += self._protocol_arg(rule.get('protocol'),
                                    rule.get('ip_version'))
 
-        args += self._ip_prefix_arg('s', rule.get('source_ip_address'))
-        args += self._ip_prefix_arg('d', rule.get('destination_ip_address'))
+        ipset_field = ipset[0] if ipset else None
+        if ipset_field != 'source_ip_address':
+            args += self._ip_prefix_arg('s', rule.get('source_ip_address'))
+        if ipset_field != 'destination_ip_address':
+            args += self._ip_prefix_arg('d',
+                                        rule.get('destination_ip_address'))
+        if ipset:
+            args += ['-m', 'set', '--match-set', ipset[1],
+                     IPSET_FIELDS[ipset_field]]
+
+        if multiport:
+            rule[multiport[0]] = None
 
         # iptables adds '-m protocol' when any source
         # or destination port number is specified
@@ -487,11 +2004,29 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
                                rule.get('protocol'),
                                rule.get('destination_port'))
 
+        if multiport:
+            args += ['-m', 'multiport',
+                     '--%s' % MULTIPORT_FIELDS[multiport[0]],
+                     ','.join(multiport[1])]
+
         args += self._action_arg(action)
 
         iptables_rule = ' '.join(args)
         return iptables_rule
 
+    def _preamble_rules(self):
+        """Rules at the head of the chains of every group.
+
+        With established_fast_path, established sessions are accepted for
+        the whole namespace before the groups' chains, see
+        _sync_established_chain(), and only invalid packets are left to
+        them.
+        """
+        if self.established_fast_path:
+            return [self._drop_invalid_packets_rule()]
+        return [self._drop_invalid_packets_rule(),
+                self._allow_established_rule()]
+
     def _drop_invalid_packets_rule(self):
         dropped_chain = self._get_action_chain(DROPPED_CHAIN)
         return '-m state --state INVALID -j %s' % dropped_chain
@@ -546,5 +2081,5 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         if not ip_prefix:
             return []
 
-        args = ['-%s' % direction, '%s' % utils.ip_to_cidr(ip_prefix)]
+        args = ['-%s' % direction, '%s' % self._ip_to_cidr(ip_prefix)]
         return args
@@ -13,10 +13,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import itertools
+
 from neutron.agent.linux import utils as linux_utils
 from neutron_lib import constants
+from oslo_config import cfg
 from oslo_log import log as logging
 
+from neutron_fwaas.common import conntrack_matcher
 from neutron_fwaas.services.firewall.service_drivers.agents.drivers import\
     conntrack_base
 
@@ -31,21 +35,30 @@ ATTR_POSITIONS = {
     'udp': (('sport', 5), ('dport', 6), ('src', 3), ('dst', 4))
 }
 
-
-def normalize_filters_tuple(rule_tuple):
-    new_rule = []
-    for el in rule_tuple:
-        if el is None:
-            new_rule.append('')
-        else:
-            new_rule.append(el)
-    return tuple(new_rule)
+# protocols of firewall rules conntrack -D can filter on, by IP version
+FILTER_PROTOCOLS = {
+    constants.IP_VERSION_4: {
+        constants.PROTO_NAME_TCP: constants.PROTO_NAME_TCP,
+        constants.PROTO_NAME_UDP: constants.PROTO_NAME_UDP,
+        constants.PROTO_NAME_ICMP: constants.PROTO_NAME_ICMP},
+    constants.IP_VERSION_6: {
+        constants.PROTO_NAME_TCP: constants.PROTO_NAME_TCP,
+        constants.PROTO_NAME_UDP: constants.PROTO_NAME_UDP,
+        # IPv6 'icmp' rules match ICMPv6, as in the iptables driver
+        constants.PROTO_NAME_ICMP: constants.PROTO_NAME_IPV6_ICMP_LEGACY,
+        constants.PROTO_NAME_IPV6_ICMP:
+            constants.PROTO_NAME_IPV6_ICMP_LEGACY}
+}
+# conntrack -D filters a rule with port ranges may be expanded into, one
+# per combination of its source and destination ports
+MAX_RULE_FILTERS = 16
 
 
 class ConntrackLegacy(conntrack_base.ConntrackDriverBase):
     def initialize(self, execute=None):
         LOG.debug('Initialize Conntrack Legacy')
         self.execute = execute or linux_utils.execute
+        self.rule_filters = cfg.CONF.fwaas.conntrack_rule_filters
 
     def flush_entries(self, namespace):
         prefixcmd = ['ip', 'netns', 'exec', namespace] if namespace else []
@@ -53,15 +66,89 @@ class ConntrackLegacy(conntrack_base.ConntrackDriverBase):
         self._execute_command(cmd)
 
     def delete_entries(self, rules, namespace):
-        rule_filters = [self._get_filter_from_rule(r) for r in rules]
-        rule_filters.sort(key=normalize_filters_tuple)
+        if self.rule_filters:
+            rules = self._delete_entries_by_filter(rules, namespace)
+            if not rules:
+                return
+        matcher = conntrack_matcher.ConntrackMatcher(
+            [conntrack_matcher.normalize_filter(self._get_filter_from_rule(r))
+             for r in rules])
 
         delete_entries = self._get_entries_to_delete(
-            rule_filters, self.list_entries(namespace))
+            matcher, self.list_entries(namespace))
         for delete_entry in delete_entries:
             cmd = self._get_conntrack_cmd_from_entry(delete_entry, namespace)
             self._execute_command(cmd)
 
+    def _delete_entries_by_filter(self, rules, namespace):
+        """Delete the entries of rules with kernel-side conntrack filters.
+
+        The entries are matched by conntrack on the family, the protocol
+        and the ports of the rules only. Their addresses are left out, as
+        conntrack compares them to the original addresses of connections,
+        which are the floating IPs for connections to them, not the fixed
+        IPs the rules are written against.
+
+        :returns: the rules which can not be expressed as conntrack filters
+        """
+        prefixcmd = ['ip', 'netns', 'exec', namespace] if namespace else []
+        unfiltered_rules = []
+        filters = []
+        for rule in rules:
+            rule_filters = self._get_conntrack_filters(rule)
+            if rule_filters is None:
+                unfiltered_rules.append(rule)
+                continue
+            filters.extend(rule_filter for rule_filter in rule_filters
+                           if rule_filter not in filters)
+        for rule_filter in filters:
+            self._execute_command(prefixcmd + ['conntrack', '-D'] +
+                                  rule_filter)
+        return unfiltered_rules
+
+    @staticmethod
+    def _get_conntrack_filters(rule):
+        """Turn a firewall rule into conntrack -D filter arguments.
+
+        conntrack only filters on single ports, so port ranges are expanded
+        into a filter per port, or per pair of source and destination
+        ports, up to MAX_RULE_FILTERS filters.
+
+        :returns: the list of filters, or None when the rule can not be
+            expressed with at most MAX_RULE_FILTERS of them
+        """
+        ip_version = rule.get('ip_version')
+        if ip_version not in FILTER_PROTOCOLS:
+            return None
+        args = ['-f', 'ipv%d' % ip_version]
+        protocol = rule.get('protocol')
+        if protocol:
+            if protocol not in FILTER_PROTOCOLS[ip_version]:
+                return None
+            args += ['-p', FILTER_PROTOCOLS[ip_version][protocol]]
+        if protocol not in (constants.PROTO_NAME_TCP,
+                            constants.PROTO_NAME_UDP):
+            return [args]
+
+        port_args = []
+        count = 1
+        for key, option in [('source_port', '--sport'),
+                            ('destination_port', '--dport')]:
+            port_range = rule.get(key)
+            if not port_range:
+                port_args.append([[]])
+                continue
+            port_lower, sep, port_upper = str(port_range).partition(':')
+            port_lower, port_upper = sorted(
+                (int(port_lower), int(port_upper if sep else port_lower)))
+            count *= port_upper - port_lower + 1
+            if count > MAX_RULE_FILTERS:
+                return None
+            port_args.append([[option, str(port)] for port
+                              in range(port_lower, port_upper + 1)])
+        return [args + sport + dport
+                for sport, dport in itertools.product(*port_args)]
+
     def _execute_command(self, cmd):
         try:
             output = self.execute(cmd,
@@ -79,8 +166,8 @@ class ConntrackLegacy(conntrack_base.ConntrackDriverBase):
 
         :param namespace: namespace to get conntrack entries
         :returns: sorted list of conntrack entries in Python tuple
-            for example: [(4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234),
-            (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')]
+            for example: [(4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234,
+            '2.2.2.2'), (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2', '2.2.2.2')]
         """
         parsed_entries = []
         prefixcmd = ['ip', 'netns', 'exec', namespace] if namespace else []
@@ -117,8 +204,9 @@ class ConntrackLegacy(conntrack_base.ConntrackDriverBase):
 
         :param entry: conntrack entry as a list of string
         :param ip_version: ip version 4 or 6
-        :returns: conntrack entry in Python tuple
-        for example: (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')
+        :returns: conntrack entry in Python tuple, followed by the source
+        address of the reply
+        for example: (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2', '2.2.2.2')
         The attributes are ordered to be easy to compare with other entries
         and compare with firewall rule
         """
@@ -133,38 +221,20 @@ class ConntrackLegacy(conntrack_base.ConntrackDriverBase):
             val = entry[position].partition('=')[2]
             parsed_entry.append(int(val) if attr in ['sport', 'dport', 'type',
                                                      'code', 'id'] else val)
+        sources = [field for field in entry if field.startswith('src=')]
+        if len(sources) > 1:
+            parsed_entry.append(sources[1].partition('=')[2])
         return tuple(parsed_entry)
 
-    def _get_entries_to_delete(self, rule_filters, entries):
+    def _get_entries_to_delete(self, matcher, entries):
         """Specify conntrack entries to delete
 
-        :param rule_filters: List of filters parsed from firewall rules
+        :param matcher: ConntrackMatcher of the filters parsed from
+            firewall rules
         :param entries: all entries within namespace
         :returns: conntrack entries to delete
         """
-        # List all entries from namespace, they are already parsed
-        # to a list of tuples:
-        # [(4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234),
-        #  (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')]
-        delete_entries = []
-        entry_index = 0
-        entry_number = len(entries)
-        for rule_filter in rule_filters:
-            while entry_index < entry_number:
-                # Compare entry with rule
-                comp = self._compare_entry_and_rule_filter(
-                    rule_filter, entries[entry_index])
-                # Increase entry_index when entry is under rule
-                if comp < 0:
-                    entry_index += 1
-                # Append entry to delete_entry if it matches with rule
-                elif comp == 0:
-                    delete_entries.append(entries[entry_index])
-                    entry_index += 1
-                # Switch to new higher rule
-                else:
-                    break
-        return delete_entries
+        return [entry for entry in entries if matcher.match_entry(entry)]
 
     @staticmethod
     def _get_filter_from_rule(rule):
@@ -188,47 +258,3 @@ class ConntrackLegacy(conntrack_base.ConntrackDriverBase):
             else:
                 rule_filter.append(rule.get(key, []))
         return tuple(rule_filter)
-
-    @staticmethod
-    def _compare_entry_and_rule_filter(rule_filter, entry):
-        """Define that the entry should be deleted or not
-
-        :param rule_filter: filter that is parsed from a firewall rule
-        for example: (4, 'tcp', ['22', '33'], ['44', '55'])
-        :param entry: parsed conntrack entry,
-        for example: (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')
-        :returns: -1 if entry is lower than rule
-                   0 if entry matches rule,
-                   1 if entry is higher than rule
-        """
-        ENTRY_IS_LOWER = -1
-        ENTRY_MATCHES = 0
-        ENTRY_IS_HIGHER = 1
-        rule_ip_version = rule_filter[0]
-        if entry[0] < rule_ip_version:
-            return ENTRY_IS_LOWER
-        elif entry[0] > rule_ip_version:
-            return ENTRY_IS_HIGHER
-        rule_protocol = rule_filter[1]
-        if rule_protocol == constants.PROTO_NAME_IPV6_ICMP:
-            rule_protocol = constants.PROTO_NAME_IPV6_ICMP_LEGACY
-        if rule_protocol:
-            if entry[1] < rule_protocol:
-                return ENTRY_IS_LOWER
-            elif entry[1] > rule_protocol:
-                return ENTRY_IS_HIGHER
-        sport_range = rule_filter[2]
-        if sport_range:
-            sport_range = [int(port) for port in sport_range]
-            if entry[2] < min(sport_range[0], sport_range[-1]):
-                return ENTRY_IS_LOWER
-            elif entry[2] > max(sport_range[0], sport_range[-1]):
-                return ENTRY_IS_HIGHER
-        dport_range = rule_filter[3]
-        if dport_range:
-            dport_range = [int(port) for port in dport_range]
-            if entry[3] < min(dport_range[0], dport_range[-1]):
-                return ENTRY_IS_LOWER
-            elif entry[3] > max(dport_range[0], dport_range[-1]):
-                return ENTRY_IS_HIGHER
-        return ENTRY_MATCHES
@@ -13,9 +13,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from neutron_lib import constants
 from oslo_log import log as logging
 
+from neutron_fwaas.common import conntrack_matcher
 from neutron_fwaas.privileged import netlink_lib as nl_lib
 from neutron_fwaas.services.firewall.service_drivers.agents.drivers import\
     conntrack_base
@@ -36,43 +36,29 @@ class ConntrackNetlink(conntrack_base.ConntrackDriverBase):
         nl_lib.flush_entries(namespace)
 
     def delete_entries(self, rules, namespace):
-        rule_filters = (self._get_filter_from_rule(r) for r in rules)
-        rule_filters = sorted(rule_filters)
-        entries = nl_lib.list_entries(namespace)
-        delete_entries = self._get_entries_to_delete(rule_filters, entries)
-        if delete_entries:
-            nl_lib.delete_entries(delete_entries, namespace)
+        """Delete the conntrack entries matching rules within the namespace
 
-    def _get_entries_to_delete(self, rule_filters, entries):
-        """Specify conntrack entries to delete
+        The entries are matched and deleted by the privsep daemon, only the
+        filters of the rules being sent to it.
 
-        :param rule_filters: List of filters parsed from firewall rules
-        :param entries: all entries within namespace
-        :return: conntrack entries to delete
+        :param rules: firewall rules
+        :param namespace: namespace to delete conntrack entries
+        :return: None
         """
-        # List all entries from namespace, they are already parsed
-        # to a list of tuples:
-        # [(4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234),
-        #  (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')]
-        delete_entries = []
-        entry_index = 0
-        entry_number = len(entries)
-        for rule_filter in rule_filters:
-            while entry_index < entry_number:
-                # Compare entry with rule
-                comp = self._compare_entry_and_rule(rule_filter,
-                                                    entries[entry_index])
-                # Increase entry_index when entry is under rule
-                if comp < 0:
-                    entry_index += 1
-                # Append entry to delete_entry if it matches with rule
-                elif comp == 0:
-                    delete_entries.append(entries[entry_index])
-                    entry_index += 1
-                # Switch to new higher rule
-                else:
-                    break
-        return delete_entries
+        rule_filters = []
+        for rule in rules:
+            rule_filter = conntrack_matcher.normalize_filter(
+                self._get_filter_from_rule(rule))
+            if rule_filter not in rule_filters:
+                rule_filters.append(rule_filter)
+        if not rule_filters:
+            return
+        stats = nl_lib.delete_entries_by_filters(rule_filters, namespace)
+        LOG.debug('Deleted %(deleted)d of %(matched)d conntrack entries '
+                  'matching %(filters)d filters out of %(dumped)d in '
+                  '%(duration).3f seconds in namespace %(namespace)s',
+                  dict(stats, filters=len(rule_filters),
+                       namespace=namespace))
 
     @staticmethod
     def _get_filter_from_rule(rule):
@@ -96,49 +82,3 @@ class ConntrackNetlink(conntrack_base.ConntrackDriverBase):
             else:
                 rule_filter.append(rule.get(key, []))
         return tuple(rule_filter)
-
-    @staticmethod
-    def _compare_entry_and_rule(rule_filter, entry):
-        """Define that the entry should be deleted or not
-
-        :param rule_filter: filter that is parsed from a firewall rule
-        ex: (4, 'tcp', 1, 2)
-        :param entry: parsed conntrack entry,
-        ex: (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')
-        :return: -1 if entry is lower than rule, 0 if entry matches rule,
-        1 if entry is higher than rule
-        """
-        ENTRY_IS_LOWER = -1
-        ENTRY_MATCHES = 0
-        ENTRY_IS_HIGHER = 1
-        rule_ipversion = rule_filter[0]
-
-        if entry[0] < rule_ipversion:
-            return ENTRY_IS_LOWER
-        elif entry[0] > rule_ipversion:
-            return ENTRY_IS_HIGHER
-        rule_protocol = rule_filter[1]
-
-        if rule_protocol:
-            if rule_protocol == constants.PROTO_NAME_IPV6_ICMP:
-                rule_protocol = constants.PROTO_NAME_IPV6_ICMP_LEGACY
-            if entry[1] < rule_protocol:
-                return ENTRY_IS_LOWER
-            elif entry[1] > rule_protocol:
-                return ENTRY_IS_HIGHER
-
-        sport_range = rule_filter[2]
-        if sport_range:
-            sport_range = [int(port) for port in sport_range]
-            if entry[2] < min(sport_range[0], sport_range[-1]):
-                return ENTRY_IS_LOWER
-            elif entry[2] > max(sport_range[0], sport_range[-1]):
-                return ENTRY_IS_HIGHER
-        dport_range = rule_filter[3]
-        if dport_range:
-            dport_range = [int(port) for port in dport_range]
-            if entry[3] < min(dport_range[0], dport_range[-1]):
-                return ENTRY_IS_LOWER
-            elif entry[3] > max(dport_range[0], dport_range[-1]):
-                return ENTRY_IS_HIGHER
-        return ENTRY_MATCHES
@@ -0,0 +1,474 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from neutron.agent.linux import utils as linux_utils
+from neutron.common import utils
+from neutron_lib import constants
+from neutron_lib.exceptions import firewall_v2 as fw_ext
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import excutils
+import netaddr
+
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers import\
+    conntrack_base
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers import\
+    fwaas_base_v2
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import firewall_group_state
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import iptables_fwaas_v2
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import rule_diff
+
+LOG = logging.getLogger(__name__)
+FWAAS_DRIVER_NAME = 'Fwaas nftables driver'
+
+TABLE = 'inet neutron-fwaas'
+FORWARD_CHAIN = 'forward'
+# interface name -> jump to the chain of the group owning the port
+INGRESS_MAP = 'ingress-ports'
+EGRESS_MAP = 'egress-ports'
+# interfaces of every port of a firewall group, dropped by default
+PORTS_SET = 'firewall-ports'
+
+CHAIN_NAME_PREFIX = iptables_fwaas_v2.CHAIN_NAME_PREFIX
+# packets ingressing the tenant network leave the router through its port
+NFT_DIR = {constants.INGRESS_DIRECTION: 'oifname',
+           constants.EGRESS_DIRECTION: 'iifname'}
+PORT_MAPS = {constants.INGRESS_DIRECTION: INGRESS_MAP,
+             constants.EGRESS_DIRECTION: EGRESS_MAP}
+# same lookup order as the jumps of the iptables driver
+DIRECTIONS = (constants.INGRESS_DIRECTION, constants.EGRESS_DIRECTION)
+
+FWAAS_TO_NFT_VERDICT = {
+    'allow': 'accept',
+    'deny': 'drop',
+    'reject': 'reject with icmpx type port-unreachable'
+}
+NFT_FAMILY = {constants.IP_VERSION_4: 'ipv4',
+              constants.IP_VERSION_6: 'ipv6'}
+NFT_ADDR_PROTO = {constants.IP_VERSION_4: 'ip',
+                  constants.IP_VERSION_6: 'ip6'}
+
+# rule fields which consecutive rules may differ in and still be matched
+# with a single set lookup
+FOLD_FIELDS = ('saddr', 'daddr', 'sport', 'dport')
+ADDRESS_FOLD_FIELDS = ('saddr', 'daddr')
+
+
+class NftablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
+    """nftables driver for Firewall As A Service.
+
+    All firewall groups of a router namespace live in a single inet table.
+    Its forward chain dispatches the packets of firewall group ports with
+    verdict maps keyed by interface name to one chain per group and
+    direction, and drops the packets the group chains did not accept.
+    Consecutive rules with the same verdict which differ in a single address
+    or port are matched with one anonymous set. Each update of a group is
+    applied to a namespace with a single, atomic, nft transaction which only
+    changes the chains and port elements of that group, the groups already
+    in a table being loaded from it the first time its namespace is changed.
+    """
+
+    def __init__(self):
+        LOG.debug("Initializing fwaas nftables driver")
+        self.conntrack = conntrack_base.load_and_init_conntrack_driver()
+        self.execute = linux_utils.execute
+        # last applied firewall group, for conntrack cleanup on update
+        self.fwg_states = firewall_group_state.FirewallGroupStateStore(
+            cfg.CONF.fwaas.max_firewall_group_states)
+        # namespace -> firewall group ID -> applied ports and rules
+        self.namespaces = {}
+
+    def create_firewall_group(self, agent_mode, apply_list, firewall):
+        LOG.debug('Creating firewall %(fw_id)s for tenant %(tid)s',
+                  {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
+        try:
+            if firewall['admin_state_up']:
+                self._setup_firewall(agent_mode, apply_list, firewall)
+                self._remove_conntrack(agent_mode, apply_list, None,
+                                       firewall)
+                self.fwg_states.get_or_create(
+                    firewall['id']).firewall = dict(firewall)
+            else:
+                self.apply_default_policy(agent_mode, apply_list, firewall)
+        except (LookupError, RuntimeError):
+            # catch known library exceptions and raise Fwaas generic exception
+            LOG.exception("Failed to create firewall: %s", firewall['id'])
+            raise fw_ext.FirewallInternalDriverError(driver=FWAAS_DRIVER_NAME)
+
+    def delete_firewall_group(self, agent_mode, apply_list, firewall):
+        LOG.debug('Deleting firewall %(fw_id)s for tenant %(tid)s',
+                  {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
+        try:
+            self._setup_firewall(agent_mode, apply_list, firewall,
+                                 remove=True)
+            self.fwg_states.pop(firewall['id'])
+        except (LookupError, RuntimeError):
+            # catch known library exceptions and raise Fwaas generic exception
+            LOG.exception("Failed to delete firewall: %s", firewall['id'])
+            raise fw_ext.FirewallInternalDriverError(driver=FWAAS_DRIVER_NAME)
+
+    def update_firewall_group(self, agent_mode, apply_list, firewall):
+        LOG.debug('Updating firewall %(fw_id)s for tenant %(tid)s',
+                  {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
+        try:
+            state = self.fwg_states.get(firewall['id'])
+            pre_firewall = state.firewall if state else None
+            if firewall['admin_state_up']:
+                self._setup_firewall(agent_mode, apply_list, firewall)
+                self._remove_conntrack(agent_mode, apply_list, pre_firewall,
+                                       firewall)
+            else:
+                self.apply_default_policy(agent_mode, apply_list, firewall)
+            self.fwg_states.get_or_create(
+                firewall['id']).firewall = dict(firewall)
+        except (LookupError, RuntimeError):
+            # catch known library exceptions and raise Fwaas generic exception
+            LOG.exception("Failed to update firewall: %s", firewall['id'])
+            raise fw_ext.FirewallInternalDriverError(driver=FWAAS_DRIVER_NAME)
+
+    def apply_default_policy(self, agent_mode, apply_list, firewall):
+        LOG.debug('Applying firewall %(fw_id)s for tenant %(tid)s',
+                  {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
+        try:
+            self._setup_firewall(agent_mode, apply_list, firewall,
+                                 with_policy=False)
+        except (LookupError, RuntimeError):
+            # catch known library exceptions and raise Fwaas generic exception
+            LOG.exception(
+                "Failed to apply default policy on firewall: %s",
+                firewall['id'])
+            raise fw_ext.FirewallInternalDriverError(driver=FWAAS_DRIVER_NAME)
+
+    def _get_namespaces_with_if_prefix(self, agent_mode, ri):
+        """Gets the namespaces along with the if prefix to apply rules.
+
+        The namespaces and interface prefixes are the ones the iptables
+        driver programs, see IptablesFwaasDriver._get_ipt_mgrs_with_if_prefix.
+        """
+        if not ri.router.get('distributed'):
+            return [(ri.iptables_manager.namespace,
+                     iptables_fwaas_v2.INTERNAL_DEV_PREFIX)]
+        namespaces = []
+        if agent_mode == 'dvr_snat':
+            if ri.snat_iptables_manager:
+                namespaces.append((ri.snat_iptables_manager.namespace,
+                                   iptables_fwaas_v2.SNAT_INT_DEV_PREFIX))
+        if ri.rtr_fip_connect:
+            namespaces.append((ri.iptables_manager.namespace,
+                               iptables_fwaas_v2.ROUTER_2_FIP_DEV_PREFIX))
+        return namespaces
+
+    def _get_intf_name(self, if_prefix, port_id):
+        _name = "%s%s" % (if_prefix, port_id)
+        return _name[:iptables_fwaas_v2.MAX_INTF_NAME_LEN]
+
+    def _setup_firewall(self, agent_mode, apply_list, firewall,
+                        with_policy=True, remove=False):
+        fwid = firewall['id']
+        if with_policy and not remove:
+            rules = {
+                direction: self._compile_rules(
+                    firewall['%s_rule_list' % direction])
+                for direction in DIRECTIONS}
+        else:
+            rules = None
+        for ri, router_fw_ports in apply_list:
+            for namespace, if_prefix in self._get_namespaces_with_if_prefix(
+                    agent_mode, ri):
+                groups = self._get_groups(namespace)
+                group = groups.pop(fwid, None)
+                # every interface of a group has a port map element
+                unmapped = set(group['interfaces'] if group else [])
+                if not remove:
+                    ifnames = [self._get_intf_name(if_prefix, port)
+                               for port in router_fw_ports]
+                    # ports moved from another group
+                    for other in groups.values():
+                        unmapped.update(set(other['interfaces']).intersection(
+                            ifnames))
+                        other['interfaces'] = [
+                            ifname for ifname in other['interfaces']
+                            if ifname not in ifnames]
+                    groups[fwid] = {'interfaces': ifnames, 'rules': rules,
+                                    'loaded': False}
+                # groups left by a previous run of the agent are removed
+                # once they do not own any port anymore
+                stale = [group_id for group_id, group in groups.items()
+                         if group['loaded'] and not group['interfaces']]
+                for group_id in stale:
+                    del groups[group_id]
+                transaction = self._build_transaction(fwid, groups,
+                                                      unmapped, stale)
+                try:
+                    self._apply(namespace, transaction)
+                except Exception:
+                    with excutils.save_and_reraise_exception():
+                        # load the table again on next change
+                        del self.namespaces[namespace]
+                if not groups:
+                    del self.namespaces[namespace]
+
+    def _get_nft_cmd(self, namespace):
+        cmd = ['ip', 'netns', 'exec', namespace] if namespace else []
+        return cmd + ['nft']
+
+    def _apply(self, namespace, transaction):
+        self.execute(self._get_nft_cmd(namespace) + ['-f', '-'],
+                     process_input=transaction, run_as_root=True,
+                     check_exit_code=True, privsep_exec=True)
+
+    def _get_groups(self, namespace):
+        if namespace not in self.namespaces:
+            self.namespaces[namespace] = self._load_groups(namespace)
+        return self.namespaces[namespace]
+
+    def _load_groups(self, namespace):
+        """Read the firewall groups applied to a namespace from its table.
+
+        The table outlives the agent, so the groups and ports found in it
+        are those applied before the agent was restarted. Only the ports of
+        the groups are known, their rules are left as they are until the
+        groups are applied again.
+        """
+        output = self.execute(
+            self._get_nft_cmd(namespace) + ['-j', 'list', 'table'] +
+            TABLE.split(), run_as_root=True, check_exit_code=False,
+            log_fail_as_error=False, privsep_exec=True)
+        groups = {}
+        if not output:
+            # no table
+            return groups
+        chain_groups = {}
+        for direction in DIRECTIONS:
+            chain_groups[CHAIN_NAME_PREFIX[direction]] = {}
+        objects = jsonutils.loads(output).get('nftables', [])
+        for obj in objects:
+            prefix, sep, group_id = obj.get('chain', {}).get(
+                'name', '').partition('-')
+            if sep and prefix in chain_groups:
+                groups[group_id] = {'interfaces': [], 'rules': None,
+                                    'loaded': True}
+        for obj in objects:
+            if obj.get('map', {}).get('name') != PORT_MAPS[DIRECTIONS[0]]:
+                continue
+            for ifname, verdict in obj['map'].get('elem', []):
+                chain_name = verdict.get('jump', {}).get('target', '')
+                group = groups.get(chain_name.partition('-')[2])
+                if group is not None:
+                    group['interfaces'].append(ifname)
+        return groups
+
+    def _build_transaction(self, fwid, groups, unmapped, stale):
+        """Build the nft script applying the changes of fwid atomically.
+
+        groups holds every firewall group applied in the namespace. Only
+        the port map and set elements of the interfaces in unmapped, which
+        fwid owned or takes over from other groups, and of the interfaces
+        of fwid are changed. The chains of the groups in stale are deleted,
+        those of the other groups are left alone.
+        """
+        lines = ['add table %s' % TABLE]
+        if not groups:
+            lines.append('delete table %s' % TABLE)
+            return '\n'.join(lines) + '\n'
+
+        lines += [
+            'add chain %s %s { type filter hook forward priority 0 ; '
+            'policy accept ; }' % (TABLE, FORWARD_CHAIN),
+            'add map %s %s { type ifname : verdict ; }' % (
+                TABLE, INGRESS_MAP),
+            'add map %s %s { type ifname : verdict ; }' % (
+                TABLE, EGRESS_MAP),
+            'add set %s %s { type ifname ; }' % (TABLE, PORTS_SET),
+            'flush chain %s %s' % (TABLE, FORWARD_CHAIN),
+        ]
+        for direction in DIRECTIONS:
+            lines.append('add rule %s %s %s vmap @%s' % (
+                TABLE, FORWARD_CHAIN, NFT_DIR[direction],
+                PORT_MAPS[direction]))
+        for direction in DIRECTIONS:
+            lines.append('add rule %s %s %s @%s drop' % (
+                TABLE, FORWARD_CHAIN, NFT_DIR[direction], PORTS_SET))
+
+        if unmapped:
+            elements = ', '.join('"%s"' % ifname
+                                 for ifname in sorted(unmapped))
+            for direction in DIRECTIONS:
+                lines.append('delete element %s %s { %s }' % (
+                    TABLE, PORT_MAPS[direction], elements))
+        unused = unmapped.difference(*[group['interfaces']
+                                       for group in groups.values()])
+        if unused:
+            lines.append('delete element %s %s { %s }' % (
+                TABLE, PORTS_SET,
+                ', '.join('"%s"' % ifname for ifname in sorted(unused))))
+
+        group = groups.get(fwid)
+        for direction in DIRECTIONS:
+            chain_name = self._get_chain_name(fwid, direction)
+            lines.append('add chain %s %s' % (TABLE, chain_name))
+            lines.append('flush chain %s %s' % (TABLE, chain_name))
+            if group is None:
+                lines.append('delete chain %s %s' % (TABLE, chain_name))
+                continue
+            if group['rules'] is None:
+                # default policy: the ports set drops all the packets
+                continue
+            lines.append('add rule %s %s ct state invalid drop' % (
+                TABLE, chain_name))
+            lines.append('add rule %s %s ct state established,related '
+                         'accept' % (TABLE, chain_name))
+            for rule in group['rules'][direction]:
+                lines.append('add rule %s %s %s' % (TABLE, chain_name, rule))
+        for group_id in stale:
+            for direction in DIRECTIONS:
+                chain_name = self._get_chain_name(group_id, direction)
+                lines.append('flush chain %s %s' % (TABLE, chain_name))
+                lines.append('delete chain %s %s' % (TABLE, chain_name))
+
+        if group is not None and group['interfaces']:
+            for direction in DIRECTIONS:
+                elements = ', '.join(
+                    '"%s" : jump %s' % (ifname, self._get_chain_name(
+                        fwid, direction))
+                    for ifname in group['interfaces'])
+                lines.append('add element %s %s { %s }' % (
+                    TABLE, PORT_MAPS[direction], elements))
+            lines.append('add element %s %s { %s }' % (
+                TABLE, PORTS_SET,
+                ', '.join('"%s"' % ifname
+                          for ifname in group['interfaces'])))
+        return '\n'.join(lines) + '\n'
+
+    def _get_chain_name(self, fwid, direction):
+        return '%s-%s' % (CHAIN_NAME_PREFIX[direction], fwid)
+
+    def _compile_rules(self, rules):
+        """Convert a rule list into nft rule expressions.
+
+        Runs of consecutive rules which only differ in the value of the same
+        address or port are folded into a single rule matching a set. A rule
+        repeating a value of its run is dropped, as the run already matches
+        it, and a value overlapping another one of the run starts a new run,
+        as nft rejects sets with overlapping intervals.
+        """
+        runs = []
+        for rule in rules:
+            if not rule['enabled']:
+                continue
+            match = self._get_match(rule)
+            run = runs[-1] if runs else None
+            field = run and self._get_fold_field(run, match)
+            if field:
+                values = [run['match'][field]] + run['values']
+                if match[field] in values:
+                    continue
+                if not any(self._values_overlap(field, value, match[field])
+                           for value in values):
+                    run['field'] = field
+                    run['values'].append(match[field])
+                    continue
+            runs.append({'match': match, 'field': None,
+                         'values': []})
+        return [self._render_run(run) for run in runs]
+
+    def _get_match(self, rule):
+        protocol = rule.get('protocol')
+        if (protocol == constants.PROTO_NAME_ICMP and
+                rule.get('ip_version') == constants.IP_VERSION_6):
+            protocol = constants.PROTO_NAME_IPV6_ICMP
+        match = {'ip_version': rule.get('ip_version'),
+                 'protocol': protocol,
+                 'verdict': FWAAS_TO_NFT_VERDICT[rule.get('action')]}
+        for field, key in (('saddr', 'source_ip_address'),
+                           ('daddr', 'destination_ip_address')):
+            match[field] = (utils.ip_to_cidr(rule[key]) if rule.get(key)
+                            else None)
+        for field, key in (('sport', 'source_port'),
+                           ('dport', 'destination_port')):
+            port = rule.get(key)
+            if (protocol not in (constants.PROTO_NAME_TCP,
+                                 constants.PROTO_NAME_UDP) or
+                    port is None):
+                match[field] = None
+            else:
+                match[field] = str(port).replace(':', '-')
+        return match
+
+    def _get_fold_field(self, run, match):
+        base = run['match']
+        if run['field']:
+            fields = [run['field']]
+        else:
+            fields = [key for key in base if base[key] != match[key]]
+        if len(fields) != 1 or fields[0] not in FOLD_FIELDS:
+            return None
+        field = fields[0]
+        if any(base[key] != match[key] for key in base if key != field):
+            return None
+        if base[field] is None or match[field] is None:
+            return None
+        return field
+
+    def _values_overlap(self, field, value, other):
+        if field in ADDRESS_FOLD_FIELDS:
+            # prefixes are either nested or disjoint
+            value = netaddr.IPNetwork(value)
+            other = netaddr.IPNetwork(other)
+            return value in other or other in value
+        low, _sep, high = value.partition('-')
+        other_low, _sep, other_high = other.partition('-')
+        return (int(low) <= int(other_high or other_low) and
+                int(other_low) <= int(high or low))
+
+    def _render_run(self, run):
+        match = dict(run['match'])
+        if run['field']:
+            values = [match[run['field']]] + run['values']
+            match[run['field']] = '{ %s }' % ', '.join(values)
+        args = []
+        if match['ip_version'] in NFT_FAMILY:
+            args.append('meta nfproto %s' % NFT_FAMILY[match['ip_version']])
+        if match['protocol']:
+            args.append('meta l4proto %s' % match['protocol'])
+        addr_proto = NFT_ADDR_PROTO.get(match['ip_version'], 'ip')
+        for field in ('saddr', 'daddr'):
+            if match[field]:
+                args.append('%s %s %s' % (addr_proto, field, match[field]))
+        for field in ('sport', 'dport'):
+            if match[field]:
+                args.append('%s %s %s' % (match['protocol'], field,
+                                          match[field]))
+        args.append(match['verdict'])
+        return ' '.join(args)
+
+    def _remove_conntrack(self, agent_mode, apply_list, pre_firewall,
+                          firewall):
+        """Remove the conntrack entries the new rules could not allow."""
+        if pre_firewall:
+            diff = rule_diff.diff_firewall_rules(pre_firewall, firewall)
+            rules = diff.changed + diff.added + diff.removed
+        namespaces = set()
+        for ri, router_fw_ports in apply_list:
+            for namespace, if_prefix in self._get_namespaces_with_if_prefix(
+                    agent_mode, ri):
+                if namespace in namespaces:
+                    continue
+                namespaces.add(namespace)
+                if pre_firewall:
+                    self.conntrack.delete_entries(rules, namespace)
+                else:
+                    self.conntrack.flush_entries(namespace)
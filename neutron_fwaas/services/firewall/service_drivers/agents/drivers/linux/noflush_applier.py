@@ -0,0 +1,181 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import weakref
+
+from neutron.agent.linux import iptables_manager
+from neutron.agent.linux import utils as linux_utils
+from neutron_lib import exceptions
+from neutron_lib.utils import runtime
+from oslo_concurrency import lockutils
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+FORWARD_CHAIN = 'FORWARD'
+
+
+class NoflushApplier(object):
+    """Apply only the FWaaS chains of an iptables manager.
+
+    IptablesManager.defer_apply_off() saves and restores whole tables, with
+    the rules of every other user of the namespace, e.g. NAT and floating
+    IPs. This applier instead restores, with iptables-restore --noflush,
+    only the filter chains FWaaS owns, as told by is_owned_chain, and the
+    FORWARD rules jumping to them. It keeps what it last applied to each
+    iptables manager and only sends the chains which changed since then:
+    declaring a chain flushes it, so every changed chain is rewritten
+    entirely, from the in-memory rules of the manager, the top rules other
+    users like the logging driver add to them included. FORWARD is shared,
+    so the FWaaS rules are deleted from it and inserted back at their
+    position instead. Those positions are the ones of the in-memory rules
+    of the manager's FORWARD chain: they assume the chain in the kernel
+    holds those rules, in that order, as IptablesManager writes it on
+    every apply. FORWARD rules which other users changed in memory but did
+    not apply yet shift the FWaaS rules relative to theirs, and a position
+    past the end of the chain fails the restore, see below.
+
+    What is in iptables is only known once the whole tables were applied,
+    so the first apply to a manager, and any apply after a failure, falls
+    back to defer_apply_off(). Both run under the same lock.
+    """
+
+    def __init__(self, is_owned_chain):
+        self.is_owned_chain = is_owned_chain
+        # iptables manager -> {command: (chains, FORWARD rules)} last applied
+        self._applied = weakref.WeakKeyDictionary()
+
+    def apply(self, ipt_mgr):
+        lock_name = 'iptables'
+        if ipt_mgr.namespace:
+            lock_name += '-' + ipt_mgr.namespace
+        with lockutils.lock(lock_name, runtime.SYNCHRONIZED_PREFIX,
+                            external=ipt_mgr.external_lock):
+            applied = self._applied.pop(ipt_mgr, None)
+            if applied is not None and self._apply_owned_chains(ipt_mgr,
+                                                                applied):
+                return
+
+        if applied is None:
+            LOG.debug("Applying all iptables rules of namespace %s before "
+                      "applying its FWaaS chains only", ipt_mgr.namespace)
+        state = self._get_state(ipt_mgr)
+        ipt_mgr.defer_apply_off()
+        self._applied[ipt_mgr] = state
+
+    def _apply_owned_chains(self, ipt_mgr, applied):
+        state = self._get_state(ipt_mgr)
+        try:
+            for cmd, (chains, forward) in sorted(state.items()):
+                commands = self._build_commands(
+                    ipt_mgr.wrap_name, applied.get(cmd, ({}, [])),
+                    (chains, forward))
+                if commands:
+                    self._restore(ipt_mgr, cmd, commands)
+        except RuntimeError:
+            LOG.warning("Failed to apply the FWaaS chains of namespace %s, "
+                        "applying all of its iptables rules",
+                        ipt_mgr.namespace, exc_info=True)
+            return False
+        self._applied[ipt_mgr] = state
+        return True
+
+    def _get_state(self, ipt_mgr):
+        """Get the FWaaS chains and FORWARD rules of the filter tables.
+
+        :returns: {<command>: ({<chain>: [<rule>, ...]},
+                               [(<position in FORWARD>, <rule>), ...])}
+        """
+        tables = [('iptables', ipt_mgr.ipv4['filter'])]
+        if ipt_mgr.use_ipv6:
+            tables.append(('ip6tables', ipt_mgr.ipv6['filter']))
+        state = {}
+        for cmd, table in tables:
+            # the order IptablesManager writes the rules of a chain in
+            rules = ([rule for rule in table.rules if rule.top] +
+                     [rule for rule in table.rules if not rule.top])
+            chains = {name: [] for name in table.chains
+                      if self.is_owned_chain(name)}
+            forward = []
+            position = 0
+            for rule in rules:
+                if not rule.wrap:
+                    continue
+                if rule.chain in chains:
+                    chains[rule.chain].append(str(rule))
+                elif rule.chain == FORWARD_CHAIN:
+                    position += 1
+                    if self._is_owned_jump(ipt_mgr.wrap_name, rule.rule):
+                        forward.append((position, str(rule)))
+            state[cmd] = (chains, forward)
+        return state
+
+    def _is_owned_jump(self, wrap_name, rule):
+        args = rule.split()
+        for idx, arg in enumerate(args[:-1]):
+            target = args[idx + 1]
+            if (arg in ('-j', '-g') and
+                    target.startswith(wrap_name + '-') and
+                    self.is_owned_chain(target[len(wrap_name) + 1:])):
+                return True
+        return False
+
+    def _build_commands(self, wrap_name, applied, state):
+        old_chains, old_forward = applied
+        chains, forward = state
+        forward_chain = '%s-%s' % (wrap_name, FORWARD_CHAIN)
+
+        changed = sorted(name for name, rules in chains.items()
+                         if old_chains.get(name) != rules)
+        removed = sorted(name for name in old_chains if name not in chains)
+        if not changed and not removed and old_forward == forward:
+            return []
+
+        # declaring a chain creates it, or flushes it with --noflush
+        commands = ['*filter']
+        commands += [':%s-%s - [0:0]' % (wrap_name, name)
+                     for name in changed + removed]
+        if old_forward != forward:
+            commands += ['-D' + rule[2:] for _position, rule in old_forward]
+        for name in changed:
+            commands += chains[name]
+        if old_forward != forward:
+            commands += ['-I %s %d%s' % (forward_chain, position,
+                                         rule[len('-A ' + forward_chain):])
+                         for position, rule in forward]
+        commands += ['-X %s-%s' % (wrap_name, name) for name in removed]
+        commands += ['COMMIT', '']
+        return commands
+
+    def _restore(self, ipt_mgr, cmd, commands):
+        args = ['%s-restore' % cmd, '-n']
+        if ipt_mgr.namespace:
+            args = ['ip', 'netns', 'exec', ipt_mgr.namespace] + args
+        LOG.debug("Applying %(count)d iptables commands to the FWaaS chains "
+                  "of namespace %(ns)s",
+                  {'count': len(commands) - 3, 'ns': ipt_mgr.namespace})
+        # without, then with, the xtables lock as IptablesManager does
+        if not ipt_mgr.use_table_lock:
+            try:
+                linux_utils.execute(args, process_input='\n'.join(commands),
+                                    run_as_root=True, privsep_exec=True,
+                                    log_fail_as_error=False)
+                return
+            except exceptions.ProcessExecutionError as e:
+                if (e.returncode !=
+                        iptables_manager.XTABLES_RESOURCE_PROBLEM_CODE):
+                    raise
+        args = args + ['-w', ipt_mgr.xlock_wait_time,
+                       '-W', iptables_manager.XLOCK_WAIT_INTERVAL]
+        linux_utils.execute(args, process_input='\n'.join(commands),
+                            run_as_root=True, privsep_exec=True)
+        ipt_mgr.__class__.use_table_lock = True
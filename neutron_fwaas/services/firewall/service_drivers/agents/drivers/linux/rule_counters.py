@@ -0,0 +1,56 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Read the packet and byte counters of the iptables rules of a namespace.
+
+The whole filter table of a namespace is dumped at once with
+iptables-save -c, rather than listing chains one by one, so that reading
+the counters of all the firewall groups of a router costs a single command
+per IP version.
+"""
+
+import re
+
+from neutron.agent.linux import utils as linux_utils
+
+# [<packets>:<bytes>] -A <chain> <rule>
+COUNTED_RULE = re.compile(r'^\[(\d+):(\d+)\] -A (\S+) ?(.*)$')
+
+
+def parse_counters(save_output):
+    """Parse the rules of iptables-save -c output.
+
+    :returns: {<chain>: [(<rule>, <packets>, <bytes>), ...]} with the rules
+        of each chain in order
+    """
+    counters = {}
+    for line in save_output.splitlines():
+        match = COUNTED_RULE.match(line.strip())
+        if match is None:
+            continue
+        packets, bytes_, chain, rule = match.groups()
+        counters.setdefault(chain, []).append(
+            (rule, int(packets), int(bytes_)))
+    return counters
+
+
+def read_counters(namespace, cmd='iptables'):
+    """Dump and parse the counters of the filter table of a namespace.
+
+    :param cmd: 'iptables' or 'ip6tables'
+    :returns: see parse_counters()
+    """
+    args = ['%s-save' % cmd, '-c', '-t', 'filter']
+    if namespace:
+        args = ['ip', 'netns', 'exec', namespace] + args
+    return parse_counters(linux_utils.execute(args, run_as_root=True,
+                                              privsep_exec=True))
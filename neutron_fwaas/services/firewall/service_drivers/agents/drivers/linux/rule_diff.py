@@ -0,0 +1,68 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+
+RULE_LISTS = ('egress_rule_list', 'ingress_rule_list')
+
+RuleDiff = collections.namedtuple('RuleDiff', ['changed', 'added', 'removed'])
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(_freeze(v) for v in value)
+    return value
+
+
+def rule_fingerprint(rule):
+    """Return a hashable value which is equal for rules with equal content."""
+    return _freeze(rule)
+
+
+def diff_firewall_rules(pre_firewall, firewall):
+    """Diff the rules of two versions of a firewall group.
+
+    Rules are matched by ID across the egress and ingress rule lists and
+    compared by fingerprint, so the whole diff is a single pass over both
+    groups. changed holds the (old, new) rules of every modified rule,
+    flattened; added and removed hold the rules only present in firewall
+    and pre_firewall respectively. Each list is ordered egress first, then
+    ingress, following the rule order of the group the rules come from.
+    """
+    changed = []
+    added = []
+    removed = []
+    for rule_list in RULE_LISTS:
+        new_rules = {}
+        for rule in firewall[rule_list]:
+            new_rules.setdefault(rule.get('id'), []).append(
+                (rule, rule_fingerprint(rule)))
+        pre_rule_ids = set()
+        for pre_rule in pre_firewall[rule_list]:
+            rule_id = pre_rule.get('id')
+            pre_rule_ids.add(rule_id)
+            matches = new_rules.get(rule_id)
+            if not matches:
+                removed.append(pre_rule)
+                continue
+            pre_fingerprint = rule_fingerprint(pre_rule)
+            for rule, fingerprint in matches:
+                if fingerprint != pre_fingerprint:
+                    changed.append(pre_rule)
+                    changed.append(rule)
+        added.extend(rule for rule in firewall[rule_list]
+                     if rule.get('id') not in pre_rule_ids)
+    return RuleDiff(changed, added, removed)
@@ -0,0 +1,141 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Remove the firewall rules which can never match.
+
+Firewall rules are evaluated in order and the first matching rule wins, so
+a rule matching a subset of the packets an earlier rule matches is never
+hit, whatever its action. Duplicated rules are the simplest such case.
+Only the fields the L3 drivers match on are compared, and fields compared
+conservatively: a rule is only dropped when its match is provably covered,
+and rules are only told disjoint when no packet can provably match both.
+"""
+
+from neutron_lib import constants
+import netaddr
+
+# matched fields, a missing value matches anything
+ADDRESS_FIELDS = ('source_ip_address', 'destination_ip_address')
+PORT_FIELDS = ('source_port', 'destination_port')
+
+
+def _port_range(port):
+    if port is None:
+        return None
+    low, _sep, high = str(port).partition(':')
+    return int(low), int(high or low)
+
+
+def _covers_address(address, other):
+    if not address:
+        return True
+    if not other:
+        return False
+    return netaddr.IPNetwork(other) in netaddr.IPNetwork(address)
+
+
+def _covers_port(port, other):
+    port_range = _port_range(port)
+    if port_range is None:
+        return True
+    other_range = _port_range(other)
+    if other_range is None:
+        return False
+    return port_range[0] <= other_range[0] and other_range[1] <= port_range[1]
+
+
+def _protocol_number(protocol, ip_version):
+    """IP protocol number of a rule's protocol, None when it matches any."""
+    if protocol is None:
+        return None
+    protocol = str(protocol).lower()
+    try:
+        number = int(constants.IP_PROTOCOL_MAP.get(protocol, protocol))
+    except ValueError:
+        # unknown name, only equal to itself
+        return protocol
+    if number == 0:
+        return None
+    # the L3 drivers match ICMPv6 for 'icmp' rules of IPv6
+    if number == constants.PROTO_NUM_ICMP and (
+            ip_version == constants.IP_VERSION_6):
+        return constants.PROTO_NUM_IPV6_ICMP
+    return number
+
+
+def _overlaps_address(address, other):
+    if not address or not other:
+        return True
+    # prefixes are either nested or disjoint
+    address = netaddr.IPNetwork(address)
+    other = netaddr.IPNetwork(other)
+    return address in other or other in address
+
+
+def _overlaps_port(port, other):
+    port_range = _port_range(port)
+    other_range = _port_range(other)
+    if port_range is None or other_range is None:
+        return True
+    return port_range[0] <= other_range[1] and other_range[0] <= port_range[1]
+
+
+def disjoint(rule, other):
+    """Whether no packet can be matched by both rule and other."""
+    if rule.get('ip_version') != other.get('ip_version'):
+        return True
+    protocol = _protocol_number(rule.get('protocol'), rule.get('ip_version'))
+    other_protocol = _protocol_number(other.get('protocol'),
+                                      other.get('ip_version'))
+    if protocol is not None and other_protocol is not None and (
+            protocol != other_protocol):
+        return True
+    return not (all(_overlaps_address(rule.get(field), other.get(field))
+                    for field in ADDRESS_FIELDS) and
+                all(_overlaps_port(rule.get(field), other.get(field))
+                    for field in PORT_FIELDS))
+
+
+def covers(rule, other):
+    """Whether every packet other matches is matched by rule."""
+    if rule.get('ip_version') != other.get('ip_version'):
+        return False
+    protocol = rule.get('protocol')
+    if protocol is not None and (
+            str(protocol).lower() != str(other.get('protocol')).lower()):
+        return False
+    return (all(_covers_address(rule.get(field), other.get(field))
+                for field in ADDRESS_FIELDS) and
+            all(_covers_port(rule.get(field), other.get(field))
+                for field in PORT_FIELDS))
+
+
+def remove_shadowed_rules(rules):
+    """Remove the enabled rules an earlier enabled rule covers.
+
+    :returns: the remaining rules, in order, and the removed ones as
+        [(<removed rule>, <earlier rule covering it>), ...]
+    """
+    kept = []
+    removed = []
+    for rule in rules:
+        if not rule.get('enabled'):
+            kept.append(rule)
+            continue
+        shadowing = next((earlier for earlier in kept
+                          if earlier.get('enabled') and
+                          covers(earlier, rule)), None)
+        if shadowing is None:
+            kept.append(rule)
+        else:
+            removed.append((rule, shadowing))
+    return kept, removed
@@ -0,0 +1,51 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Move the most hit firewall rules ahead of the rules they are disjoint from.
+
+A packet goes through the rules of a chain until one matches, so the rules
+matching most packets are best placed first. Swapping two adjacent rules
+only keeps the first match of every packet when no packet matches both,
+see rule_optimizer.disjoint(). Rules are therefore only moved ahead of
+rules they are disjoint from, which keeps the order of any two rules which
+may match the same packet, and with it the verdict of every packet.
+"""
+
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import rule_optimizer
+
+
+def reorder_rules(rules, hits):
+    """Order rules by decreasing hits, as far as they are disjoint.
+
+    Each rule, in order, moves ahead of the preceding rules while they are
+    disjoint from it and were hit less. Rules hit as often keep their
+    order, so the order is stable when the hits do not change.
+
+    :param hits: {<rule ID>: <packets matched>}, rules missing are not hit
+    :returns: the reordered rules
+    """
+    ordered = []
+    for rule in rules:
+        count = hits.get(rule['id'], 0)
+        position = len(ordered)
+        while position > 0:
+            previous = ordered[position - 1]
+            if count <= hits.get(previous['id'], 0):
+                break
+            # disabled rules match no packet
+            if previous.get('enabled') and not rule_optimizer.disjoint(
+                    rule, previous):
+                break
+            position -= 1
+        ordered.insert(position, rule)
+    return ordered
@@ -15,6 +15,7 @@
 
 from neutron_lib import rpc as n_rpc
 from oslo_config import cfg
+from oslo_config import types
 import oslo_messaging
 
 from neutron_fwaas._i18n import _
@@ -45,7 +46,163 @@ FWaaSOpts = [
         'firewall_l2_driver',
         default=FW_L2_NOOP_DRIVER,
         help=_("Name of the firewall l2 driver")
-    )
+    ),
+    cfg.BoolOpt(
+        'incremental_apply',
+        default=False,
+        help=_("Program a firewall group update as a delta against the "
+               "iptables rules last applied for that group in each router "
+               "namespace, instead of removing and rebuilding all of the "
+               "group's chains. This only reduces the in-memory rebuild: "
+               "unless noflush_apply is also set, every update still "
+               "restores the whole filter, NAT and mangle tables of the "
+               "router namespace.")),
+    cfg.IntOpt(
+        'max_firewall_group_states',
+        default=1000,
+        min=1,
+        help=_("Maximum number of firewall groups whose last applied rules "
+               "are kept by the iptables driver. The least recently used "
+               "groups are forgotten beyond it, and their next update is "
+               "handled like a new firewall group.")),
+    cfg.FloatOpt(
+        'apply_coalesce_window',
+        default=0,
+        min=0,
+        help=_("Number of seconds the iptables driver waits before applying "
+               "the changes made to a router namespace, so that the changes "
+               "of other firewall groups on the same router made meanwhile "
+               "are applied with a single iptables-restore. 0 applies every "
+               "change immediately.")),
+    cfg.BoolOpt(
+        'enable_ipset',
+        default=False,
+        help=_("Make the iptables driver match runs of adjacent firewall "
+               "rules which only differ in their source or their "
+               "destination address with a single rule and an ipset of "
+               "the addresses.")),
+    cfg.BoolOpt(
+        'enable_multiport',
+        default=False,
+        help=_("Make the iptables driver match runs of adjacent TCP or UDP "
+               "firewall rules which only differ in their source or their "
+               "destination port with multiport rules of up to 15 ports.")),
+    cfg.IntOpt(
+        'chain_tree_min_rules',
+        default=0,
+        min=0,
+        help=_("Number of rules of an IP version and direction of a "
+               "firewall group from which the iptables driver splits them "
+               "into sub-chains by protocol, and by destination prefix for "
+               "protocols with that many rules, so that packets only go "
+               "through the rules which may match them. 0 disables it.")),
+    cfg.BoolOpt(
+        'optimize_rules',
+        default=False,
+        help=_("Make the iptables driver drop the firewall rules which an "
+               "earlier rule of the same list fully covers, as they can "
+               "never match, and skip the chains of an IP version a "
+               "firewall group has no rules for.")),
+    cfg.BoolOpt(
+        'interface_dispatch',
+        default=False,
+        help=_("Make the iptables driver dispatch forwarded packets to the "
+               "chains of the firewall groups of their interfaces through "
+               "chains keyed by the first characters of the port ID, "
+               "instead of a FORWARD rule per port, direction and chain. "
+               "The chains of the output interface of a packet are then "
+               "matched before those of its input interface.")),
+    cfg.BoolOpt(
+        'established_fast_path',
+        default=False,
+        help=_("Make the iptables driver accept the packets of established "
+               "and related sessions with a single rule per router "
+               "namespace, before the jumps to the chains of the firewall "
+               "groups, instead of at the head of every group chain.")),
+    cfg.BoolOpt(
+        'noflush_apply',
+        default=False,
+        help=_("Make the iptables driver apply its changes with "
+               "iptables-restore --noflush, restoring only its own chains "
+               "and FORWARD rules instead of the whole filter, NAT and "
+               "mangle tables of the router namespace.")),
+    cfg.IntOpt(
+        'namespace_workers',
+        default=1,
+        min=1,
+        help=_("Number of router namespaces the iptables driver programs "
+               "concurrently when a firewall group spans several of them, "
+               "e.g. the SNAT and FIP namespaces of DVR routers. The "
+               "changes of a namespace are always made in order.")),
+    cfg.StrOpt(
+        'rule_counters_file',
+        help=_("File the L3 agent periodically writes the packet and byte "
+               "counters of the firewall rules to, as JSON. The counters "
+               "are not written when unset.")),
+    cfg.IntOpt(
+        'rule_counters_interval',
+        default=60,
+        min=1,
+        help=_("Seconds between two writes of rule_counters_file, and "
+               "between two checks of the rule order with "
+               "reorder_rules_by_hits.")),
+    cfg.BoolOpt(
+        'reorder_rules_by_hits',
+        default=False,
+        help=_("Move the firewall rules matching the most packets ahead of "
+               "the rules they can not match a packet in common with, "
+               "using the packet counters the iptables driver reads every "
+               "rule_counters_interval seconds. Rules which may match the "
+               "same packets always keep their order, so the verdict of "
+               "every packet is unchanged. Firewall groups are re-applied "
+               "when their order changes.")),
+    cfg.IntOpt(
+        'reject_rate_limit',
+        default=0,
+        min=0,
+        help=_("Number of packets per second of each router namespace the "
+               "iptables driver answers with an ICMP unreachable for "
+               "firewall rules with the reject action. The packets beyond "
+               "the limit are silently dropped. 0 rejects every packet.")),
+    cfg.IntOpt(
+        'reject_rate_burst',
+        default=10,
+        min=1,
+        help=_("Number of packets rejected in a row before "
+               "reject_rate_limit applies.")),
+    cfg.Opt(
+        'reject_rate_limits',
+        type=types.Dict(value_type=types.Integer(min=0)),
+        default={},
+        help=_("reject_rate_limit of specific routers, as router ID:limit "
+               "pairs, e.g. 'd6bd8f33-0f6e-4a55-9b0e-0a2b6a2c4f3b:0' to "
+               "reject every packet on that router.")),
+    cfg.IntOpt(
+        'compiled_rule_cache_size',
+        default=4096,
+        min=0,
+        help=_("Number of iptables rules compiled from firewall rules the "
+               "iptables driver keeps, so that the rules of policies "
+               "applied to many routers, or left unchanged by an update, "
+               "are not compiled again. 0 disables the cache.")),
+    cfg.BoolOpt(
+        'share_policy_chains',
+        default=False,
+        help=_("Make the firewall groups of a router which use the same "
+               "version of a policy jump to a single copy of its chains, "
+               "named after the policy ID and a digest of its rules, "
+               "instead of each group having its own copy. The chains are "
+               "removed once no group of the router uses them. Requires "
+               "incremental_apply.")),
+    cfg.BoolOpt(
+        'conntrack_rule_filters',
+        default=False,
+        help=_("Make the conntrack driver delete the connections matching "
+               "changed firewall rules with a conntrack -D filtering them "
+               "by family, protocol and ports per rule, or per port of "
+               "small port ranges, instead of listing all the connections "
+               "of the router and deleting them one by one. Rules which "
+               "can not be expressed as such filters still are.")),
 ]
 cfg.CONF.register_opts(FWaaSOpts, 'fwaas')
 
@@ -13,6 +13,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
+import os
+
 from neutron.agent.linux import ip_lib
 from neutron_lib.agent import l3_extension
 from neutron_lib import constants as nl_constants
@@ -22,6 +25,8 @@ from neutron_lib import rpc as n_rpc
 from oslo_config import cfg
 from oslo_log import helpers as log_helpers
 from oslo_log import log as logging
+from oslo_service import loopingcall
+from oslo_utils import timeutils
 
 from neutron_fwaas.common import fwaas_constants
 from neutron_fwaas.common import resources as f_resources
@@ -121,6 +126,14 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
             # NOTE: Temp location for creating service and loading driver
             self.fw_service = firewall_service.FirewallService()
             self.fwaas_driver = self.fw_service.load_device_drivers()
+            if (cfg.CONF.fwaas.rule_counters_file or
+                    cfg.CONF.fwaas.reorder_rules_by_hits):
+                interval = cfg.CONF.fwaas.rule_counters_interval
+                self._rule_counters_loop = (
+                    loopingcall.FixedIntervalLoopingCall(
+                        self._process_rule_counters))
+                self._rule_counters_loop.start(interval=interval,
+                                               initial_delay=interval)
 
         self.services_sync_needed = False
         self.fwplugin_rpc = FWaaSL3PluginApi(fwaas_constants.FIREWALL_PLUGIN,
@@ -440,49 +453,41 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
             else:
                 status = nl_constants.DOWN
 
-            # Call the driver.
+        # Handle the add router and/or rule, policy, firewall group attribute
+        # updates.
+        if status != nl_constants.INACTIVE and add_fwg_ports:
+            fw_ports = [p for ri_port in add_fwg_ports for p in ri_port[1]]
+            LOG.debug("Update (create) firewall group %(fwg_id)s on "
+                      "ports: %(ports)s",
+                      {'fwg_id': firewall_group['id'],
+                       'ports': ', '.join(fw_ports)})
+
+            # Set firewall group status, which will be overwritten if call
+            # to driver fails.
+            if firewall_group['admin_state_up']:
+                status = nl_constants.ACTIVE
+            else:
+                status = nl_constants.DOWN
+        else:
+            add_fwg_ports = []
+            if not status:
+                # if status not set by now, set it to INACTIVE
+                status = nl_constants.INACTIVE
+
+        # Call the driver once for the removed and added ports, so that it
+        # can only move the group between ports when its policy is
+        # unchanged.
+        if del_fwg_ports or add_fwg_ports:
             try:
-                self.fwaas_driver.delete_firewall_group(self.conf.agent_mode,
-                                                        del_fwg_ports,
-                                                        firewall_group)
+                self.fwaas_driver.update_firewall_group_ports(
+                    self.conf.agent_mode, add_fwg_ports, del_fwg_ports,
+                    firewall_group)
             except fw_ext.FirewallInternalDriverError:
                 msg = ("FWaaS driver error in update_firewall_group "
-                       "(add) for firewall group: %s")
+                       "for firewall group: %s")
                 LOG.exception(msg, firewall_group['id'])
                 status = nl_constants.ERROR
 
-        # Handle the add router and/or rule, policy, firewall group attribute
-        # updates.
-        if status not in (nl_constants.ERROR, nl_constants.INACTIVE):
-            if add_fwg_ports:
-                fw_ports = [p for ri_port in add_fwg_ports
-                            for p in ri_port[1]]
-                LOG.debug("Update (create) firewall group %(fwg_id)s on "
-                          "ports: %(ports)s",
-                          {'fwg_id': firewall_group['id'],
-                           'ports': ', '.join(fw_ports)})
-
-                # Set firewall group status, which will be overwritten if call
-                # to driver fails.
-                if firewall_group['admin_state_up']:
-                    status = nl_constants.ACTIVE
-                else:
-                    status = nl_constants.DOWN
-
-                # Call the driver.
-                try:
-                    self.fwaas_driver.update_firewall_group(
-                            self.conf.agent_mode, add_fwg_ports,
-                            firewall_group)
-                except fw_ext.FirewallInternalDriverError:
-                    msg = ("FWaaS driver error in update_firewall_group "
-                           "for firewall group: %s")
-                    LOG.exception(msg, firewall_group['id'])
-                    status = nl_constants.ERROR
-            elif not status:
-                # if status not set by now, set it to INACTIVE
-                status = nl_constants.INACTIVE
-
         # Return status to plugin.
         try:
             self.fwplugin_rpc.set_firewall_group_status(context,
@@ -541,6 +546,67 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
     def ha_state_change(self, context, data):
         pass
 
+    def get_rule_counters(self):
+        """Get the packet and byte counters of the firewall rules.
+
+        See FwaasDriverBase.get_rule_counters().
+        """
+        if not self.fwaas_enabled:
+            return []
+        return self.fwaas_driver.get_rule_counters()
+
+    def get_reject_counters(self):
+        """Get the packets rejected and dropped over the reject rate limit.
+
+        See FwaasDriverBase.get_reject_counters().
+        """
+        if not self.fwaas_enabled:
+            return []
+        return self.fwaas_driver.get_reject_counters()
+
+    def _process_rule_counters(self):
+        """Read the rule counters, write them and reorder the rules."""
+        try:
+            counters = self.get_rule_counters()
+        except Exception:
+            LOG.exception("Failed to read the firewall rule counters")
+            return
+        if cfg.CONF.fwaas.rule_counters_file:
+            try:
+                rejects = self.get_reject_counters()
+            except Exception:
+                LOG.exception("Failed to read the firewall reject counters")
+                rejects = []
+            self._write_rule_counters(
+                counters, rejects, self.fwaas_driver.get_compile_cache_stats())
+        if cfg.CONF.fwaas.reorder_rules_by_hits:
+            try:
+                self.fwaas_driver.apply_rule_hit_order()
+            except Exception:
+                LOG.exception("Failed to reorder the firewall rules by "
+                              "their hits")
+
+    def _write_rule_counters(self, counters, rejects=None,
+                             compile_cache=None):
+        """Write a snapshot of the rule counters to rule_counters_file.
+
+        The snapshot is written next to the file first and then renamed,
+        so that readers never see a partial snapshot.
+        """
+        path = cfg.CONF.fwaas.rule_counters_file
+        try:
+            snapshot = {'timestamp': timeutils.utcnow().isoformat(),
+                        'rules': counters,
+                        'rejects': rejects or [],
+                        'compile_cache': compile_cache or {}}
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+            os.replace(tmp_path, path)
+        except Exception:
+            LOG.exception("Failed to write the firewall rule counters to %s",
+                          path)
+
 
 class L3WithFWaaS(FWaaSL3AgentExtension):
 
@@ -0,0 +1,85 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from neutron_fwaas.cmd import compile_firewall
+from neutron_fwaas.tests import base
+
+FAKE_FW_ID = 'fake-fw-uuid'
+FAKE_PORT_IDS = ['1_fake-port-uuid', '2_fake-port-uuid']
+
+
+class TestCompileFirewall(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestCompileFirewall, self).setUp()
+        self.execute = mock.patch(
+            'neutron.agent.linux.utils.execute').start()
+
+    def _firewall(self, count):
+        rules = [{'id': 'rule-%d' % idx,
+                  'enabled': True,
+                  'ip_version': 4,
+                  'protocol': ['tcp', 'udp'][idx % 2],
+                  'destination_port': str(1000 + idx),
+                  'action': 'allow'} for idx in range(count)]
+        return {'id': FAKE_FW_ID,
+                'tenant_id': 'tenant-uuid',
+                'admin_state_up': True,
+                'ports': FAKE_PORT_IDS,
+                'ingress_rule_list': rules,
+                'egress_rule_list': []}
+
+    def _compile(self, firewall):
+        driver, ipt_mgr, elapsed = compile_firewall.compile_firewall(
+            firewall, FAKE_PORT_IDS)
+        self.assertGreaterEqual(elapsed, 0)
+        return driver, ipt_mgr
+
+    def test_save_table(self):
+        driver, ipt_mgr = self._compile(self._firewall(2))
+        lines = compile_firewall.save_table(
+            ipt_mgr.ipv4['filter']).replace(ipt_mgr.wrap_name, 'bin')
+        lines = lines.split('\n')
+        self.assertEqual('*filter', lines[0])
+        self.assertEqual('COMMIT', lines[-1])
+        self.assertIn(':bin-iv4fake-fw- - [0:0]', lines)
+        self.assertIn('-A bin-iv4fake-fw- -p udp -m udp --dport 1001 '
+                      '-j bin-accepted', lines)
+        self.assertIn('-A bin-FORWARD -o qr-2_fake-port -j bin-iv4fake-fw-',
+                      lines)
+        # nothing is run on the host
+        self.execute.assert_not_called()
+
+    def test_metrics(self):
+        firewall = self._firewall(4)
+        driver, ipt_mgr = self._compile(firewall)
+        metrics = compile_firewall.get_metrics(driver, ipt_mgr, firewall,
+                                               FAKE_PORT_IDS)
+        # accepted, dropped, rejected, default and the 2 group chains
+        self.assertEqual(6, metrics[4]['chains'])
+        # 2 x 2 group preambles, 4 rules, 4 rules of the other chains and
+        # 8 FORWARD jumps
+        self.assertEqual(20, metrics[4]['rules'])
+        # second ingress jump of FORWARD, then the whole ingress chain
+        self.assertEqual(2 + 6, metrics[4]['depth'])
+
+    def test_metrics_of_chain_tree(self):
+        self.config(group='fwaas', chain_tree_min_rules=2)
+        firewall = self._firewall(4)
+        driver, ipt_mgr = self._compile(firewall)
+        metrics = compile_firewall.get_metrics(driver, ipt_mgr, firewall,
+                                               FAKE_PORT_IDS)
+        self.assertEqual(8, metrics[4]['chains'])
+        # preamble, 2 protocol gotos, then the 2 rules of the protocol
+        self.assertEqual(2 + 2 + 2 + 2, metrics[4]['depth'])
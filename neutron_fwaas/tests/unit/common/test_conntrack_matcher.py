@@ -0,0 +1,124 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import socket
+
+from neutron_fwaas.common import conntrack_matcher
+from neutron_fwaas.tests import base
+
+
+def _filter(ip_version=4, protocol=None, sport=None, dport=None, src=None,
+            dst=None):
+    return (ip_version, protocol, sport, dport, src, dst)
+
+
+class NormalizeFilterTestCase(base.BaseTestCase):
+
+    def test_normalize_filter(self):
+        normalize = conntrack_matcher.normalize_filter
+        self.assertEqual((4, None, None, None, None, None),
+                         normalize((4, [], [], [], [], [])))
+        self.assertEqual((6, 'icmpv6', None, None, None, None),
+                         normalize((6, 'ipv6-icmp', [], [], [], [])))
+        self.assertEqual(
+            (4, 'tcp', [22, 22], [10, 20], '10.0.0.0/24', None),
+            normalize((4, 'tcp', ['22', '22'], ['20', '10'], '10.0.0.0/24',
+                       None)))
+
+    def test_normalize_filter_without_addresses(self):
+        self.assertEqual(
+            (4, 'udp', [53, 53], None, None, None),
+            conntrack_matcher.normalize_filter((4, 'udp', ['53'], [])))
+
+
+class ConntrackMatcherTestCase(base.BaseTestCase):
+
+    def test_match_protocol(self):
+        matcher = conntrack_matcher.ConntrackMatcher(
+            [_filter(protocol='tcp'), _filter(6)])
+        self.assertTrue(matcher.match(4, 'tcp', 1, 2))
+        self.assertFalse(matcher.match(4, 'udp', 1, 2))
+        self.assertTrue(matcher.match(6, 'udp', 1, 2))
+        self.assertFalse(matcher.needs_addresses)
+
+    def test_match_overlapping_port_ranges(self):
+        # entries between the two ranges were missed by the merge scans
+        # of the filters sorted by ranges
+        matcher = conntrack_matcher.ConntrackMatcher(
+            [_filter(protocol='tcp', dport=[0, 100]),
+             _filter(protocol='tcp', dport=[20, 30]),
+             _filter(protocol='tcp', sport=[5, 5], dport=[150, 200])])
+        for dport in (0, 25, 50, 100):
+            self.assertTrue(matcher.match(4, 'tcp', 1, dport))
+        self.assertFalse(matcher.match(4, 'tcp', 1, 101))
+        self.assertFalse(matcher.match(4, 'tcp', 1, 150))
+        self.assertTrue(matcher.match(4, 'tcp', 5, 150))
+        self.assertTrue(matcher.match(4, 'tcp', 5, 200))
+        self.assertFalse(matcher.match(4, 'tcp', 5, 201))
+
+    def test_match_icmp_type_and_code(self):
+        matcher = conntrack_matcher.ConntrackMatcher(
+            [_filter(protocol='icmp')])
+        self.assertTrue(matcher.match_entry(
+            (4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234)))
+        self.assertFalse(matcher.match_entry(
+            (4, 'tcp', 8, 0, '1.1.1.1', '2.2.2.2')))
+
+    def test_match_addresses(self):
+        matcher = conntrack_matcher.ConntrackMatcher(
+            [_filter(protocol='tcp', src='10.0.0.0/24'),
+             _filter(protocol='tcp', dport=[22, 22], src='10.0.0.0/16',
+                     dst='192.168.0.1')])
+        self.assertTrue(matcher.needs_addresses)
+        self.assertTrue(matcher.match(4, 'tcp', 1, 80, '10.0.0.1',
+                                      '8.8.8.8'))
+        self.assertFalse(matcher.match(4, 'tcp', 1, 80, '10.0.1.1',
+                                       '8.8.8.8'))
+        self.assertTrue(matcher.match(4, 'tcp', 1, 22, '10.0.1.1',
+                                      '192.168.0.1'))
+        self.assertFalse(matcher.match(4, 'tcp', 1, 22, '10.0.1.1',
+                                       '192.168.0.2'))
+        self.assertFalse(matcher.match(4, 'tcp', 1, 22, '10.1.0.1',
+                                       '192.168.0.1'))
+
+    def test_match_destination_nat(self):
+        matcher = conntrack_matcher.ConntrackMatcher(
+            [_filter(protocol='tcp', dst='10.0.0.6')])
+        # connection to the floating IP of 10.0.0.6
+        self.assertTrue(matcher.match_entry(
+            (4, 'tcp', 1, 22, '8.8.8.8', '172.24.4.10', '10.0.0.6')))
+        self.assertFalse(matcher.match_entry(
+            (4, 'tcp', 1, 22, '8.8.8.8', '172.24.4.10', '10.0.0.7')))
+        self.assertFalse(matcher.match_entry(
+            (4, 'tcp', 1, 22, '8.8.8.8', '172.24.4.10')))
+
+    def test_match_packed_ipv6_addresses(self):
+        matcher = conntrack_matcher.ConntrackMatcher(
+            [_filter(6, 'icmpv6', src='2001:db8::/64')])
+        self.assertTrue(matcher.match(
+            6, 'icmpv6', 128, 0,
+            socket.inet_pton(socket.AF_INET6, '2001:db8::5'),
+            socket.inet_pton(socket.AF_INET6, '2001:db8:1::5')))
+        self.assertFalse(matcher.match(
+            6, 'icmpv6', 128, 0,
+            socket.inet_pton(socket.AF_INET6, '2001:db8:1::5'),
+            socket.inet_pton(socket.AF_INET6, '2001:db8::5')))
+
+    def test_match_many_filters(self):
+        filters = [_filter(protocol='tcp', dport=[port, port],
+                           dst='10.0.%d.0/24' % (port % 256))
+                   for port in range(1000, 1500)]
+        matcher = conntrack_matcher.ConntrackMatcher(filters)
+        self.assertTrue(matcher.match(4, 'tcp', 1, 1300, '1.1.1.1',
+                                      '10.0.20.1'))
+        self.assertFalse(matcher.match(4, 'tcp', 1, 1300, '1.1.1.1',
+                                       '10.0.21.1'))
@@ -13,14 +13,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import ctypes
+import socket
 from unittest import mock
 
 import testtools
 
 from neutron_lib import constants
 
+from neutron_fwaas import privileged
 from neutron_fwaas.privileged import netlink_constants as nl_constants
 from neutron_fwaas.privileged import netlink_lib as nl_lib
+from neutron_fwaas.privileged import utils as fwaas_utils
 from neutron_fwaas.tests import base
 
 
@@ -43,6 +47,11 @@ class NetlinkLibTestCase(base.BaseTestCase):
         super(NetlinkLibTestCase, self).setUp()
         nl_lib.nfct = mock.Mock()
         nl_lib.libc = mock.Mock()
+        conntrack_handlers = fwaas_utils.NamespaceCache(
+            nl_lib._open_conntrack_handler, nl_lib._close_conntrack_handler)
+        self.addCleanup(conntrack_handlers.clear)
+        mock.patch.object(nl_lib, '_conntrack_handlers',
+                          conntrack_handlers).start()
 
     def test_open_new_conntrack_handler_failed(self):
         nl_lib.nfct.nfct_open.return_value = None
@@ -64,6 +73,210 @@ class NetlinkLibTestCase(base.BaseTestCase):
             nl_lib.nfct.nfct_query.assert_called_once()
         nl_lib.nfct.nfct_close.assert_called_once()
 
+    def _dump_entry(self, ipversion, attrs, src, dst):
+        family = nl_constants.IPVERSION_SOCKET[ipversion]
+        addrs = {
+            nl_lib.TARGET['src'][ipversion]: ctypes.create_string_buffer(
+                socket.inet_pton(family, src)),
+            nl_lib.TARGET['dst'][ipversion]: ctypes.create_string_buffer(
+                socket.inet_pton(family, dst))}
+        nl_lib.nfct.nfct_get_attr.side_effect = (
+            lambda ct, attr: ctypes.addressof(addrs[attr]))
+        nl_lib.nfct.nfct_get_attr_u8.side_effect = (
+            lambda ct, attr: attrs[attr])
+        # ports and ICMP IDs are read in network byte order
+        nl_lib.nfct.nfct_get_attr_u16.side_effect = (
+            lambda ct, attr: socket.htons(attrs[attr]))
+
+        def dump(handler, query_type, data):
+            callback = nl_lib.nfct.nfct_callback_register.call_args[0][2]
+            callback(nl_constants.NFCT_T_ALL, None, None)
+
+        nl_lib.nfct.nfct_query.side_effect = dump
+        with nl_lib.ConntrackManager(family) as conntrack:
+            return conntrack.list_entries()
+
+    def test_conntrack_list_entries_packs_attributes(self):
+        attrs = {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_TCP,
+                 nl_constants.ATTR_PORT_SRC: 1,
+                 nl_constants.ATTR_PORT_DST: 5000}
+        entries = self._dump_entry(4, attrs, '1.1.1.1', '2.2.2.2')
+        self.assertEqual(nl_lib.ENTRY_STRUCTS[4].size, len(entries))
+        self.assertEqual([(4, 'tcp', 1, 5000, '1.1.1.1', '2.2.2.2')],
+                         nl_lib.unpack_entries(entries, 4))
+        nl_lib.nfct.nfct_snprintf.assert_not_called()
+
+    def test_conntrack_list_entries_packs_icmpv6(self):
+        attrs = {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_IPV6_ICMP,
+                 nl_constants.ATTR_ICMP_TYPE: 128,
+                 nl_constants.ATTR_ICMP_CODE: 0,
+                 nl_constants.ATTR_ICMP_ID: 3456}
+        entries = self._dump_entry(6, attrs, '10::10', '20::20')
+        self.assertEqual([(6, 'icmpv6', 128, 0, '10::10', '20::20', 3456)],
+                         nl_lib.unpack_entries(entries, 6))
+
+    def test_conntrack_list_entries_skips_other_protocols(self):
+        attrs = {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_SCTP}
+        self.assertEqual(b'', self._dump_entry(4, attrs, '1.1.1.1',
+                                               '2.2.2.2'))
+
+    def _delete_matching(self, rule_filters, entries, failing=()):
+        nl_lib.nfct.nfct_get_attr_u8.side_effect = (
+            lambda ct, attr: entries[ct][attr])
+        nl_lib.nfct.nfct_get_attr_u16.side_effect = (
+            lambda ct, attr: socket.htons(entries[ct][attr]))
+        nl_lib.nfct.nfct_clone.side_effect = lambda ct: ct + 100
+
+        def query(handler, query_type, data):
+            if query_type != nl_constants.NFCT_Q_DUMP:
+                return -1 if data in failing else 0
+            callback = nl_lib.nfct.nfct_callback_register.call_args[0][2]
+            for ct in entries:
+                callback(nl_constants.NFCT_T_ALL, ct, None)
+            return 0
+
+        nl_lib.nfct.nfct_query.side_effect = query
+        with nl_lib.ConntrackManager() as conntrack:
+            return conntrack.delete_matching_entries(rule_filters)
+
+    def test_conntrack_delete_matching_entries(self):
+        entries = {
+            1: {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_TCP,
+                nl_constants.ATTR_PORT_SRC: 1000,
+                nl_constants.ATTR_PORT_DST: 22},
+            2: {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_TCP,
+                nl_constants.ATTR_PORT_SRC: 1000,
+                nl_constants.ATTR_PORT_DST: 80},
+            3: {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_ICMP,
+                nl_constants.ATTR_ICMP_TYPE: 8,
+                nl_constants.ATTR_ICMP_CODE: 0},
+            4: {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_UDP,
+                nl_constants.ATTR_PORT_SRC: 1000,
+                nl_constants.ATTR_PORT_DST: 22},
+            5: {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_SCTP}}
+        self.assertEqual(
+            (5, 2, 1),
+            self._delete_matching([(4, 'tcp', None, [20, 30], None, None),
+                                   (4, 'icmp', None, None, None, None)],
+                                  entries, failing=(103,)))
+        destroy_queries = [
+            mock_call for mock_call in nl_lib.nfct.nfct_query.call_args_list
+            if mock_call[0][1] == nl_constants.NFCT_Q_DESTROY]
+        self.assertEqual([101, 103],
+                         [mock_call[0][2] for mock_call in destroy_queries])
+        nl_lib.nfct.nfct_destroy.assert_has_calls([mock.call(101),
+                                                   mock.call(103)])
+
+    def test_conntrack_delete_matching_entries_of_any_protocol(self):
+        entries = {
+            1: {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_UDP,
+                nl_constants.ATTR_PORT_SRC: 53,
+                nl_constants.ATTR_PORT_DST: 1000},
+            2: {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_ICMP,
+                nl_constants.ATTR_ICMP_TYPE: 8,
+                nl_constants.ATTR_ICMP_CODE: 0}}
+        self.assertEqual(
+            (2, 2, 2),
+            self._delete_matching([(4, None, None, None, None, None)],
+                                  entries))
+        nl_lib.nfct.nfct_get_attr.assert_not_called()
+
+    def test_conntrack_delete_matching_entries_by_address(self):
+        addrs = {}
+        entries = {}
+        for ct, (src, dst, reply_src) in enumerate([
+                ('10.0.0.5', '8.8.8.8', '8.8.8.8'),
+                ('10.0.1.5', '8.8.8.8', '8.8.8.8'),
+                # to a floating IP of 10.0.0.6
+                ('8.8.8.8', '172.24.4.10', '10.0.0.6')], 1):
+            entries[ct] = {nl_constants.ATTR_L4PROTO: constants.PROTO_NUM_TCP,
+                           nl_constants.ATTR_PORT_SRC: 1000,
+                           nl_constants.ATTR_PORT_DST: 22}
+            for attr, address in [(nl_constants.ATTR_IPV4_SRC, src),
+                                  (nl_constants.ATTR_IPV4_DST, dst),
+                                  (nl_constants.ATTR_REPL_IPV4_SRC,
+                                   reply_src)]:
+                addrs[ct, attr] = ctypes.create_string_buffer(
+                    socket.inet_pton(socket.AF_INET, address))
+        nl_lib.nfct.nfct_get_attr.side_effect = (
+            lambda ct, attr: ctypes.addressof(addrs[ct, attr]))
+        self.assertEqual(
+            (3, 2, 2),
+            self._delete_matching(
+                [(4, 'tcp', None, None, '10.0.0.0/24', None),
+                 (4, 'tcp', None, [22, 22], None, '10.0.0.6')], entries))
+        nl_lib.nfct.nfct_clone.assert_has_calls([mock.call(1),
+                                                 mock.call(3)])
+
+    def test_delete_entries_by_filters(self):
+        privileged.default.set_client_mode(False)
+        self.addCleanup(privileged.default.set_client_mode, True)
+        with mock.patch.object(nl_lib, 'ConntrackManager') as manager:
+            conntrack = manager.return_value.__enter__.return_value
+            conntrack.delete_matching_entries.return_value = (10, 2, 2)
+            stats = nl_lib.delete_entries_by_filters(
+                [(6, 'tcp', None, [22, 22], None, None)], namespace=None)
+        # only the families with filters are dumped
+        manager.assert_called_once_with(nl_constants.IPVERSION_SOCKET[6],
+                                        nl_lib.nfct.nfct_open.return_value)
+        conntrack.delete_matching_entries.assert_called_once_with(
+            [(6, 'tcp', None, [22, 22], None, None)])
+        self.assertEqual({'dumped': 10, 'matched': 2, 'deleted': 2},
+                         {key: value for key, value in stats.items()
+                          if key != 'duration'})
+        self.assertGreaterEqual(stats['duration'], 0)
+
+    def test_entrypoints_reuse_conntrack_handler(self):
+        privileged.default.set_client_mode(False)
+        self.addCleanup(privileged.default.set_client_mode, True)
+        nl_lib.flush_entries()
+        nl_lib.dump_entries()
+        nl_lib.delete_entries([(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')])
+        nl_lib.nfct.nfct_open.assert_called_once()
+        nl_lib.nfct.nfct_close.assert_not_called()
+        # a callback per dumped family is unregistered with the manager
+        self.assertEqual(5,
+                         nl_lib.nfct.nfct_callback_unregister.call_count)
+
+    def test_entrypoint_failure_closes_conntrack_handler(self):
+        privileged.default.set_client_mode(False)
+        self.addCleanup(privileged.default.set_client_mode, True)
+        nl_lib.nfct.nfct_query.side_effect = [RuntimeError, 0, 0]
+        self.assertRaises(RuntimeError, nl_lib.flush_entries)
+        nl_lib.nfct.nfct_close.assert_called_once_with(
+            nl_lib.nfct.nfct_open.return_value)
+        nl_lib.flush_entries()
+        self.assertEqual(2, nl_lib.nfct.nfct_open.call_count)
+
+    def test_entrypoint_in_unnamed_namespace(self):
+        privileged.default.set_client_mode(False)
+        self.addCleanup(privileged.default.set_client_mode, True)
+        with mock.patch.object(fwaas_utils, '_get_namespace_id',
+                               side_effect=FileNotFoundError), \
+                mock.patch.object(fwaas_utils, 'in_namespace') as in_ns:
+            nl_lib.flush_entries('fake-namespace')
+        in_ns.assert_any_call('fake-namespace')
+        # a handler per family, closed after use
+        self.assertEqual(2, nl_lib.nfct.nfct_open.call_count)
+        self.assertEqual(2, nl_lib.nfct.nfct_close.call_count)
+
+    def test_list_entries(self):
+        tcp = nl_lib.ENTRY_STRUCTS[4].pack(
+            constants.PROTO_NUM_TCP, 1, 2, 0, 0, 0,
+            socket.inet_pton(socket.AF_INET, '1.1.1.1'),
+            socket.inet_pton(socket.AF_INET, '2.2.2.2'))
+        icmp = nl_lib.ENTRY_STRUCTS[4].pack(
+            constants.PROTO_NUM_ICMP, 0, 0, 8, 0, 1234,
+            socket.inet_pton(socket.AF_INET, '1.1.1.1'),
+            socket.inet_pton(socket.AF_INET, '2.2.2.2'))
+        with mock.patch.object(nl_lib, 'dump_entries',
+                               return_value=[(4, tcp + icmp), (6, b'')]):
+            self.assertEqual(
+                ((4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234),
+                 (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')),
+                nl_lib.list_entries('fake-namespace'))
+            nl_lib.dump_entries.assert_called_once_with('fake-namespace')
+
     def test_conntrack_flush_entries(self):
         with nl_lib.ConntrackManager() as conntrack:
             nl_lib.nfct.nfct_open.assert_called_once()
@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
 from unittest import mock
 
 import testtools
@@ -41,6 +42,11 @@ class InNamespaceTest(base.BaseTestCase):
 
         self.setns_mock = mock.patch(
             'pyroute2.netns.setns').start()
+        mock.patch.object(utils, '_process_netns_fd', None).start()
+        # namespaces not found in the netns run directory are not cached
+        self.namespace_id_mock = mock.patch.object(
+            utils, '_get_namespace_id',
+            side_effect=FileNotFoundError).start()
 
     def test_in_namespace(self):
         with utils.in_namespace(self.NEW_NETNS):
@@ -78,3 +84,116 @@ class InNamespaceTest(base.BaseTestCase):
         with testtools.ExpectedException(utils.BackInNamespaceExit):
             with utils.in_namespace(self.NEW_NETNS):
                 pass
+
+    def test_in_namespace_caches_fds(self):
+        self.namespace_id_mock.side_effect = None
+        self.namespace_id_mock.return_value = (1, 2)
+        namespace_fds = utils.NamespaceCache(utils._open_namespace_fd,
+                                             os.close)
+        self.addCleanup(namespace_fds.clear)
+        mock.patch.object(utils, '_namespace_fds', namespace_fds).start()
+        self.open_mock.side_effect = [self.ORG_NETNS_FD, self.NEW_NETNS_FD]
+        for _i in range(2):
+            with utils.in_namespace(self.NEW_NETNS):
+                pass
+        self.assertEqual(2, self.open_mock.call_count)
+        setns_calls = [mock.call(self.NEW_NETNS_FD),
+                       mock.call(self.ORG_NETNS_FD)] * 2
+        self.setns_mock.assert_has_calls(setns_calls)
+        self.close_mock.assert_not_called()
+
+
+class NamespaceCacheTest(base.BaseTestCase):
+
+    def setUp(self):
+        super(NamespaceCacheTest, self).setUp()
+        self.namespace_ids = {None: None, 'ns1': (1, 1), 'ns2': (1, 2),
+                              'ns3': (1, 3)}
+
+        def get_namespace_id(namespace):
+            if namespace not in self.namespace_ids:
+                raise FileNotFoundError()
+            return self.namespace_ids[namespace]
+
+        mock.patch.object(utils, '_get_namespace_id',
+                          side_effect=get_namespace_id).start()
+        self.open_resource = mock.Mock(
+            side_effect=lambda namespace: 'res-%s' % namespace)
+        self.close_resource = mock.Mock()
+        self.timer = mock.patch.object(utils.threading, 'Timer').start()
+        self.cache = utils.NamespaceCache(self.open_resource,
+                                          self.close_resource, max_size=2)
+
+    def _get(self, namespace):
+        with self.cache.get(namespace) as resource:
+            return resource
+
+    def test_get_reuses_resource(self):
+        self.assertEqual('res-ns1', self._get('ns1'))
+        self.assertEqual('res-ns1', self._get('ns1'))
+        self.assertEqual('res-None', self._get(None))
+        self.assertEqual(2, self.open_resource.call_count)
+        self.close_resource.assert_not_called()
+
+    def test_get_unknown_namespace(self):
+        self.assertIsNone(self._get('unknown'))
+        self.open_resource.assert_not_called()
+
+    def test_get_deleted_namespace(self):
+        self._get('ns1')
+        del self.namespace_ids['ns1']
+        self.assertIsNone(self._get('ns1'))
+        self.close_resource.assert_called_once_with('res-ns1')
+
+    def test_get_recreated_namespace(self):
+        self._get('ns1')
+        self.namespace_ids['ns1'] = (1, 4)
+        self.assertEqual('res-ns1', self._get('ns1'))
+        self.close_resource.assert_called_once_with('res-ns1')
+        self.assertEqual(2, self.open_resource.call_count)
+
+    def test_deleted_namespaces_are_evicted_periodically(self):
+        self._get('ns1')
+        self._get('ns2')
+        self.timer.assert_called_once_with(utils.NAMESPACE_CHECK_INTERVAL,
+                                           mock.ANY)
+        self.timer.return_value.start.assert_called_once_with()
+
+        # no further access to the cache
+        del self.namespace_ids['ns1']
+        self.timer.call_args[0][1]()
+        self.close_resource.assert_called_once_with('res-ns1')
+        # checked again while namespaces are cached
+        self.assertEqual(2, self.timer.call_count)
+        del self.namespace_ids['ns2']
+        self.timer.call_args[0][1]()
+        self.close_resource.assert_called_with('res-ns2')
+        self.assertEqual(2, self.timer.call_count)
+
+    def test_clear_cancels_check(self):
+        self._get('ns1')
+        self.cache.clear()
+        self.timer.return_value.cancel.assert_called_once_with()
+        self._get('ns1')
+        self.assertEqual(2, self.timer.call_count)
+
+    def test_get_evicts_least_recently_used(self):
+        self._get('ns1')
+        self._get('ns2')
+        self._get('ns1')
+        self._get('ns3')
+        self.close_resource.assert_called_once_with('res-ns2')
+
+    def test_get_failure_evicts_resource(self):
+        with testtools.ExpectedException(ValueError):
+            with self.cache.get('ns1'):
+                raise ValueError
+        self.close_resource.assert_called_once_with('res-ns1')
+        self._get('ns1')
+        self.assertEqual(2, self.open_resource.call_count)
+
+    def test_resource_in_use_is_closed_on_release(self):
+        with self.cache.get('ns1'):
+            self.cache.clear()
+            self.close_resource.assert_not_called()
+        self.close_resource.assert_called_once_with('res-ns1')
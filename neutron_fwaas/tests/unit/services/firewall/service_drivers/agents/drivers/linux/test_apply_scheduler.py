@@ -0,0 +1,69 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+from unittest import mock
+
+from neutron.tests import base
+
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import apply_scheduler
+
+
+class ApplySchedulerTestCase(base.BaseTestCase):
+
+    def _apply_concurrently(self, scheduler, ipt_mgrs):
+        errors = []
+
+        def _apply(ipt_mgr):
+            try:
+                scheduler.apply(ipt_mgr)
+            except RuntimeError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=_apply, args=(ipt_mgr,))
+                   for ipt_mgr in ipt_mgrs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_no_window_applies_immediately(self):
+        ipt_mgr = mock.Mock()
+        scheduler = apply_scheduler.ApplyScheduler(0)
+        with mock.patch('time.sleep') as sleep:
+            scheduler.apply(ipt_mgr)
+            scheduler.apply(ipt_mgr)
+        self.assertEqual(2, ipt_mgr.defer_apply_off.call_count)
+        sleep.assert_not_called()
+
+    def test_concurrent_applies_are_coalesced(self):
+        ipt_mgr = mock.Mock()
+        other_ipt_mgr = mock.Mock()
+        scheduler = apply_scheduler.ApplyScheduler(0.2)
+        errors = self._apply_concurrently(
+            scheduler, [ipt_mgr, ipt_mgr, ipt_mgr, other_ipt_mgr])
+        self.assertEqual([], errors)
+        ipt_mgr.defer_apply_off.assert_called_once_with()
+        other_ipt_mgr.defer_apply_off.assert_called_once_with()
+        # a later apply starts a new batch
+        scheduler.apply(ipt_mgr)
+        self.assertEqual(2, ipt_mgr.defer_apply_off.call_count)
+
+    def test_error_is_reported_to_every_caller(self):
+        ipt_mgr = mock.Mock()
+        ipt_mgr.defer_apply_off.side_effect = RuntimeError()
+        scheduler = apply_scheduler.ApplyScheduler(0.2)
+        errors = self._apply_concurrently(scheduler, [ipt_mgr, ipt_mgr])
+        self.assertEqual(2, len(errors))
+        ipt_mgr.defer_apply_off.assert_called_once_with()
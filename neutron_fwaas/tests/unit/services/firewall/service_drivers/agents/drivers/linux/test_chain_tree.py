@@ -0,0 +1,95 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from neutron.tests import base
+
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import chain_tree
+
+
+def _rule(protocol=None, destination=None, ip_version=4):
+    return {'protocol': protocol, 'destination_ip_address': destination,
+            'ip_version': ip_version, 'action': 'allow', 'enabled': True}
+
+
+class ChainTreeTestCase(base.BaseTestCase):
+
+    def _branch(self, node, kind, value):
+        for match, child in node.branches:
+            if match == (kind, value):
+                return child
+        self.fail('No %s %s branch' % (kind, value))
+
+    def test_get_protocol_bucket(self):
+        self.assertIsNone(chain_tree.get_protocol_bucket(_rule()))
+        self.assertEqual('tcp',
+                         chain_tree.get_protocol_bucket(_rule('tcp')))
+        self.assertEqual('tcp', chain_tree.get_protocol_bucket(_rule('6')))
+        self.assertEqual('icmp',
+                         chain_tree.get_protocol_bucket(_rule('icmp', None,
+                                                              6)))
+        self.assertEqual('icmp',
+                         chain_tree.get_protocol_bucket(_rule('58', None, 6)))
+        self.assertEqual('other',
+                         chain_tree.get_protocol_bucket(_rule('58')))
+        self.assertEqual('other',
+                         chain_tree.get_protocol_bucket(_rule('gre')))
+
+    def test_protocol_buckets_keep_order(self):
+        rules = [_rule('tcp'), _rule(), _rule('udp'), _rule('gre'),
+                 _rule('6')]
+        root = chain_tree.build_tree(rules, 4, 100)
+        self.assertEqual([('protocol', 'tcp'), ('protocol', 'udp')],
+                         [match for match, _node in root.branches])
+        self.assertEqual([rules[0], rules[1], rules[4]],
+                         self._branch(root, 'protocol', 'tcp').rules)
+        self.assertEqual([rules[1], rules[2]],
+                         self._branch(root, 'protocol', 'udp').rules)
+        # packets of other protocols only see the rules which may match
+        self.assertEqual([rules[1], rules[3]], root.rules)
+        self.assertTrue(chain_tree.verify_tree(rules, root))
+
+    def test_no_bucket(self):
+        self.assertIsNone(chain_tree.build_tree([_rule(), _rule('gre')], 4,
+                                                100))
+
+    def test_split_by_destination(self):
+        rules = []
+        for net in range(4):
+            rules += [_rule('tcp', '10.%d.%d.0/24' % (net, idx))
+                      for idx in range(5)]
+        any_rule = _rule('tcp')
+        wide_rule = _rule('tcp', '10.0.0.0/8')
+        rules.insert(7, wide_rule)
+        rules.insert(3, any_rule)
+        root = chain_tree.build_tree(rules, 4, 10)
+        bucket = self._branch(root, 'protocol', 'tcp')
+        self.assertEqual(
+            [('destination', '10.%d.0.0/16' % net) for net in range(4)],
+            [match for match, _node in bucket.branches])
+        child = self._branch(bucket, 'destination', '10.1.0.0/16')
+        # the wide rules keep their place among the 10.1.x.0/24 rules
+        specific = [_rule('tcp', '10.1.%d.0/24' % idx) for idx in range(5)]
+        self.assertEqual([any_rule] + specific[:2] + [wide_rule] +
+                         specific[2:], child.rules)
+        self.assertEqual([any_rule, wide_rule], bucket.rules)
+        self.assertTrue(chain_tree.verify_tree(rules, root))
+        # 4 dispatch rules, then 2 wide and 5 specific rules at most
+        self.assertEqual(1 + 4 + 7, root.depth())
+
+    def test_verify_detects_reordering(self):
+        rules = [_rule('tcp', '10.0.0.0/24'), _rule(), _rule('tcp')]
+        root = chain_tree.build_tree(rules, 4, 100)
+        self.assertTrue(chain_tree.verify_tree(rules, root))
+        bucket = self._branch(root, 'protocol', 'tcp')
+        bucket.rules.reverse()
+        self.assertFalse(chain_tree.verify_tree(rules, root))
@@ -0,0 +1,71 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from neutron.tests import base
+
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import firewall_group_state
+
+
+class FirewallGroupStateStoreTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(FirewallGroupStateStoreTestCase, self).setUp()
+        self.store = firewall_group_state.FirewallGroupStateStore(2)
+
+    def _ipt_mgr(self, namespace):
+        ipt_mgr = mock.Mock()
+        ipt_mgr.namespace = namespace
+        return ipt_mgr
+
+    def test_get_or_create(self):
+        state = self.store.get_or_create('fw1')
+        self.assertEqual('fw1', state.fwid)
+        self.assertIsNone(state.firewall)
+        self.assertIs(state, self.store.get('fw1'))
+        self.assertIsNone(self.store.get('fw2'))
+
+    def test_lock(self):
+        lock = self.store.lock('fw1')
+        self.assertIs(lock, self.store.lock('fw1'))
+        self.assertIsNot(lock, self.store.lock('fw2'))
+        with lock:
+            # reentrant, and kept while the state is dropped
+            with self.store.lock('fw1'):
+                self.store.get_or_create('fw1')
+                self.store.pop('fw1')
+            self.assertIs(lock, self.store.lock('fw1'))
+
+    def test_least_recently_used_is_evicted(self):
+        self.store.get_or_create('fw1')
+        self.store.get_or_create('fw2')
+        self.store.get('fw1')
+        self.store.get_or_create('fw3')
+        self.assertEqual(2, len(self.store))
+        self.assertIn('fw1', self.store)
+        self.assertNotIn('fw2', self.store)
+        self.assertIn('fw3', self.store)
+
+    def test_group_removed_with_last_namespace(self):
+        ns1 = self._ipt_mgr('ns1')
+        ns2 = self._ipt_mgr('ns2')
+        self.store.add_namespace('fw1', ns1)
+        state = self.store.add_namespace('fw1', ns2, {'ipv4': {}})
+        self.assertEqual({'ns1': (ns1, None), 'ns2': (ns2, {'ipv4': {}})},
+                         state.namespaces)
+        self.store.remove_namespace('fw1', 'ns1')
+        self.assertIn('fw1', self.store)
+        self.store.remove_namespace('fw1', 'ns2')
+        self.assertNotIn('fw1', self.store)
+        # unknown groups are ignored
+        self.store.remove_namespace('fw1', 'ns2')
@@ -19,6 +19,7 @@ from unittest import mock
 
 from neutron.tests import base
 from neutron.tests.unit.api.v2 import test_base as test_api_v2
+from neutron_lib.exceptions import firewall_v2 as fw_ext
 
 import neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux.\
     iptables_fwaas_v2 as fwaas
@@ -406,7 +407,6 @@ class IptablesFwaasTestCase(base.BaseTestCase):
         rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
         firewall = self._fake_firewall(rule_list)
         self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
-        self.firewall.pre_firewall = dict(firewall)
         insert_rule = {'enabled': True,
                  'action': 'deny',
                  'ip_version': 4,
@@ -450,7 +450,6 @@ class IptablesFwaasTestCase(base.BaseTestCase):
         rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
         firewall = self._fake_firewall(rule_list)
         self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
-        self.firewall.pre_firewall = dict(firewall)
         remove_rule = rule_list[1]
         rule_list.remove(remove_rule)
         firewall = self._fake_firewall(rule_list)
@@ -519,3 +518,1290 @@ class IptablesFwaasTestCase(base.BaseTestCase):
             self.firewall.conntrack.delete_entries.assert_called_once_with(
                 rules_changed, namespace
             )
+
+    def test_remove_conntrack_updated_firewall_per_group(self):
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        other_firewall = self._fake_firewall(rule_list[:1])
+        other_firewall['id'] = 'other-fw-uuid'
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list,
+                                            other_firewall)
+        # unchanged group: its own baseline is used, nothing to delete
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        namespace = apply_list[0][0].iptables_manager.namespace
+        self.firewall.conntrack.delete_entries.assert_called_once_with(
+            [], namespace)
+        # only the two creations flushed the conntrack table
+        self.assertEqual(2, self.firewall.conntrack.flush_entries.call_count)
+
+    def test_delete_firewall_group_forgets_state(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules_v4(FAKE_FW_ID,
+                                                           apply_list))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertIn(FAKE_FW_ID, self.firewall.fwg_states)
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertNotIn(FAKE_FW_ID, self.firewall.fwg_states)
+
+
+class IptablesFwaasIncrementalTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(IptablesFwaasIncrementalTestCase, self).setUp()
+        self.config(group='fwaas', incremental_apply=True)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack.delete_entries = mock.Mock()
+        self.firewall.conntrack.flush_entries = mock.Mock()
+
+    def _fake_apply_list(self, namespace='qrouter-fake'):
+        ipt_mgr = fwaas.iptables_manager.IptablesManager(
+            use_ipv6=True, namespace=namespace)
+        ipt_mgr.defer_apply_off = mock.Mock()
+        router_info_inst = mock.Mock()
+        router_info_inst.iptables_manager = ipt_mgr
+        router_info_inst.router = {}
+        return [(router_info_inst, FAKE_PORT_IDS)]
+
+    def _fake_rules(self, count):
+        return [{'enabled': True,
+                 'action': 'allow',
+                 'ip_version': 4,
+                 'protocol': 'tcp',
+                 'destination_port': str(1000 + idx),
+                 'id': 'fake-fw-rule%d' % idx} for idx in range(count)]
+
+    def _fake_firewall(self, rule_list):
+        return {'id': FAKE_FW_ID,
+                'admin_state_up': True,
+                'tenant_id': 'tenant-uuid',
+                'egress_rule_list': copy.deepcopy(rule_list),
+                'ingress_rule_list': copy.deepcopy(rule_list)}
+
+    @staticmethod
+    def _dump(ipt_mgr):
+        return {ver: (sorted(tables['filter'].chains),
+                      [str(rule) for rule in tables['filter'].rules])
+                for ver, tables in [(4, ipt_mgr.ipv4), (6, ipt_mgr.ipv6)]}
+
+    def _full_build(self, firewall, ports=None):
+        self.config(group='fwaas', incremental_apply=False)
+        driver = fwaas.IptablesFwaasDriver()
+        driver.conntrack = mock.Mock()
+        apply_list = self._fake_apply_list()
+        if ports is not None:
+            apply_list = [(apply_list[0][0], ports)]
+        driver.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        return apply_list[0][0].iptables_manager
+
+    def _assert_same_rules(self, ipt_mgr, expected_ipt_mgr):
+        def _by_chain(ipt_mgr):
+            result = {}
+            for ver, (chains, rules) in self._dump(ipt_mgr).items():
+                for rule in rules:
+                    chain = rule.split()[1]
+                    result.setdefault((ver, chain), []).append(rule)
+                result[ver] = chains
+            return result
+        self.assertEqual(_by_chain(expected_ipt_mgr), _by_chain(ipt_mgr))
+
+    def test_create_matches_full_build(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules(5))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self._assert_same_rules(apply_list[0][0].iptables_manager,
+                                self._full_build(firewall))
+
+    def test_update_applies_only_delta(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        rule_list = self._fake_rules(50)
+        self.firewall.create_firewall_group(
+            FW_LEGACY, apply_list, self._fake_firewall(rule_list))
+        rule_list[0]['destination_port'] = '22'
+        del rule_list[25]
+        firewall = self._fake_firewall(rule_list)
+
+        v4filter = ipt_mgr.ipv4['filter']
+        with mock.patch.object(fwaas.iptables_manager, 'IptablesRule',
+                               wraps=fwaas.iptables_manager.IptablesRule
+                               ) as rule_cls, \
+                mock.patch.object(v4filter, 'remove_chain') as remove_chain:
+            self.firewall.update_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+        # one modified rule per chain
+        self.assertEqual(2, rule_cls.call_count)
+        remove_chain.assert_not_called()
+        self._assert_same_rules(ipt_mgr, self._full_build(firewall))
+
+    def test_update_unchanged_is_noop(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_rules(5))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        before = self._dump(ipt_mgr)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(before, self._dump(ipt_mgr))
+
+    def test_admin_down_then_delete(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        empty = self._dump(ipt_mgr)
+        firewall = self._fake_firewall(self._fake_rules(5))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        firewall['admin_state_up'] = False
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        chains = ipt_mgr.ipv4['filter'].chains
+        self.assertNotIn('iv4fake-fw-u', chains)
+        default_jumps = [str(rule) for rule in ipt_mgr.ipv4['filter'].rules
+                         if 'fwaas-defau' in rule.rule]
+        self.assertEqual(4, len(default_jumps))
+
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertNotIn(FAKE_FW_ID, self.firewall.fwg_states)
+        # only the action chains shared by the groups are left
+        action_chains = ['accepted', 'dropped', 'rejected']
+        for ver, (chains, rules) in self._dump(ipt_mgr).items():
+            self.assertEqual(sorted(empty[ver][0] + action_chains), chains)
+            self.assertEqual(empty[ver][1], [
+                rule for rule in rules
+                if rule.split()[1].split('-')[-1] not in action_chains])
+
+    def test_evicted_group_is_rebuilt(self):
+        self.config(group='fwaas', max_firewall_group_states=1)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_rules(5))
+        other_firewall = self._fake_firewall([])
+        other_firewall['id'] = 'other-fw-uuid'
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list,
+                                            other_firewall)
+        self.assertNotIn(FAKE_FW_ID, self.firewall.fwg_states)
+
+        rule_list = self._fake_rules(6)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        group_rules = [str(rule) for rule in ipt_mgr.ipv4['filter'].rules
+                       if rule.tag == FAKE_FW_ID]
+        self.assertEqual(len(set(group_rules)), len(group_rules))
+        full_table = self._full_build(firewall).ipv4['filter']
+        group_chains = [fwaas.FORWARD_CHAIN,
+                        ('iv4%s' % FAKE_FW_ID)[:11],
+                        ('ov4%s' % FAKE_FW_ID)[:11]]
+        for direction in fwaas.CHAIN_NAME_PREFIX:
+            group_chains += self.firewall._get_tree_chain_names(
+                full_table, FAKE_FW_ID, fwaas.IPV4, direction)
+        group_chains += [chain for chain in full_table.chains
+                         if self.firewall._is_dispatch_chain(chain)]
+        expected_rules = [
+            str(rule) for rule in full_table.rules
+            if rule.wrap and rule.chain in group_chains and
+            rule.tag not in (fwaas.DISPATCH_TAG, fwaas.ESTABLISHED_TAG)]
+        self.assertEqual(sorted(expected_rules), sorted(group_rules))
+
+    def test_failed_apply_drops_group_state(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_rules(3))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertIsNotNone(
+            self.firewall.fwg_states.get(FAKE_FW_ID).applied_firewall)
+
+        firewall = self._fake_firewall(self._fake_rules(5))
+        with mock.patch.object(self.firewall, '_apply_iptables',
+                               side_effect=RuntimeError):
+            self.assertRaises(fw_ext.FirewallInternalDriverError,
+                              self.firewall.update_firewall_group,
+                              FW_LEGACY, apply_list, firewall)
+        self.assertNotIn(FAKE_FW_ID, self.firewall.fwg_states)
+
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(
+            [rule['id'] for rule in firewall['ingress_rule_list']],
+            [rule['id'] for rule in self.firewall.fwg_states.get(
+                FAKE_FW_ID).applied_firewall['ingress_rule_list']])
+        self._assert_same_rules(ipt_mgr, self._full_build(firewall))
+
+    def test_recreated_router_is_fully_programmed(self):
+        firewall = self._fake_firewall(self._fake_rules(3))
+        self.firewall.create_firewall_group(
+            FW_LEGACY, self._fake_apply_list(), firewall)
+        apply_list = self._fake_apply_list()
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self._assert_same_rules(apply_list[0][0].iptables_manager,
+                                self._full_build(firewall))
+
+
+class IptablesFwaasIpsetTestCase(IptablesFwaasIncrementalTestCase):
+    def setUp(self):
+        super(IptablesFwaasIpsetTestCase, self).setUp()
+        self.config(group='fwaas', enable_ipset=True)
+        self.ipset_cls = mock.patch.object(
+            fwaas.ipset_manager, 'IpsetManager').start()
+        self.ipset_cls.get_name.side_effect = (
+            lambda set_id, ethertype: 'N%s%s' % (ethertype, set_id))
+        self.ipset_mgr = self.ipset_cls.return_value
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+
+    def _fake_address_rules(self, count, action='allow'):
+        return [{'enabled': True,
+                 'action': action,
+                 'ip_version': 4,
+                 'protocol': 'tcp',
+                 'destination_port': '22',
+                 'source_ip_address': '10.0.%d.0/24' % idx,
+                 'id': 'fake-fw-rule%s%d' % (action, idx)}
+                for idx in range(count)]
+
+    def _chain_rules(self, ipt_mgr, direction='ingress'):
+        chain = ('%sv4%s' % (direction[0], FAKE_FW_ID))[:11]
+        return [rule.rule for rule in ipt_mgr.ipv4['filter'].rules
+                if rule.chain == chain][2:]
+
+    def test_compile_folds_address_runs(self):
+        rules = (self._fake_address_rules(4) +
+                 self._fake_address_rules(2, action='deny') +
+                 self._fake_rules(1))
+        iptables_rules, ipsets = self.firewall._compile_rule_list(
+            FAKE_FW_ID, fwaas.IPV4, 'ingress', rules)
+        members = ['10.0.%d.0/24' % idx for idx in range(4)]
+        set_id = self.firewall._get_ipset_id(FAKE_FW_ID, 'ingress', members)
+        self.assertEqual({(set_id, 'IPv4'): members}, ipsets)
+        self.assertLessEqual(
+            len(fwaas.ipset_manager.NET_PREFIX + 'IPv4' + set_id),
+            fwaas.ipset_manager.IPSET_NAME_MAX_LENGTH)
+        self.assertEqual(
+            '-p tcp -m set --match-set NIPv4%s src -m tcp --dport 22 '
+            '-j neutron-filte-accepted' % set_id,
+            iptables_rules[0].replace(
+                fwaas.iptables_manager.binary_name, 'neutron-filte'))
+        # the short deny run and the last rule are kept as they are
+        self.assertEqual(4, len(iptables_rules))
+        self.assertIn('-s 10.0.0.0/24', iptables_rules[1])
+
+    def test_compile_without_ipset(self):
+        self.config(group='fwaas', enable_ipset=False)
+        firewall = fwaas.IptablesFwaasDriver()
+        rules = self._fake_address_rules(4)
+        iptables_rules, ipsets = firewall._compile_rule_list(
+            FAKE_FW_ID, fwaas.IPV4, 'ingress', rules)
+        self.assertEqual({}, ipsets)
+        self.assertEqual(4, len(iptables_rules))
+
+    def test_ipsets_follow_the_rules(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_address_rules(5))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(1, len(self._chain_rules(ipt_mgr)))
+        self.assertEqual(2, self.ipset_mgr.set_members.call_count)
+        members = ['10.0.%d.0/24' % idx for idx in range(5)]
+        self.ipset_mgr.set_members.assert_any_call(
+            self.firewall._get_ipset_id(FAKE_FW_ID, 'ingress', members),
+            'IPv4', [(member, None) for member in members])
+
+        # no run left: the rules are expanded and the sets destroyed
+        firewall = self._fake_firewall(self._fake_address_rules(2))
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(2, len(self._chain_rules(ipt_mgr)))
+        self.assertEqual(
+            sorted([mock.call(self.firewall._get_ipset_id(
+                FAKE_FW_ID, direction, members), 'IPv4')
+                for direction in ('ingress', 'egress')]),
+            sorted(self.ipset_mgr.destroy.call_args_list))
+        self.assertEqual({}, self.firewall.ipsets)
+
+    def test_reordered_runs_keep_their_sets(self):
+        for incremental in (True, False):
+            self.config(group='fwaas', incremental_apply=incremental)
+            self.firewall = fwaas.IptablesFwaasDriver()
+            self.firewall.conntrack = mock.Mock()
+            self.ipset_mgr.reset_mock()
+            apply_list = self._fake_apply_list()
+            ipt_mgr = apply_list[0][0].iptables_manager
+            allowed = self._fake_address_rules(3)
+            denied = [dict(rule, source_ip_address='10.1.%d.0/24' % idx)
+                      for idx, rule in enumerate(
+                          self._fake_address_rules(3, action='deny'))]
+            firewall = self._fake_firewall(allowed + denied)
+            self.firewall.create_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+            set_members = {}
+            for call in self.ipset_mgr.set_members.call_args_list:
+                set_members[call[0][:2]] = call[0][2]
+
+            # the runs swap places: the sets the applied rules use must not
+            # change before the new rules are applied
+            events = []
+            self.ipset_mgr.set_members.side_effect = (
+                lambda *args: events.append(('set_members', args)))
+            self.ipset_mgr.destroy.side_effect = (
+                lambda *args: events.append(('destroy', args)))
+            self.firewall._apply_iptables = mock.Mock(
+                side_effect=lambda ipt_mgr: events.append(('apply', None)))
+            firewall = self._fake_firewall(denied + allowed)
+            self.firewall.update_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+            self.assertIn(('apply', None), events)
+            for event, args in events:
+                if event == 'set_members':
+                    self.assertEqual(set_members.get(args[:2], args[2]),
+                                     args[2])
+            self.ipset_mgr.destroy.assert_not_called()
+            self.assertEqual(2, len(self._chain_rules(ipt_mgr)))
+
+    def test_delete_destroys_ipsets_full_build(self):
+        self.config(group='fwaas', incremental_apply=False)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_address_rules(5))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.ipset_mgr.destroy.assert_not_called()
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(2, self.ipset_mgr.destroy.call_count)
+        self.assertEqual({}, self.firewall.ipsets)
+
+
+class IptablesFwaasMultiportTestCase(IptablesFwaasIncrementalTestCase):
+    def setUp(self):
+        super(IptablesFwaasMultiportTestCase, self).setUp()
+        self.config(group='fwaas', enable_multiport=True)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+
+    def _compile(self, rules):
+        iptables_rules, ipsets = self.firewall._compile_rule_list(
+            FAKE_FW_ID, fwaas.IPV4, 'ingress', rules)
+        self.assertEqual({}, ipsets)
+        return [rule.replace(fwaas.iptables_manager.binary_name, 'bin')
+                for rule in iptables_rules]
+
+    def test_compile_folds_port_runs(self):
+        rules = self._fake_rules(3)
+        rules[1]['destination_port'] = '2000:2010'
+        self.assertEqual(
+            ['-p tcp -m multiport --dports 1000,2000:2010,1002 '
+             '-j bin-accepted'], self._compile(rules))
+
+    def test_compile_keeps_order(self):
+        rules = self._fake_rules(4)
+        rules[2]['action'] = 'deny'
+        rules[3]['source_port'] = '53'
+        self.assertEqual(
+            ['-p tcp -m multiport --dports 1000,1001 -j bin-accepted',
+             '-p tcp -m tcp --dport 1002 -j bin-dropped',
+             '-p tcp -m tcp --sport 53 --dport 1003 -j bin-accepted'],
+            self._compile(rules))
+
+    def test_compile_splits_long_runs(self):
+        rules = self._fake_rules(20)
+        rules[0]['destination_port'] = '1:10'
+        compiled = self._compile(rules)
+        self.assertEqual(2, len(compiled))
+        # the range takes two of the 15 ports of the first rule
+        self.assertEqual(14, compiled[0].count(',') + 1)
+        self.assertEqual(6, compiled[1].count(',') + 1)
+        self.assertIn('--dports 1:10,1001,', compiled[0])
+
+    def test_compile_does_not_fold_icmp(self):
+        rules = self._fake_rules(2)
+        for rule in rules:
+            rule['protocol'] = 'icmp'
+        self.assertEqual(2, len(self._compile(rules)))
+
+    def test_update_applies_only_delta(self):
+        # the new rules are folded into the existing multiport rule
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        self.firewall.create_firewall_group(
+            FW_LEGACY, apply_list, self._fake_firewall(self._fake_rules(5)))
+        firewall = self._fake_firewall(self._fake_rules(7))
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self._assert_same_rules(ipt_mgr, self._full_build(firewall))
+        chain = ('iv4%s' % FAKE_FW_ID)[:11]
+        self.assertEqual(
+            3, len([rule for rule in ipt_mgr.ipv4['filter'].rules
+                    if rule.chain == chain]))
+
+
+class IptablesFwaasChainTreeTestCase(IptablesFwaasIncrementalTestCase):
+    def setUp(self):
+        super(IptablesFwaasChainTreeTestCase, self).setUp()
+        self.config(group='fwaas', chain_tree_min_rules=3)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+
+    def _fake_tree_rules(self):
+        rules = self._fake_rules(4)
+        rules[1]['protocol'] = 'udp'
+        rules[2]['protocol'] = None
+        rules[2]['destination_port'] = None
+        return rules
+
+    def _tree_chains(self, ipt_mgr):
+        return sorted(
+            chain for chain in ipt_mgr.ipv4['filter'].chains
+            if chain[1] == '4')
+
+    def test_compile_chains(self):
+        chains, ipsets = self.firewall._compile_chains(
+            FAKE_FW_ID, fwaas.IPV4, 'ingress', self._fake_tree_rules())
+        bname = fwaas.iptables_manager.binary_name
+        chains = {name: [rule.replace(bname, 'bin') for rule in rules]
+                  for name, rules in chains.items()}
+        self.assertEqual({
+            'iv4%s' % FAKE_FW_ID: [
+                '-p tcp -g bin-i4t-fake-fw',
+                '-p udp -g bin-i4u-fake-fw',
+                '-j bin-accepted'],
+            'i4t-%s' % FAKE_FW_ID: [
+                '-p tcp -m tcp --dport 1000 -j bin-accepted',
+                '-j bin-accepted',
+                '-p tcp -m tcp --dport 1003 -j bin-accepted'],
+            'i4u-%s' % FAKE_FW_ID: [
+                '-p udp -m udp --dport 1001 -j bin-accepted',
+                '-j bin-accepted']}, chains)
+
+    def test_small_chains_are_not_split(self):
+        chains, ipsets = self.firewall._compile_chains(
+            FAKE_FW_ID, fwaas.IPV4, 'ingress', self._fake_tree_rules()[:2])
+        self.assertEqual(['iv4%s' % FAKE_FW_ID], list(chains))
+
+    def test_tree_chains_follow_the_rules(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_tree_rules())
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(['i4t-fake-fw', 'i4u-fake-fw',
+                          'o4t-fake-fw', 'o4u-fake-fw'],
+                         self._tree_chains(ipt_mgr))
+        self._assert_same_rules(ipt_mgr, self._full_build(firewall))
+
+        firewall = self._fake_firewall(self._fake_rules(4))
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(['i4t-fake-fw', 'o4t-fake-fw'],
+                         self._tree_chains(ipt_mgr))
+        self._assert_same_rules(ipt_mgr, self._full_build(firewall))
+
+    def test_delete_removes_tree_chains_full_build(self):
+        self.config(group='fwaas', incremental_apply=False)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_tree_rules())
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(4, len(self._tree_chains(ipt_mgr)))
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual([], self._tree_chains(ipt_mgr))
+
+
+class IptablesFwaasRuleOptimizerTestCase(IptablesFwaasIncrementalTestCase):
+    def setUp(self):
+        super(IptablesFwaasRuleOptimizerTestCase, self).setUp()
+        self.config(group='fwaas', optimize_rules=True)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+
+    def _shadowed_rules(self):
+        rules = self._fake_rules(3)
+        rules.append(dict(rules[1], id='fake-fw-rule-dup'))
+        rules.append(dict(rules[0], id='fake-fw-rule-deny', action='deny'))
+        return rules
+
+    def test_shadowed_rules_are_not_programmed(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._shadowed_rules())
+        with mock.patch.object(fwaas.LOG, 'info') as log_info:
+            self.firewall.create_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+        chain = ('iv4%s' % FAKE_FW_ID)[:11]
+        rules = [rule.rule for rule in ipt_mgr.ipv4['filter'].rules
+                 if rule.chain == chain]
+        # the preamble and the 3 distinct rules
+        self.assertEqual(5, len(rules))
+        self.assertFalse(any(fwaas.DROPPED_CHAIN in rule
+                             for rule in rules[1:]))
+        self.assertEqual(2, log_info.call_count)
+        self.assertIn('fake-fw-rule-dup (covered by fake-fw-rule1)',
+                      log_info.call_args[0][1]['rules'])
+        # the stored group keeps all of its rules for the conntrack diff
+        self.assertEqual(5, len(
+            self.firewall.fwg_states.get(FAKE_FW_ID).firewall[
+                'ingress_rule_list']))
+
+    def test_versions_without_rules_have_no_chains(self):
+        for incremental in (True, False):
+            self.config(group='fwaas', incremental_apply=incremental)
+            self.firewall = fwaas.IptablesFwaasDriver()
+            self.firewall.conntrack = mock.Mock()
+            apply_list = self._fake_apply_list()
+            ipt_mgr = apply_list[0][0].iptables_manager
+            firewall = self._fake_firewall(self._fake_rules(2))
+            self.firewall.create_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+            v4_chains = ipt_mgr.ipv4['filter'].chains
+            v6_chains = ipt_mgr.ipv6['filter'].chains
+            self.assertIn(('iv4%s' % FAKE_FW_ID)[:11], v4_chains)
+            self.assertNotIn(('iv6%s' % FAKE_FW_ID)[:11], v6_chains)
+            self.assertNotIn(('ov6%s' % FAKE_FW_ID)[:11], v6_chains)
+            forward = [rule.rule for rule in ipt_mgr.ipv6['filter'].rules
+                       if rule.chain == fwaas.FORWARD_CHAIN and rule.wrap]
+            # IPv6 packets only go to the default policy
+            self.assertEqual(2 * len(FAKE_PORT_IDS), len(
+                [rule for rule in forward
+                 if fwaas.FWAAS_DEFAULT_CHAIN[:11] in rule]))
+            self.assertFalse(any(FAKE_FW_ID[:8] in rule for rule in forward))
+
+
+class IptablesFwaasInterfaceDispatchTestCase(
+        IptablesFwaasIncrementalTestCase):
+    def setUp(self):
+        super(IptablesFwaasInterfaceDispatchTestCase, self).setUp()
+        self.config(group='fwaas', interface_dispatch=True)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+
+    def _chain_rules(self, ipt_mgr, chain):
+        bname = fwaas.iptables_manager.binary_name
+        return [rule.rule.replace(bname, 'bin')
+                for rule in ipt_mgr.ipv4['filter'].rules
+                if rule.chain == chain and rule.wrap]
+
+    def _dispatch_chains(self, ipt_mgr):
+        return sorted(chain for chain in ipt_mgr.ipv4['filter'].chains
+                      if self.firewall._is_dispatch_chain(chain))
+
+    def test_jumps_go_through_dispatch_chains(self):
+        for incremental in (True, False):
+            self.config(group='fwaas', incremental_apply=incremental)
+            self.firewall = fwaas.IptablesFwaasDriver()
+            self.firewall.conntrack = mock.Mock()
+            apply_list = self._fake_apply_list()
+            ipt_mgr = apply_list[0][0].iptables_manager
+            firewall = self._fake_firewall(self._fake_rules(2))
+            self.firewall.create_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+            self.assertEqual(['-o qr-1_+ -j bin-fwo-qr-1_',
+                              '-o qr-2_+ -j bin-fwo-qr-2_',
+                              '-i qr-1_+ -j bin-fwi-qr-1_',
+                              '-i qr-2_+ -j bin-fwi-qr-2_',
+                              '-o qr-1_+ -j bin-fdo-qr-1_',
+                              '-o qr-2_+ -j bin-fdo-qr-2_',
+                              '-i qr-1_+ -j bin-fdi-qr-1_',
+                              '-i qr-2_+ -j bin-fdi-qr-2_'],
+                             self._chain_rules(ipt_mgr, fwaas.FORWARD_CHAIN))
+            self.assertEqual(['-o qr-1_fake-port -j bin-iv4fake-fw-'],
+                             self._chain_rules(ipt_mgr, 'fwo-qr-1_'))
+            self.assertEqual(['-i qr-2_fake-port -j bin-fwaas-defau'],
+                             self._chain_rules(ipt_mgr, 'fdi-qr-2_'))
+
+    def test_ports_share_dispatch_chains(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_rules(2))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        other_firewall = self._fake_firewall(self._fake_rules(1))
+        other_firewall['id'] = 'other-fw-uuid'
+        other_apply_list = [(apply_list[0][0], ['1_other-port-uuid'])]
+        self.firewall.create_firewall_group(FW_LEGACY, other_apply_list,
+                                            other_firewall)
+        self.assertEqual(['-o qr-1_fake-port -j bin-iv4fake-fw-',
+                          '-o qr-1_other-por -j bin-iv4other-fw'],
+                         self._chain_rules(ipt_mgr, 'fwo-qr-1_'))
+        self.assertEqual(8, len(self._chain_rules(ipt_mgr,
+                                                  fwaas.FORWARD_CHAIN)))
+
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(['fdi-qr-1_', 'fdo-qr-1_', 'fwi-qr-1_',
+                          'fwo-qr-1_'],
+                         self._dispatch_chains(ipt_mgr))
+        self.assertEqual(['-o qr-1_other-por -j bin-iv4other-fw'],
+                         self._chain_rules(ipt_mgr, 'fwo-qr-1_'))
+        self.firewall.delete_firewall_group(FW_LEGACY, other_apply_list,
+                                            other_firewall)
+        self.assertEqual([], self._dispatch_chains(ipt_mgr))
+        self.assertEqual([], self._chain_rules(ipt_mgr, fwaas.FORWARD_CHAIN))
+
+    def test_dispatch_chains_are_split_by_first_character(self):
+        mock.patch.object(fwaas, 'DISPATCH_CHAIN_SIZE', 2).start()
+        router_info = self._fake_apply_list()[0][0]
+        ipt_mgr = router_info.iptables_manager
+        firewall = self._fake_firewall(self._fake_rules(1))
+        ports = ['1a-port-uuid', '1b-port-uuid', '2a-port-uuid']
+        apply_list = [(router_info, ports)]
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        forward = self._chain_rules(ipt_mgr, fwaas.FORWARD_CHAIN)
+        self.assertEqual(['-o qr-1+ -j bin-fwo-qr-1',
+                          '-o qr-2+ -j bin-fwo-qr-2'], forward[:2])
+        self.assertEqual(['-o qr-1a+ -j bin-fwo-qr-1a',
+                          '-o qr-1b+ -j bin-fwo-qr-1b'],
+                         self._chain_rules(ipt_mgr, 'fwo-qr-1'))
+        self.assertEqual(['-o qr-2a+ -j bin-fwo-qr-2a'],
+                         self._chain_rules(ipt_mgr, 'fwo-qr-2'))
+        self.assertEqual(['-o qr-1a-port-uui -j bin-iv4fake-fw-'],
+                         self._chain_rules(ipt_mgr, 'fwo-qr-1a'))
+
+        # back under the threshold, FORWARD jumps to the chains directly
+        firewall = self._fake_firewall(self._fake_rules(1))
+        apply_list = [(router_info, ports[:2])]
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        forward = self._chain_rules(ipt_mgr, fwaas.FORWARD_CHAIN)
+        self.assertEqual(['-o qr-1a+ -j bin-fwo-qr-1a',
+                          '-o qr-1b+ -j bin-fwo-qr-1b'], forward[:2])
+        self.assertNotIn('fwo-qr-1', self._dispatch_chains(ipt_mgr))
+        self.assertNotIn('fwo-qr-2a', self._dispatch_chains(ipt_mgr))
+
+    def test_output_interface_jumps_come_first(self):
+        # without dispatch, the group applied first is looked up first,
+        # here the output interfaces go first whatever the groups
+        router_info = self._fake_apply_list()[0][0]
+        ipt_mgr = router_info.iptables_manager
+        apply_list = [(router_info, ['2_fake-port-uuid'])]
+        firewall = self._fake_firewall(self._fake_rules(1))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        other_firewall = self._fake_firewall(self._fake_rules(1))
+        other_firewall['id'] = 'other-fw-uuid'
+        other_apply_list = [(apply_list[0][0], ['1_other-port-uuid'])]
+        self.firewall.create_firewall_group(FW_LEGACY, other_apply_list,
+                                            other_firewall)
+        self.assertEqual(['-o qr-1_+ -j bin-fwo-qr-1_',
+                          '-o qr-2_+ -j bin-fwo-qr-2_',
+                          '-i qr-1_+ -j bin-fwi-qr-1_',
+                          '-i qr-2_+ -j bin-fwi-qr-2_'],
+                         self._chain_rules(ipt_mgr,
+                                           fwaas.FORWARD_CHAIN)[:4])
+
+
+class IptablesFwaasEstablishedFastPathTestCase(
+        IptablesFwaasIncrementalTestCase):
+    def setUp(self):
+        super(IptablesFwaasEstablishedFastPathTestCase, self).setUp()
+        self.config(group='fwaas', established_fast_path=True)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+
+    def _chain_rules(self, ipt_mgr, chain, ver=4):
+        bname = fwaas.iptables_manager.binary_name
+        tables = ipt_mgr.ipv4 if ver == 4 else ipt_mgr.ipv6
+        return [rule.rule.replace(bname, 'bin')
+                for rule in tables['filter'].rules
+                if rule.chain == chain and rule.wrap]
+
+    def test_established_sessions_are_accepted_first(self):
+        for incremental in (True, False):
+            self.config(group='fwaas', incremental_apply=incremental)
+            self.firewall = fwaas.IptablesFwaasDriver()
+            self.firewall.conntrack = mock.Mock()
+            apply_list = self._fake_apply_list()
+            ipt_mgr = apply_list[0][0].iptables_manager
+            firewall = self._fake_firewall(self._fake_rules(2))
+            self.firewall.create_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+            for ver in (4, 6):
+                forward = self._chain_rules(ipt_mgr, fwaas.FORWARD_CHAIN,
+                                            ver)
+                self.assertEqual('-m state --state RELATED,ESTABLISHED '
+                                 '-j bin-fwaas-estab', forward[0])
+                self.assertEqual(1, len([rule for rule in forward
+                                         if 'fwaas-estab' in rule]))
+                self.assertEqual(['-j ACCEPT'], self._chain_rules(
+                    ipt_mgr, 'fwaas-estab', ver))
+            # the chains of the group only drop invalid packets
+            chain_rules = self._chain_rules(ipt_mgr, 'iv4fake-fw-')
+            self.assertEqual('-m state --state INVALID -j bin-dropped',
+                             chain_rules[0])
+            self.assertFalse(any('ESTABLISHED' in rule
+                                 for rule in chain_rules))
+
+            self.firewall.delete_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+            self.assertNotIn('fwaas-estab', ipt_mgr.ipv4['filter'].chains)
+            self.assertEqual([], [
+                rule for rule in self._chain_rules(ipt_mgr,
+                                                   fwaas.FORWARD_CHAIN)
+                if 'fwaas-estab' in rule])
+
+    def test_admin_down_ports_are_excepted(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_rules(2))
+        firewall['admin_state_up'] = False
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(['-i qr-1_fake-port -j RETURN',
+                          '-o qr-1_fake-port -j RETURN',
+                          '-i qr-2_fake-port -j RETURN',
+                          '-o qr-2_fake-port -j RETURN',
+                          '-j ACCEPT'],
+                         self._chain_rules(ipt_mgr, 'fwaas-estab'))
+
+        firewall['admin_state_up'] = True
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(['-j ACCEPT'],
+                         self._chain_rules(ipt_mgr, 'fwaas-estab'))
+        self.assertEqual({}, self.firewall.admin_down_intfs)
+
+
+class IptablesFwaasNoflushApplyTestCase(IptablesFwaasIncrementalTestCase):
+    def setUp(self):
+        super(IptablesFwaasNoflushApplyTestCase, self).setUp()
+        self.config(group='fwaas', noflush_apply=True)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+        self.execute = mock.patch.object(
+            fwaas.noflush_applier.linux_utils, 'execute').start()
+
+    def test_is_fwaas_chain(self):
+        for chain_name in ['accepted', 'dropped', 'rejected', 'fwaas-defau',
+                           'fwaas-estab', 'iv4fake-fw-', 'ov6fake-fw-',
+                           'i4t-fake-fw', 'o6u0fake-fw', 'fwo-qr-a',
+                           'fdi-rfp-0']:
+            self.assertTrue(self.firewall._is_fwaas_chain(chain_name),
+                            chain_name)
+        for chain_name in ['FORWARD', 'INPUT', 'scope', 'local',
+                           'snat', 'float-snat', 'PREROUTING']:
+            self.assertFalse(self.firewall._is_fwaas_chain(chain_name),
+                             chain_name)
+
+    def test_update_restores_the_group_chains_only(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_rules(2))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        ipt_mgr.defer_apply_off.assert_called_once_with()
+        self.execute.assert_not_called()
+
+        firewall = self._fake_firewall(self._fake_rules(3))
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(1, ipt_mgr.defer_apply_off.call_count)
+        self.assertEqual(1, self.execute.call_count)
+        payload = self.execute.call_args[1]['process_input'].split('\n')
+        bname = ipt_mgr.wrap_name
+        self.assertEqual([':%s-iv4fake-fw- - [0:0]' % bname,
+                          ':%s-ov4fake-fw- - [0:0]' % bname],
+                         [line for line in payload if line.startswith(':')])
+        self.assertFalse(any('FORWARD' in line for line in payload))
+
+
+class IptablesFwaasNamespaceWorkersTestCase(IptablesFwaasIncrementalTestCase):
+    def setUp(self):
+        super(IptablesFwaasNamespaceWorkersTestCase, self).setUp()
+        self.config(group='fwaas', namespace_workers=4)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+        self.addCleanup(self.firewall._executor.shutdown)
+
+    def _multi_router_apply_list(self, count):
+        return [self._fake_apply_list('qrouter-%d' % idx)[0]
+                for idx in range(count)]
+
+    def test_namespaces_are_all_programmed(self):
+        apply_list = self._multi_router_apply_list(3)
+        firewall = self._fake_firewall(self._fake_rules(2))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        for ri, _ports in apply_list:
+            ri.iptables_manager.defer_apply_off.assert_called_once_with()
+            self._assert_same_rules(ri.iptables_manager,
+                                    self._full_build(firewall))
+        self.assertEqual(
+            ['qrouter-0', 'qrouter-1', 'qrouter-2'],
+            sorted(self.firewall.fwg_states.get(FAKE_FW_ID).namespaces))
+        self.assertEqual(3, self.firewall.conntrack.flush_entries.call_count)
+
+    def test_failures_are_aggregated(self):
+        apply_list = self._multi_router_apply_list(3)
+        for idx in (0, 2):
+            ipt_mgr = apply_list[idx][0].iptables_manager
+            ipt_mgr.defer_apply_off.side_effect = RuntimeError(
+                'qrouter-%d failed' % idx)
+        firewall = self._fake_firewall(self._fake_rules(2))
+        self.assertRaises(fw_ext.FirewallInternalDriverError,
+                          self.firewall.create_firewall_group,
+                          FW_LEGACY, apply_list, firewall)
+        # the namespace which did not fail was programmed
+        ipt_mgr = apply_list[1][0].iptables_manager
+        ipt_mgr.defer_apply_off.assert_called_once_with()
+
+        def _call(ipt_if_prefix, router_fw_ports):
+            ipt_if_prefix['ipt'].defer_apply_off()
+
+        error = self.assertRaises(fwaas.NamespaceErrors,
+                                  self.firewall._run_per_namespace,
+                                  FW_LEGACY, apply_list, _call)
+        self.assertEqual(['qrouter-0', 'qrouter-2'],
+                         [namespace for namespace, _error in error.errors])
+        self.assertEqual('Failed to program namespaces: '
+                         'qrouter-0 (qrouter-0 failed), '
+                         'qrouter-2 (qrouter-2 failed)', str(error))
+
+    def test_calls_of_a_namespace_are_ordered(self):
+        apply_list = self._fake_apply_list()
+        ri = apply_list[0][0]
+        apply_list = [(ri, FAKE_PORT_IDS[:1]), (ri, FAKE_PORT_IDS[1:])]
+        apply_list += self._multi_router_apply_list(2)
+        calls = []
+
+        def _call(ipt_if_prefix, router_fw_ports):
+            calls.append((ipt_if_prefix['ipt'].namespace, router_fw_ports))
+
+        self.firewall._run_per_namespace(FW_LEGACY, apply_list, _call)
+        self.assertEqual([('qrouter-fake', FAKE_PORT_IDS[:1]),
+                          ('qrouter-fake', FAKE_PORT_IDS[1:])],
+                         [call for call in calls if call[0] == 'qrouter-fake'])
+        self.assertEqual(4, len(calls))
+
+
+class IptablesFwaasRuleCountersTestCase(IptablesFwaasIncrementalTestCase):
+    def setUp(self):
+        super(IptablesFwaasRuleCountersTestCase, self).setUp()
+        self.execute = mock.patch.object(
+            fwaas.rule_counters.linux_utils, 'execute').start()
+
+    def _save_output(self, ipt_mgr, packets):
+        """iptables-save -c of the IPv4 filter table of ipt_mgr.
+
+        :param packets: packets matched by the rules containing each text
+        """
+        lines = ['*filter']
+        for rule in ipt_mgr.ipv4['filter'].rules:
+            count = next((count for text, count in packets.items()
+                          if text in rule.rule), 0)
+            lines.append('[%d:%d] %s' % (count, count * 100, str(rule)))
+        return '\n'.join(lines + ['COMMIT', ''])
+
+    def _counters(self, direction='ingress'):
+        return {counter['rule_id']: (counter['packets'], counter['bytes'])
+                for counter in self.firewall.get_rule_counters()
+                if counter['direction'] == direction}
+
+    def test_counters_are_mapped_to_rules(self):
+        self.firewall.enable_multiport = True
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        rules = self._fake_rules(4)
+        rules[2]['action'] = 'deny'
+        firewall = self._fake_firewall(rules)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        save_output = self._save_output(ipt_mgr, {'--dports 1000,1001': 5,
+                                                  '--dport 1002': 2})
+        self.execute.side_effect = (
+            lambda args, **kwargs: save_output
+            if 'iptables-save' in args else '')
+
+        counters = self.firewall.get_rule_counters()
+        # one dump of each IP version for the namespace
+        self.assertEqual(2, self.execute.call_count)
+        self.assertEqual(8, len(counters))
+        self.assertEqual({'firewall_group_id': FAKE_FW_ID,
+                          'rule_id': 'fake-fw-rule0',
+                          'direction': 'ingress',
+                          'ip_version': 4,
+                          'namespace': 'qrouter-fake',
+                          'ports': list(FAKE_PORT_IDS),
+                          'packets': 5,
+                          'bytes': 500}, counters[0])
+        # the folded rules share the counters of their iptables rule
+        self.assertEqual({'fake-fw-rule0': (5, 500),
+                          'fake-fw-rule1': (5, 500),
+                          'fake-fw-rule2': (2, 200),
+                          'fake-fw-rule3': (0, 0)}, self._counters())
+
+    def test_admin_down_groups_are_not_counted(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules(2))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        firewall['admin_state_up'] = False
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual([], self.firewall.get_rule_counters())
+        self.execute.assert_not_called()
+
+    def test_unreadable_namespaces_are_skipped(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules(2))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.execute.side_effect = RuntimeError()
+        self.assertEqual([], self.firewall.get_rule_counters())
+
+
+class IptablesFwaasRuleReorderTestCase(IptablesFwaasRuleCountersTestCase):
+    def setUp(self):
+        super(IptablesFwaasRuleReorderTestCase, self).setUp()
+        self.config(group='fwaas', reorder_rules_by_hits=True)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+
+    def _count(self, ipt_mgr, packets):
+        save_output = self._save_output(ipt_mgr, packets)
+        self.execute.side_effect = (
+            lambda args, **kwargs: save_output
+            if 'iptables-save' in args else '')
+        self.firewall.get_rule_counters()
+
+    def _chain_ports(self, ipt_mgr):
+        chain = ('iv4%s' % FAKE_FW_ID)[:11]
+        return [rule.rule.split('--dport ')[1].split()[0]
+                for rule in ipt_mgr.ipv4['filter'].rules
+                if rule.chain == chain and '--dport' in rule.rule]
+
+    def test_hot_rules_are_moved_ahead(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        rules = self._fake_rules(4)
+        # covers the ports of the rules after it
+        rules[1]['destination_port'] = '1000:1005'
+        firewall = self._fake_firewall(rules)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(1, ipt_mgr.defer_apply_off.call_count)
+
+        self._count(ipt_mgr, {'--dport 1003': 50, '--dport 1000 ': 10})
+        self.firewall.apply_rule_hit_order()
+        self.assertEqual(['1000', '1000:1005', '1003', '1002'],
+                         self._chain_ports(ipt_mgr))
+        self.assertEqual(2, ipt_mgr.defer_apply_off.call_count)
+        # packets of the moved rules are counted again from zero
+        self._count(ipt_mgr, {'--dport 1003': 5})
+        self.assertEqual(55, self.firewall.rule_hits[FAKE_FW_ID][
+            'ingress']['fake-fw-rule3'])
+
+        # unchanged order, nothing to apply
+        self.firewall.apply_rule_hit_order()
+        self.assertEqual(2, ipt_mgr.defer_apply_off.call_count)
+
+    def test_groups_updated_meanwhile_are_not_reordered(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_rules(3))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self._count(ipt_mgr, {'--dport 1002': 5})
+        updated = self._fake_firewall(self._fake_rules(2))
+        reorder_firewall = self.firewall._reorder_firewall
+
+        def _reorder_firewall(firewall):
+            if firewall is not updated:
+                # an RPC applies the group while its order is checked
+                self.firewall.update_firewall_group(FW_LEGACY, apply_list,
+                                                    updated)
+            return reorder_firewall(firewall)
+
+        with mock.patch.object(self.firewall, '_reorder_firewall',
+                               side_effect=_reorder_firewall):
+            with mock.patch.object(self.firewall.fwg_states, 'lock',
+                                   wraps=self.firewall.fwg_states.lock) as (
+                    lock):
+                self.firewall.apply_rule_hit_order()
+        lock.assert_called_with(FAKE_FW_ID)
+        self.assertEqual(['1000', '1001'], self._chain_ports(ipt_mgr))
+        self.assertEqual(updated, self.firewall.fwg_states.get(
+            FAKE_FW_ID).firewall)
+
+    def test_partially_deleted_groups_are_not_reordered(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        firewall = self._fake_firewall(self._fake_rules(2))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self._count(ipt_mgr, {'--dport 1001': 5})
+        self.firewall.delete_firewall_group(FW_LEGACY, [], firewall)
+        self.firewall.apply_rule_hit_order()
+        self.assertEqual(['1000', '1001'], self._chain_ports(ipt_mgr))
+
+
+class IptablesFwaasRejectRateLimitTestCase(IptablesFwaasRuleCountersTestCase):
+    def setUp(self):
+        super(IptablesFwaasRejectRateLimitTestCase, self).setUp()
+        self.config(group='fwaas', reject_rate_limit=100,
+                    reject_rate_burst=20)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+
+    def _rejected_rules(self, table):
+        return [rule.rule for rule in table.rules
+                if rule.chain == fwaas.REJECTED_CHAIN]
+
+    def test_rejects_are_rate_limited(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        self.firewall.create_firewall_group(
+            FW_LEGACY, apply_list, self._fake_firewall(self._fake_rules(1)))
+        self.assertEqual(
+            ['-m limit --limit 100/sec --limit-burst 20 '
+             '-j REJECT --reject-with icmp-port-unreachable', '-j DROP'],
+            self._rejected_rules(ipt_mgr.ipv4['filter']))
+        self.assertEqual(
+            ['-m limit --limit 100/sec --limit-burst 20 '
+             '-j REJECT --reject-with icmp6-port-unreachable', '-j DROP'],
+            self._rejected_rules(ipt_mgr.ipv6['filter']))
+
+    def test_router_limits_override_the_default(self):
+        self.config(group='fwaas', reject_rate_limits={'router1': 0,
+                                                       'router2': 5})
+        for router_id, expected in [
+                ('router1',
+                 ['-j REJECT --reject-with icmp-port-unreachable']),
+                ('router2',
+                 ['-m limit --limit 5/sec --limit-burst 20 '
+                  '-j REJECT --reject-with icmp-port-unreachable',
+                  '-j DROP'])]:
+            apply_list = self._fake_apply_list()
+            apply_list[0][0].router = {'id': router_id}
+            ipt_mgr = apply_list[0][0].iptables_manager
+            self.firewall.create_firewall_group(
+                FW_LEGACY, apply_list,
+                self._fake_firewall(self._fake_rules(1)))
+            self.assertEqual(expected,
+                             self._rejected_rules(ipt_mgr.ipv4['filter']))
+
+    def test_reject_counters(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        self.firewall.create_firewall_group(
+            FW_LEGACY, apply_list, self._fake_firewall(self._fake_rules(1)))
+        ipt_mgr.use_ipv6 = False
+        save_output = self._save_output(ipt_mgr, {'-j REJECT': 30,
+                                                  '-j DROP': 7})
+        self.execute.side_effect = (
+            lambda args, **kwargs: save_output
+            if 'iptables-save' in args else '')
+        self.assertEqual(
+            [{'namespace': 'qrouter-fake', 'ip_version': 4,
+              'rejected': 30, 'dropped': 7}],
+            self.firewall.get_reject_counters())
+
+
+class IptablesFwaasCompileCacheTestCase(IptablesFwaasIncrementalTestCase):
+    def test_rules_are_compiled_once_across_routers(self):
+        firewall = self._fake_firewall(self._fake_rules(3))
+        self.firewall.create_firewall_group(
+            FW_LEGACY, self._fake_apply_list('qrouter-1'), firewall)
+        misses = self.firewall.get_compile_cache_stats()['rules']['misses']
+        other = copy.deepcopy(firewall)
+        other['id'] = 'other-fw-id'
+        apply_list = self._fake_apply_list('qrouter-2')
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, other)
+
+        stats = self.firewall.get_compile_cache_stats()['rules']
+        self.assertEqual(misses, stats['misses'])
+        self.assertGreater(stats['hits'], 0)
+        self.assertGreater(stats['hit_ratio'], 0)
+        self._assert_same_rules(apply_list[0][0].iptables_manager,
+                                self._full_build(other))
+
+    def test_rules_differing_in_content_are_not_shared(self):
+        rule = self._fake_rules(1)[0]
+        other = dict(rule, id='other-rule', destination_port='2000')
+        self.assertNotEqual(
+            self.firewall._convert_fwaas_to_iptables_rule(rule),
+            self.firewall._convert_fwaas_to_iptables_rule(other))
+        self.assertEqual(
+            self.firewall._convert_fwaas_to_iptables_rule(rule),
+            self.firewall._convert_fwaas_to_iptables_rule(
+                dict(rule, id='renamed', name='renamed')))
+
+    def test_chains_are_compiled_once_per_rule_change(self):
+        compile_chains = mock.patch.object(
+            self.firewall, '_compile_chains',
+            wraps=self.firewall._compile_chains).start()
+        apply_list = (self._fake_apply_list('qrouter-1') +
+                      self._fake_apply_list('qrouter-2'))
+        firewall = self._fake_firewall(self._fake_rules(3))
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        # once per IP version and direction, not per namespace
+        self.assertEqual(4, compile_chains.call_count)
+
+        compile_chains.reset_mock()
+        self.firewall.update_firewall_group(
+            FW_LEGACY, [(ri, FAKE_PORT_IDS[:1]) for ri, _ports in apply_list],
+            firewall)
+        compile_chains.assert_not_called()
+
+        firewall = copy.deepcopy(firewall)
+        firewall['ingress_rule_list'][0]['destination_port'] = '2000'
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(
+            [('ingress', fwaas.IPV4), ('ingress', fwaas.IPV6)],
+            sorted((call[0][2], call[0][1])
+                   for call in compile_chains.call_args_list))
+        for ri, _ports in apply_list:
+            self._assert_same_rules(ri.iptables_manager,
+                                    self._full_build(firewall))
+
+    def test_cache_is_bounded(self):
+        self.config(group='fwaas', compiled_rule_cache_size=2)
+        firewall = fwaas.IptablesFwaasDriver()
+        for rule in self._fake_rules(5):
+            firewall._convert_fwaas_to_iptables_rule(rule)
+        stats = firewall.get_compile_cache_stats()['rules']
+        self.assertEqual(2, stats['size'])
+        self.assertEqual(2, stats['maxsize'])
+        self.assertEqual(5, stats['misses'])
+
+
+class IptablesFwaasPortUpdateTestCase(IptablesFwaasIncrementalTestCase):
+    def _update_ports(self, firewall, ports, add_ports, del_ports):
+        ri = self._fake_apply_list()[0][0]
+        self.firewall.create_firewall_group(FW_LEGACY, [(ri, ports)],
+                                            firewall)
+        with mock.patch.object(self.firewall, '_compile_chains') as compile:
+            self.firewall.update_firewall_group_ports(
+                FW_LEGACY, [(ri, add_ports)] if add_ports else [],
+                [(ri, del_ports)] if del_ports else [], firewall)
+            # the policy chains are not compiled again
+            compile.assert_not_called()
+        return ri.iptables_manager
+
+    def test_add_port_only_adds_its_jumps(self):
+        firewall = self._fake_firewall(self._fake_rules(3))
+        ipt_mgr = self._update_ports(firewall, FAKE_PORT_IDS[:1],
+                                     FAKE_PORT_IDS[1:], [])
+        self._assert_same_rules(ipt_mgr, self._full_build(firewall))
+
+    def test_remove_port_only_removes_its_jumps(self):
+        firewall = self._fake_firewall(self._fake_rules(3))
+        ipt_mgr = self._update_ports(firewall, FAKE_PORT_IDS,
+                                     [], FAKE_PORT_IDS[1:])
+        self._assert_same_rules(
+            ipt_mgr, self._full_build(firewall, FAKE_PORT_IDS[:1]))
+
+    def test_move_port_without_incremental_apply(self):
+        self.config(group='fwaas', incremental_apply=False)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+        firewall = self._fake_firewall(self._fake_rules(3))
+        ipt_mgr = self._update_ports(firewall, FAKE_PORT_IDS[:1],
+                                     FAKE_PORT_IDS[1:], FAKE_PORT_IDS[:1])
+        self._assert_same_rules(
+            ipt_mgr, self._full_build(firewall, FAKE_PORT_IDS[1:]))
+
+    def test_policy_change_falls_back_to_delete_and_update(self):
+        ri = self._fake_apply_list()[0][0]
+        firewall = self._fake_firewall(self._fake_rules(3))
+        self.firewall.create_firewall_group(
+            FW_LEGACY, [(ri, FAKE_PORT_IDS[:1])], firewall)
+        firewall = self._fake_firewall(self._fake_rules(4))
+        add_list = [(ri, FAKE_PORT_IDS[1:])]
+        del_list = [(ri, FAKE_PORT_IDS[:1])]
+        with mock.patch.object(self.firewall,
+                               'delete_firewall_group') as delete, \
+                mock.patch.object(self.firewall,
+                                  'update_firewall_group') as update:
+            self.firewall.update_firewall_group_ports(
+                FW_LEGACY, add_list, del_list, firewall)
+        delete.assert_called_once_with(FW_LEGACY, del_list, firewall)
+        update.assert_called_once_with(FW_LEGACY, add_list, firewall)
+
+    def test_removing_the_last_port_falls_back_to_delete(self):
+        ri = self._fake_apply_list()[0][0]
+        firewall = self._fake_firewall(self._fake_rules(3))
+        self.firewall.create_firewall_group(
+            FW_LEGACY, [(ri, FAKE_PORT_IDS)], firewall)
+        del_list = [(ri, FAKE_PORT_IDS)]
+        with mock.patch.object(self.firewall,
+                               'delete_firewall_group') as delete:
+            self.firewall.update_firewall_group_ports(
+                FW_LEGACY, [], del_list, firewall)
+        delete.assert_called_once_with(FW_LEGACY, del_list, firewall)
+
+
+class IptablesFwaasSharePolicyChainsTestCase(
+        IptablesFwaasIncrementalTestCase):
+    def setUp(self):
+        super(IptablesFwaasSharePolicyChainsTestCase, self).setUp()
+        self.config(group='fwaas', share_policy_chains=True)
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack = mock.Mock()
+        self.ri = self._fake_apply_list()[0][0]
+        self.ipt_mgr = self.ri.iptables_manager
+
+    def _policy_firewall(self, fwid, rule_count=3):
+        firewall = self._fake_firewall(self._fake_rules(rule_count))
+        firewall['id'] = fwid
+        firewall['ingress_firewall_policy_id'] = 'ingress-policy'
+        firewall['egress_firewall_policy_id'] = 'egress-policy'
+        return firewall
+
+    def _rule_chains(self):
+        return sorted(chain for chain in self.ipt_mgr.ipv4['filter'].chains
+                      if chain[:3] in ('iv4', 'ov4'))
+
+    def _jump_targets(self):
+        return sorted(set(rule.rule.split()[-1]
+                          for rule in self.ipt_mgr.ipv4['filter'].rules
+                          if rule.chain == 'FORWARD' and
+                          rule.rule.split()[-1][-11:-8] in ('iv4', 'ov4')))
+
+    def test_groups_with_the_same_policy_share_chains(self):
+        firewall1 = self._policy_firewall('fake-fw-uuid1')
+        firewall2 = self._policy_firewall('fake-fw-uuid2')
+        self.firewall.create_firewall_group(
+            FW_LEGACY, [(self.ri, FAKE_PORT_IDS[:1])], firewall1)
+        rules_count = len(self.ipt_mgr.ipv4['filter'].rules)
+        self.firewall.create_firewall_group(
+            FW_LEGACY, [(self.ri, FAKE_PORT_IDS[1:])], firewall2)
+
+        chains = self._rule_chains()
+        self.assertEqual(2, len(chains))
+        self.assertTrue(all(chain[3] == fwaas.SHARED_CHAIN_ID_PREFIX
+                            for chain in chains))
+        # the second group only adds the jumps of its interface
+        self.assertEqual(rules_count + 4,
+                         len(self.ipt_mgr.ipv4['filter'].rules))
+        self.assertEqual(chains, [target.split('-')[-1]
+                                  for target in self._jump_targets()])
+
+    def test_shared_chains_are_removed_with_their_last_group(self):
+        firewall1 = self._policy_firewall('fake-fw-uuid1')
+        firewall2 = self._policy_firewall('fake-fw-uuid2')
+        apply_list1 = [(self.ri, FAKE_PORT_IDS[:1])]
+        apply_list2 = [(self.ri, FAKE_PORT_IDS[1:])]
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list1,
+                                            firewall1)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list2,
+                                            firewall2)
+        chains = self._rule_chains()
+
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list1,
+                                            firewall1)
+        self.assertEqual(chains, self._rule_chains())
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list2,
+                                            firewall2)
+        self.assertEqual([], self._rule_chains())
+        self.assertEqual({}, self.firewall.shared_chains)
+
+    def test_group_moves_to_the_chains_of_its_new_rules(self):
+        firewall1 = self._policy_firewall('fake-fw-uuid1')
+        firewall2 = self._policy_firewall('fake-fw-uuid2')
+        self.firewall.create_firewall_group(
+            FW_LEGACY, [(self.ri, FAKE_PORT_IDS[:1])], firewall1)
+        self.firewall.create_firewall_group(
+            FW_LEGACY, [(self.ri, FAKE_PORT_IDS[1:])], firewall2)
+        chains = self._rule_chains()
+
+        self.firewall.update_firewall_group(
+            FW_LEGACY, [(self.ri, FAKE_PORT_IDS[1:])],
+            self._policy_firewall('fake-fw-uuid2', rule_count=4))
+        new_chains = self._rule_chains()
+        self.assertEqual(4, len(new_chains))
+        self.assertTrue(set(chains) < set(new_chains))
+        self.assertEqual(new_chains, [target.split('-')[-1]
+                                      for target in self._jump_targets()])
+
+        self.firewall.delete_firewall_group(
+            FW_LEGACY, [(self.ri, FAKE_PORT_IDS[:1])], firewall1)
+        self.assertEqual(sorted(set(new_chains) - set(chains)),
+                         self._rule_chains())
+
+    def test_shared_ipsets_are_kept_while_used(self):
+        ipset_mgr = mock.Mock()
+        self.firewall.ipset_mgrs['qrouter-fake'] = ipset_mgr
+        ipset = ('iPshared', 'IPv4')
+        self.firewall.ipsets['qrouter-fake'] = {'fwg1': {ipset},
+                                                'fwg2': {ipset}}
+        self.firewall._remove_unused_ipsets('fwg1', self.ipt_mgr, {})
+        ipset_mgr.destroy.assert_not_called()
+        self.firewall._remove_unused_ipsets('fwg2', self.ipt_mgr, {})
+        ipset_mgr.destroy.assert_called_once_with(*ipset)
@@ -101,16 +101,6 @@ class ConntrackLegacyTestCase(base.BaseTestCase):
         self.conntrack_driver = legacy_conntrack.ConntrackLegacy()
         self.conntrack_driver.initialize(execute=self.utils_exec)
 
-    def test_normalize_filters_tuple(self):
-        self.assertEqual(
-            (4, 'udp', [], [], '', ''),
-            legacy_conntrack.normalize_filters_tuple(
-                (4, 'udp', [], [], None, None)))
-        self.assertEqual(
-            (4, '', [], [], '', ''),
-            legacy_conntrack.normalize_filters_tuple(
-                (4, None, [], [], None, None)))
-
     def test_excecute_command_failed(self):
         with testtools.ExpectedException(RuntimeError):
             self.conntrack_driver._execute_command(['fake', 'command'])
@@ -176,3 +166,113 @@ class ConntrackLegacyTestCase(base.BaseTestCase):
 
         ]
         self.utils_exec.assert_has_calls(calls)
+
+
+class ConntrackLegacyRuleFiltersTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(ConntrackLegacyRuleFiltersTestCase, self).setUp()
+        self.config(group='fwaas', conntrack_rule_filters=True)
+        self.utils_exec = mock.Mock()
+        self.conntrack_driver = legacy_conntrack.ConntrackLegacy()
+        self.conntrack_driver.initialize(execute=self.utils_exec)
+        self.list_entries = mock.patch.object(
+            self.conntrack_driver, 'list_entries').start()
+
+    def _deleted_filters(self):
+        prefix = ['ip', 'netns', 'exec', ROUTER_NAMESPACE, 'conntrack', '-D']
+        filters = []
+        for call in self.utils_exec.call_args_list:
+            cmd = call[0][0]
+            self.assertEqual(prefix, cmd[:len(prefix)])
+            filters.append(cmd[len(prefix):])
+        return filters
+
+    def test_get_conntrack_filters(self):
+        get_filters = legacy_conntrack.ConntrackLegacy._get_conntrack_filters
+        self.assertEqual([['-f', 'ipv4']], get_filters({'ip_version': 4}))
+        self.assertEqual(
+            [['-f', 'ipv6', '-p', 'icmpv6']],
+            get_filters({'ip_version': 6, 'protocol': 'ipv6-icmp'}))
+        self.assertEqual(
+            [['-f', 'ipv6', '-p', 'icmpv6']],
+            get_filters({'ip_version': 6, 'protocol': 'icmp'}))
+        self.assertEqual(
+            [['-f', 'ipv4', '-p', 'tcp', '--dport', '80']],
+            get_filters({'ip_version': 4, 'protocol': 'tcp',
+                         'destination_port': '80'}))
+        self.assertEqual(
+            [['-f', 'ipv4', '-p', 'udp', '--sport', '1', '--dport', '53'],
+             ['-f', 'ipv4', '-p', 'udp', '--sport', '2', '--dport', '53']],
+            get_filters({'ip_version': 4, 'protocol': 'udp',
+                         'source_port': '1:2', 'destination_port': '53'}))
+
+    def test_get_conntrack_filters_unexpressable(self):
+        get_filters = legacy_conntrack.ConntrackLegacy._get_conntrack_filters
+        self.assertIsNone(get_filters({'ip_version': 4, 'protocol': 'sctp'}))
+        self.assertIsNone(get_filters({'ip_version': 4, 'protocol': 'tcp',
+                                       'destination_port': '1:1024'}))
+        # 5 source ports by 4 destination ports
+        self.assertIsNone(get_filters({'ip_version': 4, 'protocol': 'tcp',
+                                       'source_port': '1:5',
+                                       'destination_port': '1:4'}))
+
+    def test_delete_entries(self):
+        rules = [{'ip_version': 4, 'protocol': 'icmp'},
+                 {'ip_version': 4, 'protocol': 'tcp',
+                  'destination_port': '22:23'},
+                 # same filters as the previous rule
+                 {'ip_version': 4, 'protocol': 'tcp',
+                  'destination_port': '22:23'}]
+        self.conntrack_driver.delete_entries(rules, ROUTER_NAMESPACE)
+        self.assertEqual(
+            [['-f', 'ipv4', '-p', 'icmp'],
+             ['-f', 'ipv4', '-p', 'tcp', '--dport', '22'],
+             ['-f', 'ipv4', '-p', 'tcp', '--dport', '23']],
+            self._deleted_filters())
+        self.utils_exec.assert_called_with(
+            mock.ANY, check_exit_code=True, extra_ok_codes=[1],
+            run_as_root=True, privsep_exec=True)
+        self.list_entries.assert_not_called()
+
+    def test_delete_entries_falls_back_to_listing(self):
+        self.list_entries.return_value = [TCP_ENTRY, UDP_ENTRY]
+        rules = [{'ip_version': 4, 'protocol': 'icmp'},
+                 {'ip_version': 4, 'protocol': 'tcp',
+                  'destination_port': '0:1024'}]
+        self.conntrack_driver.delete_entries(rules, ROUTER_NAMESPACE)
+        self.list_entries.assert_called_once_with(ROUTER_NAMESPACE)
+        self.assertEqual(
+            [['-f', 'ipv4', '-p', 'icmp'],
+             ['-f', 'ipv4', '-p', 'tcp', '--sport', 1, '--dport', 2,
+              '-s', '1.1.1.1', '-d', '2.2.2.2']],
+            self._deleted_filters())
+
+
+class ConntrackLegacyMatcherTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(ConntrackLegacyMatcherTestCase, self).setUp()
+        self.utils_exec = mock.Mock()
+        self.conntrack_driver = legacy_conntrack.ConntrackLegacy()
+        self.conntrack_driver.initialize(execute=self.utils_exec)
+
+    def test_parse_entry_with_reply_source(self):
+        self.assertEqual(
+            (4, 'tcp', 36567, 5000, '1.1.1.1', '2.2.2.2', '2.2.2.2'),
+            self.conntrack_driver._parse_entry(
+                CONNTRACK_LIST.splitlines()[1].split(), 4))
+
+    def test_delete_entries_by_address(self):
+        in_subnet = (4, 'tcp', 1, 22, '10.0.0.5', '8.8.8.8', '8.8.8.8')
+        out_of_subnet = (4, 'tcp', 1, 22, '10.0.1.5', '8.8.8.8', '8.8.8.8')
+        to_floating_ip = (4, 'tcp', 1, 22, '8.8.8.8', '172.24.4.10',
+                          '10.0.0.6')
+        rules = [{'ip_version': 4, 'protocol': 'tcp',
+                  'source_ip_address': '10.0.0.0/24'},
+                 {'ip_version': 4, 'protocol': 'tcp',
+                  'destination_ip_address': '10.0.0.6'}]
+        with mock.patch.object(self.conntrack_driver, 'list_entries',
+                               return_value=[in_subnet, out_of_subnet,
+                                             to_floating_ip]):
+            self.conntrack_driver.delete_entries(rules, ROUTER_NAMESPACE)
+        deleted = [call[0][0][15] for call in self.utils_exec.call_args_list]
+        self.assertEqual(['10.0.0.5', '8.8.8.8'], deleted)
@@ -0,0 +1,332 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import copy
+from unittest import mock
+
+from neutron.tests import base
+from neutron_lib.exceptions import firewall_v2 as fw_ext
+from oslo_serialization import jsonutils
+
+import neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux.\
+    nftables_fwaas_v2 as fwaas
+
+
+FAKE_FW_ID = 'fake-fw-uuid'
+FAKE_NAMESPACE = 'qrouter-fake-uuid'
+FAKE_PORT_IDS = ('1_fake-port-uuid', '2_fake-port-uuid')
+FW_LEGACY = 'legacy'
+TABLE = 'inet neutron-fwaas'
+
+
+class NftablesFwaasTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(NftablesFwaasTestCase, self).setUp()
+        self.firewall = fwaas.NftablesFwaasDriver()
+        # no table in the namespace
+        self.firewall.execute = mock.Mock(return_value='')
+        self.firewall.conntrack = mock.Mock()
+
+    def _fake_apply_list(self, distributed=False):
+        router_info_inst = mock.Mock()
+        router_info_inst.router = {'distributed': distributed}
+        router_info_inst.iptables_manager.namespace = FAKE_NAMESPACE
+        return [(router_info_inst, list(FAKE_PORT_IDS))]
+
+    def _fake_rules(self):
+        return [{'enabled': True, 'action': 'allow', 'ip_version': 4,
+                 'protocol': 'tcp', 'destination_port': '22',
+                 'id': 'fake-fw-rule1'},
+                {'enabled': True, 'action': 'allow', 'ip_version': 4,
+                 'protocol': 'tcp', 'destination_port': '8000:8080',
+                 'id': 'fake-fw-rule2'},
+                {'enabled': False, 'action': 'allow', 'ip_version': 4,
+                 'protocol': 'tcp', 'destination_port': '25',
+                 'id': 'fake-fw-rule3'},
+                {'enabled': True, 'action': 'reject', 'ip_version': 4,
+                 'protocol': 'udp', 'source_ip_address': '10.0.0.1',
+                 'id': 'fake-fw-rule4'},
+                {'enabled': True, 'action': 'deny', 'ip_version': 6,
+                 'protocol': 'icmp', 'id': 'fake-fw-rule5'}]
+
+    def _fake_firewall(self, rule_list, admin_state_up=True, fwid=FAKE_FW_ID):
+        return {'id': fwid,
+                'admin_state_up': admin_state_up,
+                'tenant_id': 'tenant-uuid',
+                'egress_rule_list': copy.deepcopy(rule_list),
+                'ingress_rule_list': copy.deepcopy(rule_list)}
+
+    def _get_transaction(self):
+        cmd = ['ip', 'netns', 'exec', FAKE_NAMESPACE, 'nft', '-f', '-']
+        self.assertEqual(cmd, self.firewall.execute.call_args[0][0])
+        return self.firewall.execute.call_args[1][
+            'process_input'].splitlines()
+
+    def test_compile_rules_folds_sets(self):
+        self.assertEqual(
+            ['meta nfproto ipv4 meta l4proto tcp tcp dport { 22, 8000-8080 } '
+             'accept',
+             'meta nfproto ipv4 meta l4proto udp ip saddr 10.0.0.1/32 '
+             'reject with icmpx type port-unreachable',
+             'meta nfproto ipv6 meta l4proto ipv6-icmp drop'],
+            self.firewall._compile_rules(self._fake_rules()))
+
+    def test_compile_rules_keeps_order(self):
+        rules = [{'enabled': True, 'action': 'allow', 'ip_version': 4,
+                  'protocol': 'tcp', 'destination_port': '22',
+                  'source_ip_address': '10.0.0.1', 'id': 'r1'},
+                 {'enabled': True, 'action': 'allow', 'ip_version': 4,
+                  'protocol': 'tcp', 'destination_port': '22',
+                  'source_ip_address': '10.0.0.2', 'id': 'r2'},
+                 # differs in two fields, starts a new run
+                 {'enabled': True, 'action': 'allow', 'ip_version': 4,
+                  'protocol': 'tcp', 'destination_port': '23',
+                  'source_ip_address': '10.0.0.3', 'id': 'r3'},
+                 {'enabled': True, 'action': 'deny', 'ip_version': 4,
+                  'protocol': 'tcp', 'destination_port': '23',
+                  'source_ip_address': '10.0.0.4', 'id': 'r4'},
+                 # "any" address cannot be folded with an address
+                 {'enabled': True, 'action': 'deny', 'ip_version': 4,
+                  'protocol': 'tcp', 'destination_port': '23', 'id': 'r5'}]
+        self.assertEqual(
+            ['meta nfproto ipv4 meta l4proto tcp '
+             'ip saddr { 10.0.0.1/32, 10.0.0.2/32 } tcp dport 22 accept',
+             'meta nfproto ipv4 meta l4proto tcp ip saddr 10.0.0.3/32 '
+             'tcp dport 23 accept',
+             'meta nfproto ipv4 meta l4proto tcp ip saddr 10.0.0.4/32 '
+             'tcp dport 23 drop',
+             'meta nfproto ipv4 meta l4proto tcp tcp dport 23 drop'],
+            self.firewall._compile_rules(rules))
+
+    def _fake_run_rules(self, field, values):
+        return [{'enabled': True, 'action': 'allow', 'ip_version': 4,
+                 'protocol': 'tcp', field: value, 'id': 'r%d' % idx}
+                for idx, value in enumerate(values)]
+
+    def test_compile_rules_drops_duplicate_values(self):
+        rules = self._fake_run_rules(
+            'source_ip_address', ['10.0.0.1', '10.0.0.2', '10.0.0.1/32'])
+        self.assertEqual(
+            ['meta nfproto ipv4 meta l4proto tcp '
+             'ip saddr { 10.0.0.1/32, 10.0.0.2/32 } accept'],
+            self.firewall._compile_rules(rules))
+
+    def test_compile_rules_splits_overlapping_addresses(self):
+        rules = self._fake_run_rules(
+            'source_ip_address',
+            ['10.0.0.0/8', '192.168.0.0/24', '10.1.0.0/16', '172.16.0.0/12'])
+        self.assertEqual(
+            ['meta nfproto ipv4 meta l4proto tcp '
+             'ip saddr { 10.0.0.0/8, 192.168.0.0/24 } accept',
+             'meta nfproto ipv4 meta l4proto tcp '
+             'ip saddr { 10.1.0.0/16, 172.16.0.0/12 } accept'],
+            self.firewall._compile_rules(rules))
+
+    def test_compile_rules_splits_overlapping_ports(self):
+        rules = self._fake_run_rules(
+            'destination_port', ['80:90', '22', '85', '91:95', '90'])
+        self.assertEqual(
+            ['meta nfproto ipv4 meta l4proto tcp tcp dport { 80-90, 22 } '
+             'accept',
+             'meta nfproto ipv4 meta l4proto tcp tcp dport { 85, 91-95, 90 } '
+             'accept'],
+            self.firewall._compile_rules(rules))
+
+    def test_create_firewall_group(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules())
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        transaction = self._get_transaction()
+        self.assertEqual('add table %s' % TABLE, transaction[0])
+        rules = self.firewall._compile_rules(self._fake_rules())
+        for chain in ('i-%s' % FAKE_FW_ID, 'o-%s' % FAKE_FW_ID):
+            expected = ['add chain %s %s' % (TABLE, chain),
+                        'flush chain %s %s' % (TABLE, chain),
+                        'add rule %s %s ct state invalid drop' % (TABLE,
+                                                                  chain),
+                        'add rule %s %s ct state established,related '
+                        'accept' % (TABLE, chain)]
+            expected += ['add rule %s %s %s' % (TABLE, chain, rule)
+                         for rule in rules]
+            start = transaction.index(expected[0])
+            self.assertEqual(expected,
+                             transaction[start:start + len(expected)])
+        self.assertIn('add element %s ingress-ports { '
+                      '"qr-1_fake-port" : jump i-fake-fw-uuid, '
+                      '"qr-2_fake-port" : jump i-fake-fw-uuid }' % TABLE,
+                      transaction)
+        self.assertIn('add element %s firewall-ports { '
+                      '"qr-1_fake-port", "qr-2_fake-port" }' % TABLE,
+                      transaction)
+        self.firewall.conntrack.flush_entries.assert_called_once_with(
+            FAKE_NAMESPACE)
+
+    def test_update_firewall_group_keeps_other_groups(self):
+        apply_list = self._fake_apply_list()
+        other_apply_list = self._fake_apply_list()
+        other_apply_list[0][1][:] = ['3_fake-port-uuid']
+        firewall = self._fake_firewall(self._fake_rules())
+        other_firewall = self._fake_firewall([], fwid='other-fw-uuid')
+        self.firewall.create_firewall_group(FW_LEGACY, other_apply_list,
+                                            other_firewall)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        rules = self._fake_rules()
+        del rules[0]
+        firewall = self._fake_firewall(rules)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        transaction = self._get_transaction()
+        # only the chains and elements of the updated group are rewritten
+        self.assertNotIn('flush chain %s i-other-fw-uuid' % TABLE,
+                         transaction)
+        self.assertNotIn('flush map %s ingress-ports' % TABLE, transaction)
+        self.assertFalse([line for line in transaction
+                          if 'qr-3_fake-port' in line])
+        self.assertIn('delete element %s ingress-ports { '
+                      '"qr-1_fake-port", "qr-2_fake-port" }' % TABLE,
+                      transaction)
+        self.assertNotIn('delete element %s firewall-ports' % TABLE,
+                         transaction)
+        self.firewall.conntrack.delete_entries.assert_called_once_with(
+            [self._fake_rules()[0]] * 2, FAKE_NAMESPACE)
+
+    def test_apply_default_policy(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules(),
+                                       admin_state_up=False)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        transaction = self._get_transaction()
+        # empty chains, the ports set drops all the packets
+        self.assertNotIn('delete chain %s i-%s' % (TABLE, FAKE_FW_ID),
+                         transaction)
+        self.assertFalse([line for line in transaction
+                          if line.startswith('add rule %s i-' % TABLE)])
+        self.assertIn('add rule %s forward oifname @firewall-ports drop' %
+                      TABLE, transaction)
+        self.assertIn('add element %s firewall-ports { '
+                      '"qr-1_fake-port", "qr-2_fake-port" }' % TABLE,
+                      transaction)
+
+    def test_delete_last_firewall_group_removes_table(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules())
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(['add table %s' % TABLE,
+                          'delete table %s' % TABLE],
+                         self._get_transaction())
+        self.assertEqual({}, self.firewall.namespaces)
+        self.assertNotIn(FAKE_FW_ID, self.firewall.fwg_states)
+
+    def test_apply_failure_raises_driver_error(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules())
+        self.firewall.execute.side_effect = RuntimeError()
+        self.assertRaises(fw_ext.FirewallInternalDriverError,
+                          self.firewall.create_firewall_group,
+                          FW_LEGACY, apply_list, firewall)
+
+    def _fake_table(self, groups):
+        """nft -j list table output of groups: fwid -> interfaces"""
+        objects = [{'table': {'family': 'inet', 'name': 'neutron-fwaas'}},
+                   {'chain': {'family': 'inet', 'table': 'neutron-fwaas',
+                              'name': 'forward'}}]
+        for fwid in groups:
+            for prefix in ('i', 'o'):
+                objects.append({'chain': {'family': 'inet',
+                                          'table': 'neutron-fwaas',
+                                          'name': '%s-%s' % (prefix, fwid)}})
+        for name, prefix in (('ingress-ports', 'i'), ('egress-ports', 'o')):
+            elements = [
+                [ifname, {'jump': {'target': '%s-%s' % (prefix, fwid)}}]
+                for fwid, ifnames in sorted(groups.items())
+                for ifname in ifnames]
+            objects.append({'map': {'family': 'inet',
+                                    'table': 'neutron-fwaas', 'name': name,
+                                    'type': 'ifname', 'map': 'verdict',
+                                    'elem': elements}})
+        objects.append({'set': {'family': 'inet', 'table': 'neutron-fwaas',
+                                'name': 'firewall-ports', 'type': 'ifname',
+                                'elem': sorted(ifname for ifnames in
+                                               groups.values()
+                                               for ifname in ifnames)}})
+        return jsonutils.dumps({'nftables': objects})
+
+    def test_update_firewall_group_after_restart(self):
+        # groups applied before the agent restarted
+        self.firewall.execute.return_value = self._fake_table({
+            FAKE_FW_ID: ['qr-1_fake-port'],
+            'other-fw-uuid': ['qr-3_fake-port'],
+            'moved-fw-uuid': ['qr-2_fake-port'],
+            'deleted-fw-uuid': []})
+        self.assertEqual({}, self.firewall.namespaces)
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules())
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(
+            mock.call(['ip', 'netns', 'exec', FAKE_NAMESPACE, 'nft', '-j',
+                       'list', 'table', 'inet', 'neutron-fwaas'],
+                      run_as_root=True, check_exit_code=False,
+                      log_fail_as_error=False, privsep_exec=True),
+            self.firewall.execute.call_args_list[0])
+        transaction = self._get_transaction()
+        # the elements of the other groups are kept
+        self.assertNotIn('flush map %s ingress-ports' % TABLE, transaction)
+        self.assertNotIn('flush set %s firewall-ports' % TABLE, transaction)
+        self.assertFalse([line for line in transaction
+                          if 'qr-3_fake-port' in line or
+                          'other-fw-uuid' in line])
+        # qr-2 is taken over from moved-fw-uuid
+        self.assertIn('delete element %s ingress-ports { '
+                      '"qr-1_fake-port", "qr-2_fake-port" }' % TABLE,
+                      transaction)
+        self.assertNotIn('delete element %s firewall-ports' % TABLE,
+                         transaction)
+        self.assertIn('add element %s egress-ports { '
+                      '"qr-1_fake-port" : jump o-fake-fw-uuid, '
+                      '"qr-2_fake-port" : jump o-fake-fw-uuid }' % TABLE,
+                      transaction)
+        # the groups left without ports are removed
+        for fwid in ('moved-fw-uuid', 'deleted-fw-uuid'):
+            self.assertIn('delete chain %s i-%s' % (TABLE, fwid),
+                          transaction)
+            self.assertIn('delete chain %s o-%s' % (TABLE, fwid),
+                          transaction)
+        self.assertEqual(
+            {FAKE_FW_ID: ['qr-1_fake-port', 'qr-2_fake-port'],
+             'other-fw-uuid': ['qr-3_fake-port']},
+            {fwid: group['interfaces'] for fwid, group in
+             self.firewall.namespaces[FAKE_NAMESPACE].items()})
+
+    def test_delete_firewall_group_after_restart(self):
+        self.firewall.execute.return_value = self._fake_table({
+            FAKE_FW_ID: ['qr-1_fake-port', 'qr-2_fake-port'],
+            'other-fw-uuid': ['qr-3_fake-port']})
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules())
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        transaction = self._get_transaction()
+        self.assertIn('delete element %s firewall-ports { '
+                      '"qr-1_fake-port", "qr-2_fake-port" }' % TABLE,
+                      transaction)
+        self.assertIn('delete chain %s i-%s' % (TABLE, FAKE_FW_ID),
+                      transaction)
+        self.assertNotIn('delete table %s' % TABLE, transaction)
+
+    def test_apply_failure_reloads_table(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules())
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.execute.side_effect = RuntimeError()
+        self.assertRaises(fw_ext.FirewallInternalDriverError,
+                          self.firewall.update_firewall_group,
+                          FW_LEGACY, apply_list, firewall)
+        self.assertEqual({}, self.firewall.namespaces)
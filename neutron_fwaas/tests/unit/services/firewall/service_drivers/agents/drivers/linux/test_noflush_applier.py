@@ -0,0 +1,153 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from neutron.agent.linux import iptables_manager
+from neutron.conf.agent import common as agent_config
+from neutron.tests import base
+from neutron_lib import exceptions
+from oslo_config import cfg
+
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import noflush_applier
+
+
+class NoflushApplierTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(NoflushApplierTestCase, self).setUp()
+        self.execute = mock.patch.object(noflush_applier.linux_utils,
+                                         'execute').start()
+        mock.patch.object(iptables_manager.IptablesManager,
+                          'use_table_lock', False).start()
+        self.ipt_mgr = iptables_manager.IptablesManager(
+            namespace='qrouter-fake', external_lock=False)
+        self.ipt_mgr.defer_apply_off = mock.Mock()
+        self.table = self.ipt_mgr.ipv4['filter']
+        self.table.add_rule('FORWARD', '-j $scope')
+        self.applier = noflush_applier.NoflushApplier(
+            lambda name: name.startswith('fw'))
+        self.bname = self.ipt_mgr.wrap_name
+
+    def _payload(self):
+        self.assertEqual(1, self.execute.call_count)
+        args, kwargs = self.execute.call_args
+        self.assertEqual(['ip', 'netns', 'exec', 'qrouter-fake',
+                          'iptables-restore', '-n'], args[0])
+        return kwargs['process_input'].replace(self.bname, 'bin').split('\n')
+
+    def test_first_apply_applies_everything(self):
+        self.table.add_chain('fw-a')
+        self.applier.apply(self.ipt_mgr)
+        self.ipt_mgr.defer_apply_off.assert_called_once_with()
+        self.execute.assert_not_called()
+
+        self.applier.apply(self.ipt_mgr)
+        self.assertEqual(1, self.ipt_mgr.defer_apply_off.call_count)
+        self.execute.assert_not_called()
+
+    def test_only_changed_chains_are_restored(self):
+        self.table.add_chain('fw-a')
+        self.table.add_chain('fw-b')
+        self.table.add_rule('fw-a', '-j DROP')
+        self.applier.apply(self.ipt_mgr)
+
+        self.table.add_rule('fw-b', '-p tcp -j ACCEPT')
+        self.table.add_rule('fw-b', '-j NFLOG', top=True)
+        self.applier.apply(self.ipt_mgr)
+        self.assertEqual(['*filter',
+                          ':bin-fw-b - [0:0]',
+                          '-A bin-fw-b -j NFLOG',
+                          '-A bin-fw-b -p tcp -j ACCEPT',
+                          'COMMIT', ''], self._payload())
+        self.assertEqual(1, self.ipt_mgr.defer_apply_off.call_count)
+
+    def test_forward_jumps_keep_their_position(self):
+        self.table.add_chain('fw-a')
+        self.table.add_rule('FORWARD', '-o qr-1 -j $fw-a')
+        self.applier.apply(self.ipt_mgr)
+
+        self.table.add_rule('FORWARD', '-j $local')
+        self.table.add_rule('FORWARD', '-o qr-2 -j $fw-a')
+        self.applier.apply(self.ipt_mgr)
+        self.assertEqual(['*filter',
+                          '-D bin-FORWARD -o qr-1 -j bin-fw-a',
+                          '-I bin-FORWARD 2 -o qr-1 -j bin-fw-a',
+                          '-I bin-FORWARD 4 -o qr-2 -j bin-fw-a',
+                          'COMMIT', ''], self._payload())
+
+    def test_removed_chains_are_deleted(self):
+        self.table.add_chain('fw-a')
+        self.table.add_rule('FORWARD', '-o qr-1 -j $fw-a')
+        self.applier.apply(self.ipt_mgr)
+
+        self.table.remove_chain('fw-a')
+        self.applier.apply(self.ipt_mgr)
+        self.assertEqual(['*filter',
+                          ':bin-fw-a - [0:0]',
+                          '-D bin-FORWARD -o qr-1 -j bin-fw-a',
+                          '-X bin-fw-a',
+                          'COMMIT', ''], self._payload())
+
+    def test_failure_falls_back_to_full_apply(self):
+        self.table.add_chain('fw-a')
+        self.applier.apply(self.ipt_mgr)
+        self.table.add_rule('fw-a', '-j DROP')
+        self.execute.side_effect = RuntimeError()
+        self.applier.apply(self.ipt_mgr)
+        self.assertEqual(2, self.ipt_mgr.defer_apply_off.call_count)
+
+        # what the full apply wrote is known again
+        self.execute.reset_mock()
+        self.applier.apply(self.ipt_mgr)
+        self.execute.assert_not_called()
+
+    def test_restore_waits_for_the_xtables_lock(self):
+        agent_config.register_agent_state_opts_helper(cfg.CONF)
+        self.table.add_chain('fw-a')
+        self.applier.apply(self.ipt_mgr)
+        self.table.add_rule('fw-a', '-j DROP')
+        self.execute.side_effect = [
+            exceptions.ProcessExecutionError(
+                'Another app is currently holding the xtables lock',
+                iptables_manager.XTABLES_RESOURCE_PROBLEM_CODE),
+            None]
+        self.applier.apply(self.ipt_mgr)
+        self.assertEqual(1, self.ipt_mgr.defer_apply_off.call_count)
+        cmd = ['ip', 'netns', 'exec', 'qrouter-fake', 'iptables-restore',
+               '-n']
+        self.assertEqual(cmd, self.execute.call_args_list[0][0][0])
+        self.assertFalse(
+            self.execute.call_args_list[0][1]['log_fail_as_error'])
+        self.assertEqual(
+            cmd + ['-w', self.ipt_mgr.xlock_wait_time,
+                   '-W', iptables_manager.XLOCK_WAIT_INTERVAL],
+            self.execute.call_args_list[1][0][0])
+
+        # the lock is then always waited for
+        self.assertTrue(self.ipt_mgr.use_table_lock)
+        self.execute.reset_mock(side_effect=True)
+        self.table.add_rule('fw-a', '-j ACCEPT')
+        self.applier.apply(self.ipt_mgr)
+        self.assertEqual(1, self.execute.call_count)
+        self.assertIn('-w', self.execute.call_args[0][0])
+
+    def test_restore_failure_is_not_retried(self):
+        self.table.add_chain('fw-a')
+        self.applier.apply(self.ipt_mgr)
+        self.table.add_rule('fw-a', '-j DROP')
+        self.execute.side_effect = exceptions.ProcessExecutionError(
+            'iptables-restore: line 3 failed', 1)
+        self.applier.apply(self.ipt_mgr)
+        self.assertEqual(1, self.execute.call_count)
+        self.assertEqual(2, self.ipt_mgr.defer_apply_off.call_count)
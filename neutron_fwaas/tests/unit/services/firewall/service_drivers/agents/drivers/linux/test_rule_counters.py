@@ -0,0 +1,53 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from neutron.tests import base
+
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import rule_counters
+
+SAVE_OUTPUT = """# Generated by iptables-save v1.8.7
+*filter
+:INPUT ACCEPT [10:600]
+:FORWARD ACCEPT [0:0]
+:bin-iv4fake-fw- - [0:0]
+[12:960] -A FORWARD -j bin-FORWARD
+[3:180] -A bin-iv4fake-fw- -m state --state INVALID -j bin-dropped
+[7:420] -A bin-iv4fake-fw- -p tcp -m tcp --dport 22 -j bin-accepted
+[0:0] -A bin-accepted -j ACCEPT
+COMMIT
+"""
+
+
+class RuleCountersTestCase(base.BaseTestCase):
+
+    def test_parse_counters(self):
+        self.assertEqual(
+            {'FORWARD': [('-j bin-FORWARD', 12, 960)],
+             'bin-iv4fake-fw-': [
+                 ('-m state --state INVALID -j bin-dropped', 3, 180),
+                 ('-p tcp -m tcp --dport 22 -j bin-accepted', 7, 420)],
+             'bin-accepted': [('-j ACCEPT', 0, 0)]},
+            rule_counters.parse_counters(SAVE_OUTPUT))
+
+    def test_read_counters(self):
+        with mock.patch.object(rule_counters.linux_utils, 'execute',
+                               return_value=SAVE_OUTPUT) as execute:
+            counters = rule_counters.read_counters('qrouter-fake',
+                                                   'ip6tables')
+        execute.assert_called_once_with(
+            ['ip', 'netns', 'exec', 'qrouter-fake',
+             'ip6tables-save', '-c', '-t', 'filter'],
+            run_as_root=True, privsep_exec=True)
+        self.assertEqual(4, sum(len(rules) for rules in counters.values()))
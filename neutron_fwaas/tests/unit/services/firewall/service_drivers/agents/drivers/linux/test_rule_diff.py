@@ -0,0 +1,67 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from neutron.tests import base
+
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import rule_diff
+
+
+def _rule(rule_id, **kwargs):
+    rule = {'id': rule_id, 'enabled': True, 'action': 'allow',
+            'protocol': 'tcp', 'ip_version': 4}
+    rule.update(kwargs)
+    return rule
+
+
+def _firewall(egress, ingress):
+    return {'egress_rule_list': egress, 'ingress_rule_list': ingress}
+
+
+class RuleDiffTestCase(base.BaseTestCase):
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            rule_diff.rule_fingerprint(_rule('r1', destination_port='22')),
+            rule_diff.rule_fingerprint(_rule('r1', destination_port='22')))
+        self.assertNotEqual(
+            rule_diff.rule_fingerprint(_rule('r1', destination_port='22')),
+            rule_diff.rule_fingerprint(_rule('r1', destination_port='23')))
+        # nested values are hashable too
+        hash(rule_diff.rule_fingerprint(_rule('r1', tags=['a', {'b': 1}])))
+
+    def test_unchanged(self):
+        firewall = _firewall([_rule('r1'), _rule('r2')], [_rule('r3')])
+        diff = rule_diff.diff_firewall_rules(firewall, firewall)
+        self.assertEqual(rule_diff.RuleDiff([], [], []), diff)
+
+    def test_changed_added_removed(self):
+        pre_firewall = _firewall(
+            [_rule('r1'), _rule('r2'), _rule('r3')],
+            [_rule('r4'), _rule('r5')])
+        firewall = _firewall(
+            [_rule('r6'), _rule('r3', action='deny'), _rule('r1')],
+            [_rule('r5', protocol='udp'), _rule('r7')])
+        diff = rule_diff.diff_firewall_rules(pre_firewall, firewall)
+        self.assertEqual([_rule('r3'), _rule('r3', action='deny'),
+                          _rule('r5'), _rule('r5', protocol='udp')],
+                         diff.changed)
+        self.assertEqual([_rule('r6'), _rule('r7')], diff.added)
+        self.assertEqual([_rule('r2'), _rule('r4')], diff.removed)
+
+    def test_rule_moved_between_directions(self):
+        pre_firewall = _firewall([_rule('r1')], [])
+        firewall = _firewall([], [_rule('r1')])
+        diff = rule_diff.diff_firewall_rules(pre_firewall, firewall)
+        self.assertEqual([], diff.changed)
+        self.assertEqual([_rule('r1')], diff.added)
+        self.assertEqual([_rule('r1')], diff.removed)
@@ -0,0 +1,86 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from neutron.tests import base
+
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import rule_optimizer
+
+
+def _rule(rule_id, protocol=None, source=None, destination=None,
+          destination_port=None, action='allow', ip_version=4, enabled=True):
+    return {'id': rule_id, 'protocol': protocol,
+            'source_ip_address': source,
+            'destination_ip_address': destination,
+            'source_port': None, 'destination_port': destination_port,
+            'action': action, 'ip_version': ip_version, 'enabled': enabled}
+
+
+class RuleOptimizerTestCase(base.BaseTestCase):
+
+    def test_covers(self):
+        covers = rule_optimizer.covers
+        self.assertTrue(covers(_rule('a'), _rule('b', 'tcp')))
+        self.assertTrue(covers(_rule('a', 'tcp'),
+                               _rule('b', 'tcp', destination_port='80')))
+        self.assertTrue(covers(_rule('a', 'tcp', destination_port='1:1024'),
+                               _rule('b', 'tcp', destination_port='22:80')))
+        self.assertTrue(covers(_rule('a', destination='10.0.0.0/8'),
+                               _rule('b', destination='10.1.0.0/16')))
+        self.assertFalse(covers(_rule('a', 'tcp'), _rule('b')))
+        self.assertFalse(covers(_rule('a', 'tcp'), _rule('b', 'udp')))
+        self.assertFalse(covers(_rule('a', 'tcp', destination_port='80'),
+                                _rule('b', 'tcp', destination_port='79:80')))
+        self.assertFalse(covers(_rule('a', destination='10.1.0.0/16'),
+                                _rule('b', destination='10.0.0.0/8')))
+        self.assertFalse(covers(_rule('a', source='10.0.0.0/8'),
+                                _rule('b')))
+        self.assertFalse(covers(_rule('a'), _rule('b', ip_version=6)))
+
+    def test_disjoint(self):
+        disjoint = rule_optimizer.disjoint
+        self.assertTrue(disjoint(_rule('a', 'tcp'), _rule('b', 'udp')))
+        self.assertTrue(disjoint(_rule('a', 'tcp', destination_port='80'),
+                                 _rule('b', 'tcp', destination_port='81:90')))
+        self.assertTrue(disjoint(_rule('a', destination='10.0.0.0/24'),
+                                 _rule('b', destination='10.0.1.0/24')))
+        self.assertTrue(disjoint(_rule('a'), _rule('b', ip_version=6)))
+        self.assertFalse(disjoint(_rule('a', 'tcp'), _rule('b')))
+        self.assertFalse(disjoint(_rule('a', 'tcp'), _rule('b', '6')))
+        self.assertFalse(disjoint(_rule('a', 'icmp', ip_version=6),
+                                  _rule('b', 'ipv6-icmp', ip_version=6)))
+        self.assertFalse(disjoint(_rule('a', 'tcp', destination_port='80'),
+                                  _rule('b', 'tcp', destination_port='1:80')))
+        self.assertFalse(disjoint(_rule('a', destination='10.0.0.0/8'),
+                                  _rule('b', destination='10.0.1.0/24')))
+        self.assertFalse(disjoint(_rule('a', source='10.0.0.0/8'),
+                                  _rule('b', destination='10.0.1.0/24')))
+
+    def test_remove_shadowed_rules(self):
+        rules = [_rule('a', 'tcp', destination_port='80'),
+                 _rule('b', 'tcp', destination_port='80', action='deny'),
+                 _rule('c', 'tcp', destination='10.0.0.0/8'),
+                 _rule('d', 'tcp', destination='10.0.0.0/24',
+                       destination_port='22'),
+                 _rule('e', 'udp', destination='10.0.0.0/24')]
+        kept, removed = rule_optimizer.remove_shadowed_rules(rules)
+        self.assertEqual(['a', 'c', 'e'], [rule['id'] for rule in kept])
+        self.assertEqual([('b', 'a'), ('d', 'c')],
+                         [(rule['id'], earlier['id'])
+                          for rule, earlier in removed])
+
+    def test_disabled_rules_are_ignored(self):
+        rules = [_rule('a', enabled=False), _rule('b', 'tcp'),
+                 _rule('c', 'tcp', enabled=False)]
+        kept, removed = rule_optimizer.remove_shadowed_rules(rules)
+        self.assertEqual(rules, kept)
+        self.assertEqual([], removed)
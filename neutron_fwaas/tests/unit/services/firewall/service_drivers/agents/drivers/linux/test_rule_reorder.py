@@ -0,0 +1,60 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from neutron.tests import base
+
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import rule_reorder
+
+
+def _rule(rule_id, protocol='tcp', destination_port=None, enabled=True):
+    return {'id': rule_id, 'protocol': protocol,
+            'source_ip_address': None, 'destination_ip_address': None,
+            'source_port': None, 'destination_port': destination_port,
+            'action': 'allow', 'ip_version': 4, 'enabled': enabled}
+
+
+class RuleReorderTestCase(base.BaseTestCase):
+
+    def _reorder(self, rules, hits):
+        return [rule['id'] for rule in rule_reorder.reorder_rules(rules,
+                                                                  hits)]
+
+    def test_hot_rules_move_ahead_of_disjoint_rules(self):
+        rules = [_rule('a', destination_port='22'),
+                 _rule('b', destination_port='80'),
+                 _rule('c', 'udp', destination_port='53')]
+        self.assertEqual(['c', 'b', 'a'],
+                         self._reorder(rules, {'b': 10, 'c': 20}))
+        self.assertEqual(['a', 'b', 'c'], self._reorder(rules, {}))
+
+    def test_overlapping_rules_keep_their_order(self):
+        rules = [_rule('a', destination_port='22'),
+                 _rule('b', destination_port='1:1024'),
+                 _rule('c', destination_port='443'),
+                 _rule('d', 'udp')]
+        # c can not pass b, which a can not pass either
+        self.assertEqual(['d', 'a', 'b', 'c'],
+                         self._reorder(rules, {'c': 30, 'd': 40, 'b': 10}))
+        # d can not pass the hotter c
+        self.assertEqual(['a', 'b', 'c', 'd'],
+                         self._reorder(rules, {'c': 30, 'd': 20, 'b': 10}))
+
+    def test_ties_keep_their_order(self):
+        rules = [_rule('a', destination_port='22'),
+                 _rule('b', destination_port='80')]
+        self.assertEqual(['a', 'b'], self._reorder(rules, {'a': 5, 'b': 5}))
+
+    def test_disabled_rules_are_passed(self):
+        rules = [_rule('a', enabled=False),
+                 _rule('b', destination_port='80')]
+        self.assertEqual(['b', 'a'], self._reorder(rules, {'b': 1}))
@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
 from unittest import mock
 
 from neutron.agent.l3 import l3_agent_extension_api as l3_agent_api
@@ -178,6 +179,31 @@ class TestFWaaSL3AgentExtension(base.BaseTestCase):
             mock_set_firewall_group_status.assert_called_once_with(
                     self.context, firewall_group['id'], 'ACTIVE')
 
+    def test_update_firewall_group_moves_ports_in_one_driver_call(self):
+        firewall_group = {'id': 0, 'project_id': 1,
+                          'admin_state_up': True,
+                          'ports': ['1', '2'],
+                          'add-port-ids': ['1'],
+                          'del-port-ids': ['2'],
+                          'last-port': False}
+        add_ports = [(mock.sentinel.ri, ['1'])]
+        del_ports = [(mock.sentinel.ri, ['2'])]
+
+        with mock.patch.object(self.api, '_get_firewall_group_ports',
+                               side_effect=[del_ports, add_ports]), \
+                mock.patch.object(self.api.fwaas_driver,
+                                  'update_firewall_group_ports'
+                                  ) as mock_driver_update_ports, \
+                mock.patch.object(self.api.fwplugin_rpc,
+                                  'set_firewall_group_status'
+                                  ) as mock_set_firewall_group_status:
+            self.api.update_firewall_group(self.context, firewall_group,
+                                           host='host')
+            mock_driver_update_ports.assert_called_once_with(
+                self.conf.agent_mode, add_ports, del_ports, firewall_group)
+            mock_set_firewall_group_status.assert_called_once_with(
+                self.context, firewall_group['id'], 'ACTIVE')
+
     def test_update_firewall_group_with_ports_added_and_admin_state_down(self):
         firewall_group = {'id': 0, 'project_id': 1,
                           'admin_state_up': False,
@@ -390,6 +416,34 @@ class TestFWaaSL3AgentExtension(base.BaseTestCase):
             mock_set_firewall_group_status.assert_called_once_with(
                     self.context, firewall_group['id'], 'ACTIVE')
 
+    def test_process_rule_counters(self):
+        path = self.get_temp_file_path('rule_counters.json')
+        cfg.CONF.set_override('rule_counters_file', path, 'fwaas')
+        cfg.CONF.set_override('reorder_rules_by_hits', True, 'fwaas')
+        self.api.fwaas_enabled = True
+        counters = [{'firewall_group_id': 'fwg', 'rule_id': 'rule',
+                     'packets': 1, 'bytes': 60}]
+        rejects = [{'namespace': 'qrouter-fake', 'ip_version': 4,
+                    'rejected': 10, 'dropped': 5}]
+        with mock.patch.object(self.api.fwaas_driver, 'get_rule_counters',
+                               return_value=counters), \
+                mock.patch.object(self.api.fwaas_driver,
+                                  'get_reject_counters',
+                                  return_value=rejects), \
+                mock.patch.object(self.api.fwaas_driver,
+                                  'get_compile_cache_stats',
+                                  return_value={'rules': {'hits': 1}}), \
+                mock.patch.object(self.api.fwaas_driver,
+                                  'apply_rule_hit_order') as reorder:
+            self.api._process_rule_counters()
+            reorder.assert_called_once_with()
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        self.assertEqual(counters, snapshot['rules'])
+        self.assertEqual(rejects, snapshot['rejects'])
+        self.assertEqual({'rules': {'hits': 1}}, snapshot['compile_cache'])
+        self.assertIn('timestamp', snapshot)
+
     def test_delete_firewall_group(self):
         firewall_group = {'id': 0, 'project_id': 1,
                           'admin_state_up': True,
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compare the iptables and nftables L3 firewall drivers.
+
+Firewall groups with synthetic rules are applied to one router with both
+drivers. For each driver the script reports the time spent applying the
+groups and the number of rules a packet of the last port of the last group
+walks through when no rule of its group matches, which is the worst case.
+
+By default nothing is executed on the host: iptables-save returns an empty
+ruleset and the iptables-restore and nft input is only generated. With
+--namespace, the rules are applied to that (existing) network namespace,
+which requires root privileges.
+"""
+
+import argparse
+import random
+import time
+from unittest import mock
+
+from neutron.agent.linux import iptables_manager
+from neutron.agent.linux import utils as linux_utils
+from oslo_config import cfg
+
+from neutron_fwaas.services.firewall.service_drivers.agents import \
+    firewall_agent_api  # noqa
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import iptables_fwaas_v2
+from neutron_fwaas.services.firewall.service_drivers.agents.drivers.linux \
+    import nftables_fwaas_v2
+
+
+def _make_rules(count, rand):
+    rules = []
+    for i in range(count):
+        rule = {'id': 'rule-%d' % i,
+                'enabled': True,
+                'ip_version': 4,
+                'protocol': rand.choice(['tcp', 'udp']),
+                'action': rand.choice(['allow', 'allow', 'deny']),
+                'destination_port': str(rand.randint(1, 65535))}
+        if rand.random() < 0.3:
+            rule['source_ip_address'] = '10.%d.%d.0/24' % (
+                rand.randint(0, 255), rand.randint(0, 255))
+        rules.append(rule)
+    return rules
+
+
+def _make_groups(args):
+    rand = random.Random(args.seed)
+    groups = []
+    for i in range(args.groups):
+        rules = _make_rules(args.rules, rand)
+        firewall = {'id': 'fwg-%04d' % i,
+                    'tenant_id': 'tenant',
+                    'admin_state_up': True,
+                    'egress_rule_list': rules,
+                    'ingress_rule_list': rules}
+        ports = ['%04d-%04d-port' % (i, j) for j in range(args.ports)]
+        groups.append((firewall, ports))
+    return groups
+
+
+def _make_router(ipt_mgr):
+    ri = mock.Mock()
+    ri.router = {'distributed': False}
+    ri.iptables_manager = ipt_mgr
+    return ri
+
+
+def _offline_execute(cmd, *args, **kwargs):
+    # empty iptables-save output, anything else is only generated
+    return ''
+
+
+def _bench_iptables(args, groups):
+    driver = iptables_fwaas_v2.IptablesFwaasDriver()
+    driver.conntrack = mock.Mock()
+    ipt_mgr = iptables_manager.IptablesManager(
+        namespace=args.namespace, use_ipv6=True,
+        external_lock=bool(args.namespace))
+    ri = _make_router(ipt_mgr)
+    start = time.monotonic()
+    for firewall, ports in groups:
+        driver.create_firewall_group('legacy', [(ri, ports)], firewall)
+    elapsed = time.monotonic() - start
+
+    # worst case: egress IPv4 packet of the last port of the last group
+    firewall, ports = groups[-1]
+    ifname = driver._get_intf_name(iptables_fwaas_v2.INTERNAL_DEV_PREFIX,
+                                   ports[-1])
+    table = ipt_mgr.ipv4['filter']
+    forward = [str(rule) for rule in table.rules
+               if rule.chain == iptables_fwaas_v2.FORWARD_CHAIN]
+    chain = iptables_manager.get_chain_name(driver._get_chain_name(
+        firewall['id'], iptables_fwaas_v2.IPV4, 'egress'))
+    default_jump = [i for i, rule in enumerate(forward)
+                    if '-i %s ' % ifname in rule and
+                    iptables_fwaas_v2.FWAAS_DEFAULT_CHAIN[:11] in rule]
+    chain_rules = [rule for rule in table.rules if rule.chain == chain]
+    # every FORWARD rule up to the default jump, then the group's chain
+    traversal = default_jump[0] + 1 + len(chain_rules)
+    return elapsed, traversal
+
+
+def _bench_nftables(args, groups):
+    driver = nftables_fwaas_v2.NftablesFwaasDriver()
+    driver.conntrack = mock.Mock()
+    if not args.namespace:
+        driver.execute = _offline_execute
+    ipt_mgr = mock.Mock()
+    ipt_mgr.namespace = args.namespace
+    ri = _make_router(ipt_mgr)
+    start = time.monotonic()
+    for firewall, ports in groups:
+        driver.create_firewall_group('legacy', [(ri, ports)], firewall)
+    elapsed = time.monotonic() - start
+
+    firewall, ports = groups[-1]
+    group = driver.namespaces[args.namespace][firewall['id']]
+    # two verdict map lookups, the group's chain, then the default drop
+    traversal = 2 + 2 + len(group['rules']['egress']) + 1
+    return elapsed, traversal
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--groups', type=int, default=10,
+                        help='number of firewall groups on the router')
+    parser.add_argument('--rules', type=int, default=100,
+                        help='number of rules of each firewall group')
+    parser.add_argument('--ports', type=int, default=4,
+                        help='number of router ports of each group')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the rule generator')
+    parser.add_argument('--namespace', default=None,
+                        help='network namespace to really apply rules to')
+    args = parser.parse_args()
+    cfg.CONF([], project='neutron')
+
+    groups = _make_groups(args)
+    results = {}
+    if args.namespace:
+        results['iptables'] = _bench_iptables(args, groups)
+    else:
+        with mock.patch.object(linux_utils, 'execute',
+                               side_effect=_offline_execute):
+            results['iptables'] = _bench_iptables(args, groups)
+    results['nftables'] = _bench_nftables(args, groups)
+
+    print('%d groups x %d rules x %d ports%s' % (
+        args.groups, args.rules, args.ports,
+        '' if args.namespace else ' (dry run)'))
+    print('%-10s %14s %20s' % ('driver', 'apply (ms)', 'worst traversal'))
+    for name, (elapsed, traversal) in sorted(results.items()):
+        print('%-10s %14.1f %20d' % (name, elapsed * 1000, traversal))
+
+
+if __name__ == '__main__':
+    main()